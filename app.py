@@ -2,10 +2,20 @@ from dotenv import load_dotenv
 load_dotenv()
 
 import inspect
+import io
+import json
 import math
 import os
+import threading
+import time
+from collections import namedtuple
 import extractors
-from flask import Flask, request, render_template, session, send_file, redirect, url_for
+from flask import Flask, request, render_template, session, send_file, redirect, url_for, jsonify, g, Response
+from rq.exceptions import NoSuchJobError
+from rq.job import Job
+import metrics
+import tasks
+import uploads
 from extractors import (
     get_data_biostats,
     calculate_dmc,
@@ -14,17 +24,40 @@ from extractors import (
     get_data_pm,
     get_data_conform,
     get_data_eclinical,
+    get_assumed_data,
+    get_merged_data,
+    get_provided_data,
+    merged_extraction_enabled,
+    needs_provided_data,
+    run_concurrently,
+    unique_documents,
 )
-from excel_utils import populate_template
+from model_cache import cache_stats
+from session_store import make_session_interface
 from word_utils import populate_work_order
-from openpyxl import load_workbook
-from docx import Document
 import tempfile
 
 
 app = Flask(__name__)
 app.secret_key = os.environ.get("FLASK_KEY", "edetek123")
 app.config["MAX_CONTENT_LENGTH"] = 50 * 1024 * 1024  # 50 MB
+# The extracted fields live server-side; the cookie only carries a session ID.
+app.session_interface = make_session_interface(tasks.redis_conn)
+
+
+@app.before_request
+def _start_timing():
+    g.request_started = time.perf_counter()
+    metrics.start_request()
+
+
+@app.after_request
+def _add_server_timing(response):
+    # Per-stage durations of this request, visible in the browser dev tools.
+    started = g.get("request_started")
+    total = None if started is None else time.perf_counter() - started
+    response.headers["Server-Timing"] = metrics.server_timing_header(total)
+    return response
 
 ALLOWED_EXTENSIONS = {"pdf", "docx"}
 
@@ -263,74 +296,197 @@ def _lookup_numeric(data, key):
     return 0.0
 
 
-def _calculate_formula(field, data):
-    num = lambda key: _lookup_numeric(data, key)
-
-    if field == "adam_fr":
-        return num("subj_dur") * 1.5
-    if field == "crf_pages_complete":
-        return num("num_visits") * num("crf_pages_per_visit")
-    if field == "crf_pages_total":
-        return (
+class DerivedField(namedtuple("DerivedField", "inputs compute")):
+    """
+    A field calculated from other fields. ``inputs`` lists every field the
+    formula reads; ``compute`` receives a numeric lookup for those fields.
+    """
+
+
+# Declarative version of FIELD_FORMULAS. The inputs form a DAG that is
+# evaluated in topological order, so a formula that reads another derived
+# field (crf_pages_total reads crf_pages_complete) always sees its new value.
+DERIVED_FIELDS = {
+    "adam_fr": DerivedField(
+        ("subj_dur",),
+        lambda num: num("subj_dur") * 1.5,
+    ),
+    "crf_pages_complete": DerivedField(
+        ("num_visits", "crf_pages_per_visit"),
+        lambda num: num("num_visits") * num("crf_pages_per_visit"),
+    ),
+    "crf_pages_total": DerivedField(
+        ("num_complete", "crf_pages_complete", "avg_unscheduled_visits", "crf_pages_per_visit",
+         "num_withdrawn", "crf_pages_withdrawn", "num_screen_fail", "crf_pages_screen_fail"),
+        lambda num: (
             num("num_complete")
             * (num("crf_pages_complete") + num("avg_unscheduled_visits") * num("crf_pages_per_visit"))
             + num("num_withdrawn") * num("crf_pages_withdrawn")
             + num("num_screen_fail") * num("crf_pages_screen_fail")
-        )
-    if field == "auto_queries_total":
-        return num("auto_queries_complete") * num("num_complete") + num("auto_queries_screen_fail") * num("num_screen_fail") + num("auto_queries_withdrawn") * num("num_withdrawn")
-    if field == "manual_queries_total":
-        return num("manual_queries_complete") * num("num_complete") + num("manual_queries_withdrawn") * num("num_withdrawn")
-    if field == "num_screened_subj":
-        return 1 / (1-num("screen_failure_rate")) * num("num_subj")
-    if field == "crf_pages_withdrawn":
-        return num("crf_pages_complete") / 2.0
-    if field == "dsur_years":
-        return math.floor(num("total_dur") / 12.0)
-    if field == "investigator_years":
-        return math.floor(num("total_dur") / 12.0)
-    if field == "num_complete":
-        return num("num_subj") * (1 - num("withdrawal_rate"))
-    if field == "num_screen_fail":
-        return num("num_screened") * num("screen_failure_rate")
-    if field == "num_unique_terms_aemh":
-        return num("num_subj") * 10 * 0.05
-    if field == "num_unique_terms_cm":
-        return num("num_subj") * 8 * 0.3
-    if field == "num_withdrawn":
-        return num("num_subj") * num("dropout_rate")
-    if field == "sdtm_fr":
-        return num("subj_dur") * 3
-    if field == "num_dmc_meet":
-        return math.ceil(num("subj_dur") / 6.0)
-    if field == "tlf_final_fr":
-        return num("subj_dur")
-    if field == "tlf_dmc_fr":
-        return num("num_dmc_meet")
-    if field == "tlf_dmc_repeat_figures":
-        return math.floor(num("tlf_final_repeat_figures") * 0.6)
-    if field == "tlf_dmc_repeat_listings":
-        return math.floor(num("tlf_final_repeat_listings") * 0.6)
-    if field == "tlf_dmc_repeat_tables":
-        return math.floor(num("tlf_final_repeat_tables") * 0.6)
-    if field == "tlf_dmc_unique_figures":
-        return math.floor(num("tlf_final_unique_figures") * 0.6)
-    if field == "tlf_dmc_unique_listings":
-        return math.floor(num("tlf_final_unique_listings") * 0.6)
-    if field == "tlf_dmc_unique_tables":
-        return math.floor(num("tlf_final_unique_tables") * 0.6)
-    if field == "sdtm_dmc_fr":
-        return num("num_dmc_meet")
-    if field == "adam_dmc_fr":
-        return num("num_dmc_meet")
-    return None
-
-
-def _apply_auto_formulas(data, auto_flags):
+        ),
+    ),
+    "auto_queries_total": DerivedField(
+        ("auto_queries_complete", "num_complete", "auto_queries_screen_fail", "num_screen_fail",
+         "auto_queries_withdrawn", "num_withdrawn"),
+        lambda num: num("auto_queries_complete") * num("num_complete") + num("auto_queries_screen_fail") * num("num_screen_fail") + num("auto_queries_withdrawn") * num("num_withdrawn"),
+    ),
+    "manual_queries_total": DerivedField(
+        ("manual_queries_complete", "num_complete", "manual_queries_withdrawn", "num_withdrawn"),
+        lambda num: num("manual_queries_complete") * num("num_complete") + num("manual_queries_withdrawn") * num("num_withdrawn"),
+    ),
+    "num_screened_subj": DerivedField(
+        ("screen_failure_rate", "num_subj"),
+        lambda num: 1 / (1-num("screen_failure_rate")) * num("num_subj"),
+    ),
+    "crf_pages_withdrawn": DerivedField(
+        ("crf_pages_complete",),
+        lambda num: num("crf_pages_complete") / 2.0,
+    ),
+    "dsur_years": DerivedField(
+        ("total_dur",),
+        lambda num: math.floor(num("total_dur") / 12.0),
+    ),
+    "investigator_years": DerivedField(
+        ("total_dur",),
+        lambda num: math.floor(num("total_dur") / 12.0),
+    ),
+    "num_complete": DerivedField(
+        ("num_subj", "withdrawal_rate"),
+        lambda num: num("num_subj") * (1 - num("withdrawal_rate")),
+    ),
+    "num_screen_fail": DerivedField(
+        ("num_screened", "screen_failure_rate"),
+        lambda num: num("num_screened") * num("screen_failure_rate"),
+    ),
+    "num_unique_terms_aemh": DerivedField(
+        ("num_subj",),
+        lambda num: num("num_subj") * 10 * 0.05,
+    ),
+    "num_unique_terms_cm": DerivedField(
+        ("num_subj",),
+        lambda num: num("num_subj") * 8 * 0.3,
+    ),
+    "num_withdrawn": DerivedField(
+        ("num_subj", "dropout_rate"),
+        lambda num: num("num_subj") * num("dropout_rate"),
+    ),
+    "sdtm_fr": DerivedField(
+        ("subj_dur",),
+        lambda num: num("subj_dur") * 3,
+    ),
+    "num_dmc_meet": DerivedField(
+        ("subj_dur",),
+        lambda num: math.ceil(num("subj_dur") / 6.0),
+    ),
+    "tlf_final_fr": DerivedField(
+        ("subj_dur",),
+        lambda num: num("subj_dur"),
+    ),
+    "tlf_dmc_fr": DerivedField(
+        ("num_dmc_meet",),
+        lambda num: num("num_dmc_meet"),
+    ),
+    "tlf_dmc_repeat_figures": DerivedField(
+        ("tlf_final_repeat_figures",),
+        lambda num: math.floor(num("tlf_final_repeat_figures") * 0.6),
+    ),
+    "tlf_dmc_repeat_listings": DerivedField(
+        ("tlf_final_repeat_listings",),
+        lambda num: math.floor(num("tlf_final_repeat_listings") * 0.6),
+    ),
+    "tlf_dmc_repeat_tables": DerivedField(
+        ("tlf_final_repeat_tables",),
+        lambda num: math.floor(num("tlf_final_repeat_tables") * 0.6),
+    ),
+    "tlf_dmc_unique_figures": DerivedField(
+        ("tlf_final_unique_figures",),
+        lambda num: math.floor(num("tlf_final_unique_figures") * 0.6),
+    ),
+    "tlf_dmc_unique_listings": DerivedField(
+        ("tlf_final_unique_listings",),
+        lambda num: math.floor(num("tlf_final_unique_listings") * 0.6),
+    ),
+    "tlf_dmc_unique_tables": DerivedField(
+        ("tlf_final_unique_tables",),
+        lambda num: math.floor(num("tlf_final_unique_tables") * 0.6),
+    ),
+    "sdtm_dmc_fr": DerivedField(
+        ("num_dmc_meet",),
+        lambda num: num("num_dmc_meet"),
+    ),
+    "adam_dmc_fr": DerivedField(
+        ("num_dmc_meet",),
+        lambda num: num("num_dmc_meet"),
+    ),
+}
+
+
+def _formula_graph(derived):
+    """Return (dependents, topological order) for the derived-field DAG."""
+    dependents = {}
+    for field, node in derived.items():
+        for name in node.inputs:
+            # A formula input may be read through an alias; edits to either
+            # spelling must reach the formula.
+            for source in (name,) + _FORMULA_ALIASES.get(name, ()):
+                dependents.setdefault(source, set()).add(field)
+
+    order = []
+    state = {}
+
+    def visit(field):
+        if state.get(field) == "done":
+            return
+        if state.get(field) == "active":
+            raise ValueError(f"Cycle in DERIVED_FIELDS at {field!r}")
+        state[field] = "active"
+        for name in derived[field].inputs:
+            for source in (name,) + _FORMULA_ALIASES.get(name, ()):
+                if source in derived:
+                    visit(source)
+        state[field] = "done"
+        order.append(field)
+
+    for field in derived:
+        visit(field)
+    return dependents, order
+
+
+_FORMULA_DEPENDENTS, _FORMULA_ORDER = _formula_graph(DERIVED_FIELDS)
+
+
+def _downstream_fields(changed):
+    """Derived fields that must be recomputed after ``changed`` were edited."""
+    dirty = {field for field in changed if field in DERIVED_FIELDS}
+    stack = list(changed)
+    while stack:
+        for dependent in _FORMULA_DEPENDENTS.get(stack.pop(), ()):
+            if dependent not in dirty:
+                dirty.add(dependent)
+                stack.append(dependent)
+    return dirty
+
+
+def _calculate_formula(field, data):
+    node = DERIVED_FIELDS.get(field)
+    if node is None:
+        return None
+    return node.compute(lambda key: _lookup_numeric(data, key))
+
+
+def _apply_auto_formulas(data, auto_flags, changed=None):
+    """
+    Recompute the derived fields whose auto-update flag is on, in dependency
+    order. With ``changed`` (the fields the user just edited), only fields
+    downstream of those edits are recomputed; otherwise all of them are.
+    """
     if not auto_flags:
         return data
 
-    for field in FIELD_FORMULAS.keys():
+    dirty = None if changed is None else _downstream_fields(changed)
+    for field in _FORMULA_ORDER:
+        if dirty is not None and field not in dirty:
+            continue
         if not auto_flags.get(field, True):
             continue
         value = _calculate_formula(field, data)
@@ -402,6 +558,13 @@ SHEETS_MAP = {"biostats": ["Study Information", "Budget Summary", "Biostatistics
 BUDGET_PLACEHOLDER_TOKEN = "__BUDGET_TABLES__"
 
 
+def _sheets_for_steps(steps):
+    keep = set()
+    for step in steps:
+        keep.update(SHEETS_MAP.get(step, []))
+    return keep
+
+
 def _ordered_service_sheets(steps, workbook):
     seen = set()
     ordered = []
@@ -437,33 +600,32 @@ def _worksheet_to_rows(worksheet):
     return rows
 
 
+@metrics.timed()
 def _collect_budget_tables(data, steps):
     if not steps:
         return []
 
-    tmp_in = tempfile.NamedTemporaryFile(suffix=".xlsx", delete=False)
-    tmp_in.close()
+    from excel_utils import build_workbook
+
+    # openpyxl never recalculates, so the formula results are evaluated here
+    # and written into the cells in place of the formulas.
+    wb = build_workbook(data, TEMPLATE_PATH, keep_sheets=_sheets_for_steps(steps), calculate=True)
     try:
-        populate_template(data, TEMPLATE_PATH, tmp_in.name)
-        wb = load_workbook(tmp_in.name, data_only=True)
-        try:
-            tables = []
-            for sheet_name in _ordered_service_sheets(steps, wb):
-                worksheet = wb[sheet_name]
-                rows = _worksheet_to_rows(worksheet)
-                if rows:
-                    tables.append((sheet_name, rows))
-            return tables
-        finally:
-            wb.close()
+        tables = []
+        for sheet_name in _ordered_service_sheets(steps, wb):
+            worksheet = wb[sheet_name]
+            rows = _worksheet_to_rows(worksheet)
+            if rows:
+                tables.append((sheet_name, rows))
+        return tables
     finally:
-        try:
-            os.remove(tmp_in.name)
-        except OSError:
-            pass
+        wb.close()
 
 
+@metrics.timed()
 def _embed_budget_tables(doc_path, tables, placeholder_token):
+    from docx import Document
+
     document = Document(doc_path)
 
     placeholder_para = None
@@ -523,6 +685,19 @@ def allowed_file(filename):
         and filename.rsplit(".", 1)[1].lower() in ALLOWED_EXTENSIONS
     )
 
+
+def _spooled_documents(field):
+    """
+    The allowed files posted under ``field``, streamed to the upload spool
+    directory; the documents reference the spooled files instead of
+    holding their bytes.
+    """
+    return [
+        uploads.make_document(uploads.spool(f.stream), f.filename)
+        for f in request.files.getlist(field)
+        if f and allowed_file(f.filename)
+    ]
+
 def _extract_work_order_fields(documents):
     extractor = getattr(extractors, "extract_wo", None)
     if not callable(extractor):
@@ -546,6 +721,10 @@ def _extract_work_order_fields(documents):
         app.logger.exception("extract_wo failed")
         return {}
 
+    return _work_order_fields(result)
+
+
+def _work_order_fields(result):
     if not isinstance(result, dict):
         app.logger.warning("extract_wo returned non-dict result: %r", type(result))
         return {}
@@ -559,33 +738,54 @@ def _ensure_manual_work_order_fields(data):
     return data
 
 
+@metrics.timed()
 def run_extraction(steps, documents, refresh_opts, dmc_opts):
 
     data = {}
     services_list = []
-    print(2)
+    # The model prompts do not depend on each other, so they are sent together
+    # and the builders below only combine their results. The common study facts
+    # are extracted once and shared by every builder.
+    calls = {}
+    if needs_provided_data(steps):
+        calls["provided"] = (get_provided_data, documents)
+    if "biostats" in steps:
+        calls["assumed"] = (get_assumed_data, documents)
+    if documents:
+        calls["work_order"] = (_extract_work_order_fields, documents)
+    if merged_extraction_enabled() and len(calls) > 1:
+        # EXTRACTION_MODE=merged: one request for every prompt's variables.
+        prefetched = get_merged_data(documents, list(calls))
+        if "work_order" in prefetched:
+            prefetched["work_order"] = _work_order_fields(prefetched["work_order"])
+    else:
+        prefetched = run_concurrently(calls)
+    provided = prefetched.get("provided")
+
     if "data_management" in steps:
-        data = selective_update(data, get_data_dm(documents))
+        data = selective_update(data, get_data_dm(documents, provided))
         services_list.append("Data Management")
     if "eclinical" in steps:
         data = selective_update(data, get_data_eclinical(documents))
         services_list.append("eClinical Setup")
     if "biostats" in steps:
-        data = selective_update(data, get_data_biostats(documents))
+        data = selective_update(
+            data,
+            get_data_biostats(documents, provided, prefetched.get("assumed")),
+        )
         services_list.append("Biostatistics and Programming")
     if "conform" in steps:
-        data = selective_update(data, get_data_conform(documents))
+        data = selective_update(data, get_data_conform(documents, provided))
         services_list.append("CONFORM Informatics")
     if "project_management" in steps:
-        data = selective_update(data, get_data_pm(documents))
+        data = selective_update(data, get_data_pm(documents, provided))
         services_list.append("Project Management")
 
 
     services = ", ".join(services_list)
-    if documents:
-        work_order_fields = _extract_work_order_fields(documents)
-        if work_order_fields:
-            data.update(work_order_fields)
+    work_order_fields = prefetched.get("work_order")
+    if work_order_fields:
+        data.update(work_order_fields)
 
     _ensure_manual_work_order_fields(data)
     data["services"] = services
@@ -593,23 +793,30 @@ def run_extraction(steps, documents, refresh_opts, dmc_opts):
 
     return data
 
+@metrics.timed()
 def run_substeps(steps, data, refresh_opts, dmc_opts):
     # if refresh_opts is a tuple (do_refresh, docs[])
     do_refresh, refresh_docs = refresh_opts
     r = True
     if not refresh_docs:
         r = False        
-        
-    if "biostats" in steps and do_refresh:
-        data.update(calculate_refresh(data, refresh_docs, r))
 
     # same for DMC:
     do_dmc, dmc_docs = dmc_opts
     d = True
     if not dmc_docs:
         d = False
+
+    # EXTRACTION_MODE=merged: when both sub-steps read files, ask once over both sets.
+    merged = {}
+    if "biostats" in steps and do_refresh and r and do_dmc and d and merged_extraction_enabled():
+        merged = get_merged_data(unique_documents(refresh_docs + dmc_docs), ["refresh", "dmc"])
+
+    if "biostats" in steps and do_refresh:
+        data.update(calculate_refresh(data, refresh_docs, r, merged.get("refresh")))
+
     if "biostats" in steps and do_dmc:
-        data.update(calculate_dmc(data, dmc_docs, d))
+        data.update(calculate_dmc(data, dmc_docs, d, merged.get("dmc")))
 
     _ensure_manual_work_order_fields(data)
 
@@ -626,6 +833,8 @@ def select_types():
         session["extraction_steps"] = chosen
         session.pop("extracted", None)
         session.pop("auto_update_flags", None)
+        session.pop("pending_job", None)
+        session.pop("documents", None)
         return redirect(url_for("upload_and_extract"))
     return render_template("select_types.html")
 
@@ -636,39 +845,14 @@ def upload_and_extract():
 
     if request.method == "POST":
         # 1) Gather any top‑level uploads
-        raw_docs = request.files.getlist("docs")
-        documents = [
-            {
-              "file_bytes": f.read(),
-              "format": f.filename.rsplit(".", 1)[1].lower(),
-              "name":    os.path.splitext(f.filename)[0]
-            }
-            for f in raw_docs
-            if f and allowed_file(f.filename)
-        ]
+        documents = _spooled_documents("docs")
 
         # 2) Check sub‑step flags and their helper docs
         do_refresh = request.form.get("calculate_refresh") == "yes"
-        refresh_docs = [
-            {
-              "file_bytes": f.read(),
-              "format": f.filename.rsplit(".", 1)[1].lower(),
-              "name":    os.path.splitext(f.filename)[0]
-            }
-            for f in request.files.getlist("refresh_docs")
-            if f and allowed_file(f.filename)
-        ]
+        refresh_docs = _spooled_documents("refresh_docs")
 
         do_dmc = request.form.get("calculate_dmc") == "yes"
-        dmc_docs = [
-            {
-              "file_bytes": f.read(),
-              "format": f.filename.rsplit(".", 1)[1].lower(),
-              "name":    os.path.splitext(f.filename)[0]
-            }
-            for f in request.files.getlist("dmc_docs")
-            if f and allowed_file(f.filename)
-        ]
+        dmc_docs = _spooled_documents("dmc_docs")
 
         # —————————————————————————————
         # A) SAVE‑CHANGES ONLY (no docs, no flags)
@@ -684,15 +868,23 @@ def upload_and_extract():
 
             posted_auto = set(request.form.getlist("auto_update"))
             present_auto = set(request.form.getlist("auto_update_field"))
+            # Fields whose value was edited or whose auto update was just
+            # switched on; only formulas downstream of these are recomputed.
+            changed = set()
             for key in auto_flags.keys():
                 if key in present_auto:
-                    auto_flags[key] = key in posted_auto
+                    enabled = key in posted_auto
+                    if enabled and not auto_flags[key]:
+                        changed.add(key)
+                    auto_flags[key] = enabled
 
             control_fields = {
                 "calculate_refresh",
                 "calculate_dmc",
                 "refresh_file_opt_in",
                 "dmc_file_opt_in",
+                "refresh_reuse_docs",
+                "dmc_reuse_docs",
                 "auto_update",
                 "auto_update_field",
             }
@@ -700,9 +892,13 @@ def upload_and_extract():
             for key, val in request.form.items():
                 if key in control_fields:
                     continue
+                previous = data.get(key)
+                shown = "" if previous in (-1, "-1", None) else str(previous)
+                if key not in data or val != shown:
+                    changed.add(key)
                 data[key] = val
 
-            data = _apply_auto_formulas(data, auto_flags)
+            data = _apply_auto_formulas(data, auto_flags, changed)
             _ensure_manual_work_order_fields(data)
             session["extracted"] = data
             session["auto_update_flags"] = auto_flags
@@ -725,111 +921,272 @@ def upload_and_extract():
         if session.get("base_done") and (do_refresh or do_dmc):
             data = session.get("extracted", {}).copy()
             _ensure_manual_work_order_fields(data)
-            extract = run_substeps(
-                steps,
-                data,
-                (do_refresh, refresh_docs),
-                (do_dmc,     dmc_docs),
-            )
-            _ensure_manual_work_order_fields(extract)
-            auto_flags = _normalize_auto_flags(
-                extract,
-                session.get("auto_update_flags"),
-            )
-            extract = _apply_auto_formulas(extract, auto_flags)
-            session["extracted"] = extract
-            session["auto_update_flags"] = auto_flags
 
-
-            display = {k: ("" if v in (-1, "-1") else v) for k, v in extract.items()}
-            return render_template(
-                "results.html",
-                results=display,
-                descriptions=FIELD_DESCRIPTIONS,
-                formulas=FIELD_FORMULAS,
-                notes=FIELD_NOTES,
-                show_dmc_prompt=_should_offer_dmc(steps, extract),
-                auto_flags=auto_flags,
-            )
+            # Sub-steps can reuse the protocol uploaded for the base
+            # extraction straight from the document store.
+            reuse_refresh = do_refresh and request.form.get("refresh_reuse_docs") == "yes"
+            reuse_dmc = do_dmc and request.form.get("dmc_reuse_docs") == "yes"
+            if reuse_refresh or reuse_dmc:
+                stored = uploads.stored_documents(session.get("documents") or [])
+                if stored is None:
+                    session.pop("documents", None)
+                    return render_template(
+                        "upload.html",
+                        error="The documents uploaded earlier have expired. Please upload them again.",
+                    )
+                if reuse_refresh:
+                    refresh_docs = refresh_docs + stored
+                if reuse_dmc:
+                    dmc_docs = dmc_docs + stored
+
+            refresh_opts = (do_refresh, refresh_docs)
+            dmc_opts = (do_dmc, dmc_docs)
+
+            # Only file-backed sub-steps call the model; the rest is arithmetic.
+            if refresh_docs or dmc_docs:
+                job = tasks.enqueue(
+                    tasks.run_substeps, steps, data, refresh_opts, dmc_opts,
+                    kind="substep", owner=session.sid,
+                )
+                return _render_waiting(job, "substeps")
+
+            extract = run_substeps(steps, data, refresh_opts, dmc_opts)
+            return _render_extracted(steps, extract, session.get("auto_update_flags"))
 
         
-        print(8)
         session.pop("base_done", None)
-        data = run_extraction(steps, documents, (do_refresh, refresh_docs), (do_dmc, dmc_docs))
-        session["base_done"] = True
-        auto_flags = _normalize_auto_flags(data)
-        data = _apply_auto_formulas(data, auto_flags)
-        session["extracted"] = data
-        session["auto_update_flags"] = auto_flags
-        print(1)
-        display = {k: ("" if v in (-1, "-1") else v) for k, v in data.items()}
-        return render_template(
-            "results.html",
-            results=display,
-            descriptions=FIELD_DESCRIPTIONS,
-            formulas=FIELD_FORMULAS,
-            notes=FIELD_NOTES,
-            show_dmc_prompt=_should_offer_dmc(steps, data),
-            auto_flags=auto_flags,
+        session["documents"] = uploads.document_refs(documents)
+        job = tasks.enqueue(
+            tasks.run_extraction,
+            steps,
+            documents,
+            (do_refresh, refresh_docs),
+            (do_dmc, dmc_docs),
+            owner=session.sid,
         )
+        return _render_waiting(job, "extraction")
 
     # GET → show upload form
     return render_template("upload.html")
 
 
+def _render_waiting(job, kind):
+    """Remember the queued job for /results and show the polling page."""
+    session["pending_job"] = {"id": job.id, "kind": kind}
+    return render_template("waiting.html", job_id=job.id)
+
+
+def _render_extracted(steps, data, stored_flags=None):
+    """Apply auto formulas, store the result in the session and render it."""
+    _ensure_manual_work_order_fields(data)
+    auto_flags = _normalize_auto_flags(data, stored_flags)
+    data = _apply_auto_formulas(data, auto_flags)
+    session["extracted"] = data
+    session["auto_update_flags"] = auto_flags
+
+    display = {k: ("" if v in (-1, "-1") else v) for k, v in data.items()}
+    return render_template(
+        "results.html",
+        results=display,
+        descriptions=FIELD_DESCRIPTIONS,
+        formulas=FIELD_FORMULAS,
+        notes=FIELD_NOTES,
+        show_dmc_prompt=_should_offer_dmc(steps, data),
+        auto_flags=auto_flags,
+    )
+
+
+def _job_status(job):
+    status = job.get_status()
+    return getattr(status, "value", status)
 
-@app.route("/export", methods=["POST"])
-def export():
-    steps = session.get("extraction_steps", [])
-    data  = session.get("extracted")
-    if not steps or not data:
-        return redirect(url_for("select_types"))
 
-    # --- sanitize ---
+def _job_error(job):
+    result = job.latest_result()
+    exc_string = getattr(result, "exc_string", None) or ""
+    lines = [line for line in exc_string.strip().splitlines() if line.strip()]
+    return lines[-1] if lines else "unknown error"
+
+
+def _job_payload(job):
+    """Status, per-call progress and, while queued, queue position of ``job``."""
+    status = _job_status(job)
+    payload = {"status": status, "progress": job.meta.get("progress", {})}
+    if status == "failed":
+        payload["error"] = _job_error(job)
+    elif status == "queued":
+        payload["queue"] = job.origin
+        payload["position"] = job.get_position()
+    return payload
+
+
+@app.route("/status/<job_id>", methods=["GET"])
+def job_status(job_id):
+    try:
+        job = Job.fetch(job_id, connection=tasks.redis_conn)
+    except NoSuchJobError:
+        return jsonify({"status": "failed", "error": "Job not found or expired"}), 404
+    return jsonify(_job_payload(job))
+
+
+# Without events, the job is still re-read this often, in case its worker
+# died without saying so; the comment sent then also keeps proxies from
+# closing the idle connection.
+EVENTS_CHECK_INTERVAL = 15
+# Streams end after this long and the browser reconnects, so a stuck page
+# cannot hold a web thread forever.
+EVENTS_MAX_SECONDS = 300
+TERMINAL_STATUSES = {"finished", "failed", "stopped", "canceled"}
+# Every open stream holds a web thread (and a Redis connection) for up to
+# EVENTS_MAX_SECONDS. Past this many per process, /events answers 503 and
+# the page polls /status instead; keep it well below gunicorn's --threads
+# so uploads and downloads still get a thread.
+EVENTS_MAX_STREAMS = int(os.environ.get("EVENTS_MAX_STREAMS", "4"))
+_event_streams = threading.BoundedSemaphore(EVENTS_MAX_STREAMS)
+
+
+def _sse(event, data):
+    return f"event: {event}\ndata: {json.dumps(data, default=str)}\n\n"
+
+
+@app.route("/events/<job_id>", methods=["GET"])
+def job_events(job_id):
+    """
+    Server-Sent Events for one job: a "status" event (the /status payload)
+    on connect and whenever the job changes state, and a "progress" event
+    for every model-call update the worker publishes. The stream ends once
+    the job is over. Answers 503 when EVENTS_MAX_STREAMS streams are open.
+    """
+    try:
+        job = Job.fetch(job_id, connection=tasks.redis_conn)
+    except NoSuchJobError:
+        return jsonify({"status": "failed", "error": "Job not found or expired"}), 404
+    if not _event_streams.acquire(blocking=False):
+        metrics.inc("event_streams_rejected_total")
+        return jsonify({"error": "Too many open event streams; poll /status instead"}), 503
+
+    def stream():
+        pubsub = tasks.redis_conn.pubsub(ignore_subscribe_messages=True)
+        # Subscribe before reading the job, so no event falls in between.
+        pubsub.subscribe(tasks.progress_channel(job_id))
+        try:
+            yield "retry: 2000\n"
+            payload = _job_payload(job)
+            yield _sse("status", payload)
+            deadline = time.monotonic() + EVENTS_MAX_SECONDS
+            while payload["status"] not in TERMINAL_STATUSES and time.monotonic() < deadline:
+                message = pubsub.get_message(timeout=EVENTS_CHECK_INTERVAL)
+                if message is not None:
+                    event = json.loads(message["data"])
+                    if "status" not in event:
+                        yield _sse("progress", event)
+                        continue
+                # A state change, or the periodic look at the job (a queued
+                # job's position also moves without any event).
+                job.refresh()
+                latest = _job_payload(job)
+                if latest["status"] != payload["status"] or latest.get("position") != payload.get("position"):
+                    yield _sse("status", latest)
+                else:
+                    yield ": keep-alive\n\n"
+                payload = latest
+        finally:
+            pubsub.close()
+
+    response = Response(
+        stream(),
+        mimetype="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+    # Runs when the server closes the response, even if the stream never started.
+    response.call_on_close(_event_streams.release)
+    return response
+
+
+@app.route("/results", methods=["GET"])
+def results():
+    steps = session.get("extraction_steps") or []
+    pending = session.get("pending_job")
+
+    if not pending:
+        data = session.get("extracted")
+        if not data:
+            return redirect(url_for("select_types"))
+        return _render_extracted(steps, data.copy(), session.get("auto_update_flags"))
+
+    try:
+        job = Job.fetch(pending["id"], connection=tasks.redis_conn)
+    except NoSuchJobError:
+        session.pop("pending_job", None)
+        return render_template("upload.html", error="The extraction job expired. Please upload again.")
+
+    status = _job_status(job)
+    if status == "failed":
+        session.pop("pending_job", None)
+        return render_template("upload.html", error=f"Extraction failed: {_job_error(job)}")
+    if status != "finished":
+        return render_template("waiting.html", job_id=job.id)
+
+    data = job.return_value()
+    session.pop("pending_job", None)
+    if pending["kind"] == "extraction":
+        session["base_done"] = True
+        return _render_extracted(steps, data)
+    return _render_extracted(steps, data, session.get("auto_update_flags"))
+
+
+
+@metrics.timed()
+def write_budget_workbook(data, steps, output):
+    """
+    Fill the master template with `data`, keeping only the sheets for
+    `steps`, and write it once to `output` (a path or a binary buffer).
+    """
+    from excel_utils import populate_template
+
     sanitized = {
         k: ("" if v == -1 or v == "-1" else v)
         for k, v in data.items()
     }
-    
-    # 1) Fill the master template into a temp file
-    tmp_in = tempfile.NamedTemporaryFile(suffix=".xlsx", delete=False)
-    tmp_in.close()
-    populate_template(sanitized,TEMPLATE_PATH,tmp_in.name)
-
-    # 2) Load the populated workbook and decide which sheets to keep
-    wb = load_workbook(tmp_in.name)
-    to_keep = set()
-    for step in steps:
-        # grab the list of sheet names for this step
-        for sheet_name in SHEETS_MAP.get(step, []):
-            if sheet_name in wb.sheetnames:
-                to_keep.add(sheet_name)
+    populate_template(sanitized, TEMPLATE_PATH, output, keep_sheets=_sheets_for_steps(steps))
 
-    # 3) Remove any sheet not in the to_keep set
-    for sheet in list(wb.sheetnames):
-        if sheet not in to_keep:
-            wb.remove(wb[sheet])
 
-    # 4) Save the pruned workbook to another temp file and send it
-    tmp_out = tempfile.NamedTemporaryFile(suffix=".xlsx", delete=False)
-    tmp_out.close()
-    wb.save(tmp_out.name)
+@metrics.timed()
+def write_work_order(data, steps, output_path):
+    """Populate the Word work order for `data` and embed the budget tables."""
+    sanitized = {
+        k: ("" if v in (-1, "-1", None) else v)
+        for k, v in data.items()
+    }
 
-    resp = send_file(
-        tmp_out.name,
+    budget_tables = _collect_budget_tables(sanitized.copy(), steps)
+
+    payload = {field: sanitized.get(field, "") for field in WORK_ORDER_FIELDS}
+    payload["budget_tables"] = BUDGET_PLACEHOLDER_TOKEN
+
+    populate_work_order(payload, WO_TEMPLATE_PATH, output_path)
+    _embed_budget_tables(output_path, budget_tables, BUDGET_PLACEHOLDER_TOKEN)
+
+
+@app.route("/export", methods=["POST"])
+def export():
+    steps = session.get("extraction_steps", [])
+    data  = session.get("extracted")
+    if not steps or not data:
+        return redirect(url_for("select_types"))
+
+    # Fill only the sheets for the chosen steps and write the workbook once,
+    # straight into the response buffer.
+    buffer = io.BytesIO()
+    write_budget_workbook(data, steps, buffer)
+    buffer.seek(0)
+
+    return send_file(
+        buffer,
         as_attachment=True,
         download_name="budget_proposal.xlsx",
         mimetype="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"
     )
-    @resp.call_on_close
-    def cleanup():
-        try:
-            os.remove(tmp_in.name)
-            os.remove(tmp_out.name)
-        except OSError:
-            pass
-
-    return resp
 
 
 @app.route("/export_work_order", methods=["POST"])
@@ -839,20 +1196,10 @@ def export_work_order():
     if not data:
         return redirect(url_for("select_types"))
 
-    sanitized = {
-        k: ("" if v in (-1, "-1", None) else v)
-        for k, v in data.items()
-    }
-
-    budget_tables = _collect_budget_tables(sanitized.copy(), steps)
-
-    payload = {field: sanitized.get(field, "") for field in WORK_ORDER_FIELDS}
-    payload["budget_tables"] = BUDGET_PLACEHOLDER_TOKEN
     tmp_out = tempfile.NamedTemporaryFile(suffix=".docx", delete=False)
     tmp_out.close()
 
-    populate_work_order(payload, WO_TEMPLATE_PATH, tmp_out.name)
-    _embed_budget_tables(tmp_out.name, budget_tables, BUDGET_PLACEHOLDER_TOKEN)
+    write_work_order(data, steps, tmp_out.name)
 
 
     resp = send_file(
@@ -871,5 +1218,47 @@ def export_work_order():
 
     return resp
 
+@app.route("/metrics", methods=["GET"])
+def prometheus_metrics():
+    """Stage timings, model usage and queue depth in the Prometheus text format."""
+    body = metrics.render_prometheus()
+    try:
+        stats = tasks.queue_stats()
+    except Exception as e:
+        app.logger.warning("Queue stats unavailable: %s", e)
+    else:
+        body += metrics.render_gauge(
+            "job_queue_depth",
+            "Jobs waiting in each queue.",
+            [({"queue": name}, stat["waiting"]) for name, stat in stats.items()],
+        )
+        body += metrics.render_gauge(
+            "job_queue_running",
+            "Jobs currently running from each queue.",
+            [({"queue": name}, stat["running"]) for name, stat in stats.items()],
+        )
+        body += metrics.render_gauge(
+            "job_queue_oldest_wait_seconds",
+            "How long the oldest waiting job in each queue has been queued.",
+            [({"queue": name}, round(stat["oldest_wait"], 3)) for name, stat in stats.items()],
+        )
+    return Response(body, mimetype="text/plain; version=0.0.4")
+
+
+@app.route("/queues", methods=["GET"])
+def queue_status():
+    """Depth, running jobs and oldest wait (seconds) of every job queue."""
+    return jsonify(tasks.queue_stats())
+
+
+@app.route("/cache/stats", methods=["GET"])
+def model_cache_stats():
+    """
+    Hit/miss counts and size of this dyno's model response cache. Worker
+    dynos keep their own cache file, which this does not include.
+    """
+    return jsonify(cache_stats())
+
+
 if __name__ == "__main__":
     app.run(host="0.0.0.0", port=int(os.environ.get("PORT", 5000)), debug=True)
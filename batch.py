@@ -0,0 +1,304 @@
+# batch.py
+"""
+Price a folder (or manifest) of protocols offline.
+
+    python batch.py protocols/ out/ --steps biostats,data_management --workers 4
+    python batch.py manifest.csv out/
+
+A folder input treats every .pdf/.docx file as one proposal, and every
+sub-folder as one proposal made of all the documents inside it. A manifest
+(.csv or .json) lists one proposal per row with the columns/keys ``id``,
+``files`` (``;``-separated, relative to the manifest), and optionally
+``steps`` (``,``-separated), ``refresh`` and ``dmc``.
+
+Each proposal goes through the same pipeline as the web app
+(app.run_extraction, run_substeps, auto formulas, write_budget_workbook and
+write_work_order), so model replies are served from the shared response
+cache and model calls obey the same EXTRACTION_CONCURRENCY and
+MODEL_MAX_IN_FLIGHT limits. Progress is recorded in ``progress.json`` in the
+output folder; re-running the same command skips proposals that already
+finished with unchanged inputs. ``summary.csv`` lists every proposal.
+"""
+
+import argparse
+import csv
+import hashlib
+import json
+import os
+import re
+import sys
+import threading
+import time
+import traceback
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+from dotenv import load_dotenv
+
+load_dotenv()
+
+import app as webapp
+import uploads
+from excel_utils import calculate_template
+
+
+DOCUMENT_EXTENSIONS = tuple(f".{ext}" for ext in webapp.ALLOWED_EXTENSIONS)
+PROGRESS_FILE = "progress.json"
+SUMMARY_FILE = "summary.csv"
+SUMMARY_FIELDS = [
+    "id", "status", "files", "steps", "study_number", "sponsor",
+    "total_budget", "seconds", "xlsx", "docx", "error",
+]
+# Budget Summary cell holding "Total Budget Before Discount".
+TOTAL_BUDGET_CELL = ("Budget Summary", "B54")
+# Proposal ids name the output files, so they stay plain file names.
+JOB_ID_RE = re.compile(r"^[A-Za-z0-9_-][A-Za-z0-9._-]*$")
+
+
+def _truthy(value):
+    return str(value).strip().lower() in {"1", "true", "yes", "y"}
+
+
+def _split(value, sep):
+    if isinstance(value, (list, tuple)):
+        return [str(v).strip() for v in value if str(v).strip()]
+    return [part.strip() for part in str(value or "").split(sep) if part.strip()]
+
+
+def _folder_job_id(entry, taken):
+    """
+    Id for a folder entry: its name without extension, with other characters
+    than JOB_ID_RE allows replaced. ``X.pdf``, ``X.docx`` and ``X/`` would
+    share one id, so later ones get ``-2``, ``-3``, ...
+    """
+    base = re.sub(r"[^A-Za-z0-9._-]", "_", os.path.splitext(entry)[0]).lstrip(".") or "proposal"
+    job_id = base
+    suffix = 2
+    while job_id in taken:
+        job_id = f"{base}-{suffix}"
+        suffix += 1
+    taken.add(job_id)
+    return job_id
+
+
+def discover_jobs(source, default_steps, refresh=False, dmc=False):
+    """
+    Return the list of proposals described by a folder or manifest. Raises
+    ValueError for manifest rows with an invalid or repeated id, or unknown
+    steps.
+    """
+    if os.path.isdir(source):
+        taken = set()
+        jobs = []
+        for entry in sorted(os.listdir(source)):
+            path = os.path.join(source, entry)
+            if os.path.isdir(path):
+                files = [
+                    os.path.join(path, name)
+                    for name in sorted(os.listdir(path))
+                    if name.lower().endswith(DOCUMENT_EXTENSIONS)
+                ]
+            elif entry.lower().endswith(DOCUMENT_EXTENSIONS):
+                files = [path]
+            else:
+                continue
+            if files:
+                jobs.append({
+                    "id": _folder_job_id(entry, taken),
+                    "files": files,
+                    "steps": list(default_steps),
+                    "refresh": refresh,
+                    "dmc": dmc,
+                })
+        return jobs
+
+    base = os.path.dirname(os.path.abspath(source))
+    if source.lower().endswith(".json"):
+        with open(source, encoding="utf-8") as fh:
+            rows = json.load(fh)
+    else:
+        with open(source, newline="", encoding="utf-8") as fh:
+            rows = list(csv.DictReader(fh))
+
+    jobs = []
+    seen = set()
+    for index, row in enumerate(rows, 1):
+        job_id = str(row.get("id") or f"proposal_{index}").strip()
+        if not JOB_ID_RE.match(job_id):
+            raise ValueError(f"{job_id!r}: ids may only contain letters, digits, '.', '_' and '-'")
+        if job_id in seen:
+            raise ValueError(f"{job_id}: id used by more than one proposal")
+        seen.add(job_id)
+        files = [
+            path if os.path.isabs(path) else os.path.join(base, path)
+            for path in _split(row.get("files"), ";")
+        ]
+        steps = _split(row.get("steps"), ",") or list(default_steps)
+        unknown = [step for step in steps if step not in webapp.SHEETS_MAP]
+        if unknown:
+            raise ValueError(f"{job_id}: unknown steps: {', '.join(unknown)}")
+        jobs.append({
+            "id": job_id,
+            "files": files,
+            "steps": steps,
+            "refresh": _truthy(row.get("refresh", refresh)),
+            "dmc": _truthy(row.get("dmc", dmc)),
+        })
+    return jobs
+
+
+def load_documents(paths):
+    documents = []
+    for path in paths:
+        filename = os.path.basename(path)
+        if not webapp.allowed_file(filename):
+            raise ValueError(f"Unsupported document type: {filename}")
+        documents.append(uploads.make_document(uploads.from_path(path), filename))
+    return documents
+
+
+def job_fingerprint(job):
+    """Hash of the job's options and document contents, used to resume safely."""
+    digest = hashlib.sha256()
+    digest.update(json.dumps(
+        {"steps": sorted(job["steps"]), "refresh": job["refresh"], "dmc": job["dmc"]},
+        sort_keys=True,
+    ).encode("utf-8"))
+    for path in job["files"]:
+        with open(path, "rb") as fh:
+            for chunk in iter(lambda: fh.read(1024 * 1024), b""):
+                digest.update(chunk)
+    return digest.hexdigest()
+
+
+def price_proposal(job, output_dir):
+    """Run one proposal end to end and write its xlsx/docx outputs."""
+    steps = job["steps"]
+    documents = load_documents(job["files"])
+
+    data = webapp.run_extraction(steps, documents, (job["refresh"], []), (job["dmc"], []))
+    if job["refresh"] or (job["dmc"] and webapp._should_offer_dmc(steps, data)):
+        data = webapp.run_substeps(steps, data, (job["refresh"], []), (job["dmc"], []))
+
+    auto_flags = webapp._normalize_auto_flags(data)
+    data = webapp._apply_auto_formulas(data, auto_flags)
+
+    xlsx_path = os.path.join(output_dir, f"{job['id']}.xlsx")
+    docx_path = os.path.join(output_dir, f"{job['id']}.docx")
+    webapp.write_budget_workbook(data, steps, xlsx_path)
+    webapp.write_work_order(data, steps, docx_path)
+
+    sanitized = {k: ("" if v in (-1, "-1", None) else v) for k, v in data.items()}
+    keep_sheets = webapp._sheets_for_steps(steps)
+    total = calculate_template(sanitized, webapp.TEMPLATE_PATH, keep_sheets).get(TOTAL_BUDGET_CELL)
+
+    return {
+        "study_number": data.get("study_number", ""),
+        "sponsor": data.get("sponsor", ""),
+        "total_budget": total if isinstance(total, (int, float)) else "",
+        "xlsx": xlsx_path,
+        "docx": docx_path,
+    }
+
+
+class Progress:
+    """Thread-safe progress.json holding one record per proposal id."""
+
+    def __init__(self, path, resume=True):
+        self.path = path
+        self.lock = threading.Lock()
+        self.records = {}
+        if resume and os.path.exists(path):
+            with open(path, encoding="utf-8") as fh:
+                self.records = json.load(fh)
+
+    def is_done(self, job_id, fingerprint):
+        record = self.records.get(job_id)
+        return bool(record) and record.get("status") == "done" and record.get("fingerprint") == fingerprint
+
+    def update(self, job_id, record):
+        with self.lock:
+            self.records[job_id] = record
+            tmp = self.path + ".tmp"
+            with open(tmp, "w", encoding="utf-8") as fh:
+                json.dump(self.records, fh, indent=2, sort_keys=True)
+            os.replace(tmp, self.path)
+
+
+def write_summary(path, jobs, progress):
+    with open(path, "w", newline="", encoding="utf-8") as fh:
+        writer = csv.DictWriter(fh, fieldnames=SUMMARY_FIELDS, extrasaction="ignore")
+        writer.writeheader()
+        for job in jobs:
+            record = progress.records.get(job["id"], {"status": "pending"})
+            writer.writerow({
+                **record,
+                "id": job["id"],
+                "files": ";".join(os.path.basename(p) for p in job["files"]),
+                "steps": ",".join(job["steps"]),
+            })
+
+
+def run_batch(jobs, output_dir, workers=2, resume=True):
+    os.makedirs(output_dir, exist_ok=True)
+    progress = Progress(os.path.join(output_dir, PROGRESS_FILE), resume=resume)
+
+    def run(job):
+        started = time.perf_counter()
+        try:
+            fingerprint = job_fingerprint(job)
+            if progress.is_done(job["id"], fingerprint):
+                return job["id"], "skipped"
+            result = price_proposal(job, output_dir)
+            record = {"status": "done", "fingerprint": fingerprint, **result}
+        except Exception as e:
+            traceback.print_exc()
+            record = {"status": "failed", "error": f"{type(e).__name__}: {e}"}
+        record["seconds"] = round(time.perf_counter() - started, 2)
+        progress.update(job["id"], record)
+        return job["id"], record["status"]
+
+    with ThreadPoolExecutor(max_workers=max(1, workers)) as pool:
+        futures = [pool.submit(run, job) for job in jobs]
+        for done, future in enumerate(as_completed(futures), 1):
+            job_id, status = future.result()
+            print(f"[{done}/{len(jobs)}] {job_id}: {status}", flush=True)
+
+    write_summary(os.path.join(output_dir, SUMMARY_FILE), jobs, progress)
+    return progress.records
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Price a directory or manifest of protocols offline.")
+    parser.add_argument("source", help="folder of protocols, or a .csv/.json manifest")
+    parser.add_argument("output_dir", help="where xlsx/docx outputs, progress.json and summary.csv go")
+    parser.add_argument("--steps", default="biostats,data_management,project_management",
+                        help="comma-separated services for proposals without their own steps")
+    parser.add_argument("--workers", type=int, default=int(os.environ.get("BATCH_WORKERS", "2")),
+                        help="proposals priced at the same time")
+    parser.add_argument("--refresh", action="store_true", help="also run the refresh sub-step")
+    parser.add_argument("--dmc", action="store_true", help="also run the DMC sub-step when DMC/IA is detected")
+    parser.add_argument("--no-resume", action="store_true", help="re-price proposals that already finished")
+    args = parser.parse_args(argv)
+
+    steps = _split(args.steps, ",")
+    unknown = [step for step in steps if step not in webapp.SHEETS_MAP]
+    if unknown:
+        parser.error(f"unknown steps: {', '.join(unknown)}")
+
+    try:
+        jobs = discover_jobs(args.source, steps, refresh=args.refresh, dmc=args.dmc)
+    except ValueError as exc:
+        parser.error(str(exc))
+    if not jobs:
+        print("No protocols found.", file=sys.stderr)
+        return 1
+
+    records = run_batch(jobs, args.output_dir, workers=args.workers, resume=not args.no_resume)
+    failed = sum(1 for job in jobs if records.get(job["id"], {}).get("status") == "failed")
+    print(f"{len(jobs) - failed}/{len(jobs)} proposals priced; summary in "
+          f"{os.path.join(args.output_dir, SUMMARY_FILE)}")
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,217 @@
+import logging
+import os
+import random
+import threading
+import time
+from typing import Optional
+
+
+logger = logging.getLogger(__name__)
+
+# Error codes worth retrying: quota and capacity errors clear up on their own.
+# Errors raised mid-stream (EventStreamError) carry the same codes with a
+# lowercase first letter, so codes are compared case-insensitively.
+RETRYABLE_CODES = {
+    "ThrottlingException",
+    "TooManyRequestsException",
+    "ServiceUnavailableException",
+    "ModelNotReadyException",
+    "ModelStreamErrorException",
+    "InternalServerException",
+}
+_RETRYABLE = {code.lower() for code in RETRYABLE_CODES}
+
+
+def _env_float(name: str, default: float) -> float:
+    try:
+        return float(os.environ.get(name, "").strip() or default)
+    except ValueError:
+        return default
+
+
+def _env_int(name: str, default: int) -> int:
+    return int(_env_float(name, default))
+
+
+_client = None
+_client_lock = threading.Lock()
+
+
+def get_client():
+    """
+    Return the process-wide bedrock-runtime client. The connection pool is
+    sized for MODEL_MAX_IN_FLIGHT concurrent requests. botocore makes a
+    single attempt per request; ``call`` is the only retry policy, so its
+    backoff is the only place a throttled request waits.
+    """
+    global _client
+    with _client_lock:
+        if _client is None:
+            # boto3 is slow to import; only processes that call the model pay for it.
+            import boto3
+            from botocore.config import Config
+
+            in_flight = _env_int("MODEL_MAX_IN_FLIGHT", 8)
+            config = Config(
+                region_name=os.environ.get("BEDROCK_REGION") or os.environ.get("AWS_REGION") or "us-east-1",
+                max_pool_connections=_env_int("BEDROCK_MAX_POOL_CONNECTIONS", max(10, in_flight)),
+                connect_timeout=_env_int("BEDROCK_CONNECT_TIMEOUT", 10),
+                read_timeout=_env_int("BEDROCK_READ_TIMEOUT", 300),
+                tcp_keepalive=True,
+                retries={"mode": "standard", "max_attempts": 1},
+            )
+            session = boto3.Session(profile_name=os.environ.get("BEDROCK_PROFILE") or None)
+            _client = session.client("bedrock-runtime", config=config)
+        return _client
+
+
+class TokenBucket:
+    """
+    In-process token bucket. ``acquire`` reserves a token and sleeps until it
+    is due, so callers queue up in arrival order instead of failing.
+    """
+
+    def __init__(self, rate_per_minute: float, burst: int):
+        self.rate = rate_per_minute / 60.0
+        self.capacity = float(burst)
+        self.tokens = float(burst)
+        self.updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def reserve(self) -> float:
+        """Take one token and return how long to wait before using it."""
+        with self._lock:
+            now = time.monotonic()
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            self.tokens -= 1
+            return 0.0 if self.tokens >= 0 else -self.tokens / self.rate
+
+    def acquire(self) -> None:
+        wait = self.reserve()
+        if wait > 0:
+            time.sleep(wait)
+
+
+# Same reservation logic as TokenBucket, run atomically inside Redis so the
+# web app and every RQ worker draw from one shared budget.
+_RESERVE_SCRIPT = """
+local rate = tonumber(ARGV[1])
+local capacity = tonumber(ARGV[2])
+local clock = redis.call('TIME')
+local now = tonumber(clock[1]) + tonumber(clock[2]) / 1000000
+local state = redis.call('HMGET', KEYS[1], 'tokens', 'updated')
+local tokens = tonumber(state[1]) or capacity
+local updated = tonumber(state[2]) or now
+tokens = math.min(capacity, tokens + (now - updated) * rate) - 1
+redis.call('HSET', KEYS[1], 'tokens', tostring(tokens), 'updated', tostring(now))
+redis.call('EXPIRE', KEYS[1], math.ceil(capacity / rate) + 60)
+if tokens >= 0 then
+  return '0'
+end
+return tostring(-tokens / rate)
+"""
+
+
+class RedisTokenBucket(TokenBucket):
+    """
+    Token bucket shared through Redis. If Redis cannot be reached the
+    in-process bucket is used instead for the next ``fallback_seconds``, so
+    model calls are still paced.
+    """
+
+    def __init__(self, redis_conn, rate_per_minute: float, burst: int,
+                 key: str = "bedrock:rate", fallback_seconds: float = 30.0):
+        super().__init__(rate_per_minute, burst)
+        self.redis = redis_conn
+        self.key = key
+        self.fallback_seconds = fallback_seconds
+        self._local_until = 0.0
+        self._script = redis_conn.register_script(_RESERVE_SCRIPT)
+
+    def reserve(self) -> float:
+        if time.monotonic() >= self._local_until:
+            try:
+                return float(self._script(keys=[self.key], args=[self.rate, self.capacity]))
+            except Exception as e:
+                logger.warning("Redis rate limiter unavailable, pacing locally: %s", e)
+                self._local_until = time.monotonic() + self.fallback_seconds
+        return super().reserve()
+
+
+_limiter = None
+_limiter_lock = threading.Lock()
+
+
+def get_rate_limiter() -> Optional[TokenBucket]:
+    """
+    Return the limiter for model requests, or None when
+    BEDROCK_REQUESTS_PER_MINUTE is 0. ``BEDROCK_RATE_LIMIT_BACKEND`` picks
+    ``redis`` (default, shared across processes) or ``local``.
+    """
+    global _limiter
+    rate = _env_float("BEDROCK_REQUESTS_PER_MINUTE", 50)
+    if rate <= 0:
+        return None
+    with _limiter_lock:
+        if _limiter is None:
+            burst = _env_int("BEDROCK_BURST", 10)
+            backend = os.environ.get("BEDROCK_RATE_LIMIT_BACKEND", "redis").strip().lower()
+            if backend == "redis":
+                from redis import Redis
+
+                redis_conn = Redis.from_url(
+                    os.environ.get("REDIS_URL", "redis://localhost:6379"),
+                    socket_timeout=2,
+                    socket_connect_timeout=2,
+                )
+                _limiter = RedisTokenBucket(redis_conn, rate, burst)
+            else:
+                _limiter = TokenBucket(rate, burst)
+        return _limiter
+
+
+def _backoff(attempt: int) -> float:
+    """Full-jitter exponential backoff."""
+    base = _env_float("BEDROCK_RETRY_BASE", 1.0)
+    cap = _env_float("BEDROCK_RETRY_CAP", 30.0)
+    return random.uniform(0, min(cap, base * 2 ** attempt))
+
+
+def _error_code(error: Exception) -> Optional[str]:
+    # EventStreamError, raised while reading a reply stream, is a ClientError.
+    from botocore.exceptions import ClientError
+
+    if isinstance(error, ClientError):
+        return error.response.get("Error", {}).get("Code")
+    return None
+
+
+def is_retryable(error: Exception) -> bool:
+    """Whether ``call`` retries ``error`` (throttling and capacity errors)."""
+    return (_error_code(error) or "").lower() in _RETRYABLE
+
+
+def call(fn, *args, **kwargs):
+    """
+    Run ``fn(*args, **kwargs)`` (a request to the model) under the rate
+    limiter, retrying throttling and capacity errors with exponential backoff
+    and jitter up to BEDROCK_MAX_RETRIES times. Other errors, and the last
+    retryable one, are raised unchanged.
+    """
+    max_retries = _env_int("BEDROCK_MAX_RETRIES", 6)
+    limiter = get_rate_limiter()
+    attempt = 0
+    while True:
+        if limiter is not None:
+            limiter.acquire()
+        try:
+            return fn(*args, **kwargs)
+        except Exception as e:
+            if not is_retryable(e) or attempt >= max_retries:
+                raise
+            code = _error_code(e)
+            delay = _backoff(attempt)
+            attempt += 1
+            logger.warning("Bedrock %s, retry %d/%d in %.1fs", code, attempt, max_retries, delay)
+            time.sleep(delay)
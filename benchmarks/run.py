@@ -0,0 +1,212 @@
+# benchmarks/run.py
+"""
+End-to-end benchmarks for extraction, export and work-order generation.
+
+    python benchmarks/run.py                 # compare against baseline.json
+    python benchmarks/run.py --save          # record a new baseline
+    python benchmarks/run.py --only export   # cases whose name contains "export"
+
+Each case runs a few times and the median wall time is compared with the
+stored baseline; a case more than ``--threshold`` times slower (plus a small
+absolute allowance for very fast cases) is reported as a regression and the
+runner exits with status 1. Model calls go to the offline stub backend, so
+no network or AWS profile is needed. Baselines are machine specific:
+record one on the machine that checks against it.
+"""
+
+import argparse
+import io
+import json
+import os
+import shutil
+import statistics
+import sys
+import tempfile
+import time
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+BASE_DIR = os.path.dirname(BENCH_DIR)
+BASELINE_PATH = os.path.join(BENCH_DIR, "baseline.json")
+REPLIES_PATH = os.path.join(BENCH_DIR, "replies.json")
+
+STEPS = ["biostats", "data_management", "project_management", "conform", "eclinical"]
+# Regressions smaller than this many seconds are treated as noise.
+ABSOLUTE_ALLOWANCE = 0.005
+
+
+def _configure_environment(scratch):
+    """Keep every cache and store inside ``scratch`` and the model offline."""
+    os.environ["MODEL_BACKEND"] = "stub"
+    os.environ["MODEL_CACHE_ENABLED"] = "0"
+    os.environ["BEDROCK_REQUESTS_PER_MINUTE"] = "0"
+    os.environ["METRICS_BACKEND"] = "local"
+    os.environ["SESSION_BACKEND"] = "sqlite"
+    os.environ["SESSION_SQLITE_PATH"] = os.path.join(scratch, "sessions.sqlite3")
+    os.environ["DOCUMENT_TEXT_CACHE_DIR"] = os.path.join(scratch, "doc_text")
+    if BASE_DIR not in sys.path:
+        sys.path.insert(0, BASE_DIR)
+
+
+def _protocol_document():
+    """A small synthetic protocol, enough for the extraction pipeline to chew on."""
+    from docx import Document
+
+    document = Document()
+    document.add_paragraph("Protocol BENCH-001. Sponsor: Benchmark Pharma. A Phase 2 study.")
+    sections = {
+        "Synopsis": "200 subjects at 40 sites in 5 countries, enrolled over 12 months.",
+        "Objectives and Endpoints": "Primary efficacy endpoint; secondary pharmacokinetics and safety.",
+        "Schedule of Assessments": "14 scheduled visits per subject over 18 months.",
+        "Data Monitoring Committee": "An independent DMC meets every 6 months; one interim analysis.",
+    }
+    for heading, text in sections.items():
+        document.add_heading(heading, 1)
+        for _ in range(20):
+            document.add_paragraph(text)
+    buffer = io.BytesIO()
+    document.save(buffer)
+    return [{"file_bytes": buffer.getvalue(), "format": "docx", "name": "BENCH-001"}]
+
+
+def build_cases(scratch):
+    import app as webapp
+    from extractors import extract_dict
+    from excel_utils import populate_template
+    from word_utils import populate_work_order
+
+    with open(REPLIES_PATH, encoding="utf-8") as fh:
+        replies = json.load(fh)
+    documents = _protocol_document()
+
+    data = webapp.run_extraction(STEPS, documents, (True, []), (True, []))
+    data = webapp.run_substeps(STEPS, data, (True, []), (True, []))
+    data = webapp._apply_auto_formulas(data, webapp._normalize_auto_flags(data))
+    sanitized = {k: ("" if v in (-1, "-1", None) else v) for k, v in data.items()}
+
+    client = webapp.app.test_client()
+    with client.session_transaction() as sess:
+        sess["extraction_steps"] = STEPS
+        sess["extracted"] = data
+
+    def extract_replies():
+        for reply in replies:
+            extract_dict(reply)
+
+    def extraction_pipeline():
+        webapp.run_extraction(STEPS, documents, (True, []), (True, []))
+
+    def workbook():
+        populate_template(sanitized, webapp.TEMPLATE_PATH, io.BytesIO())
+
+    # Work order with the placeholder already filled in, copied fresh for
+    # every run so only the table collection and embedding are timed.
+    populated_wo = os.path.join(scratch, "populated_wo.docx")
+    populate_work_order(
+        {field: sanitized.get(field, "") for field in webapp.WORK_ORDER_FIELDS},
+        webapp.WO_TEMPLATE_PATH,
+        populated_wo,
+    )
+
+    def budget_tables():
+        path = os.path.join(scratch, "tables.docx")
+        shutil.copyfile(populated_wo, path)
+        tables = webapp._collect_budget_tables(dict(sanitized), STEPS)
+        webapp._embed_budget_tables(path, tables, webapp.BUDGET_PLACEHOLDER_TOKEN)
+
+    def work_order():
+        payload = {field: sanitized.get(field, "") for field in webapp.WORK_ORDER_FIELDS}
+        populate_work_order(payload, webapp.WO_TEMPLATE_PATH, os.path.join(scratch, "wo.docx"))
+
+    def export_request():
+        response = client.post("/export")
+        assert response.status_code == 200, response.status_code
+        response.get_data()
+        response.close()
+
+    def export_work_order_request():
+        response = client.post("/export_work_order")
+        assert response.status_code == 200, response.status_code
+        response.get_data()
+        response.close()
+
+    return {
+        "extract_dict_corpus": extract_replies,
+        "run_extraction_stub": extraction_pipeline,
+        "populate_template": workbook,
+        "budget_tables_embed": budget_tables,
+        "populate_work_order": work_order,
+        "export_request": export_request,
+        "export_work_order_request": export_work_order_request,
+    }
+
+
+def measure(fn, repeat, warmup=1):
+    for _ in range(warmup):
+        fn()
+    times = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        fn()
+        times.append(time.perf_counter() - started)
+    return {"median": statistics.median(times), "min": min(times), "repeat": repeat}
+
+
+def compare(results, baseline, threshold):
+    """Return the names of cases slower than ``threshold`` times their baseline."""
+    regressions = []
+    for name, result in results.items():
+        base = baseline.get(name)
+        if base is None:
+            print(f"{name:28s} {result['median'] * 1000:9.1f} ms   (no baseline)")
+            continue
+        ratio = result["median"] / base["median"] if base["median"] else float("inf")
+        allowed = base["median"] * threshold + ABSOLUTE_ALLOWANCE
+        flag = "REGRESSION" if result["median"] > allowed else "ok"
+        print(f"{name:28s} {result['median'] * 1000:9.1f} ms   {ratio:5.2f}x baseline   {flag}")
+        if flag != "ok":
+            regressions.append(name)
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark extraction, export and work-order generation.")
+    parser.add_argument("--save", action="store_true", help="write the results as the new baseline")
+    parser.add_argument("--threshold", type=float, default=2.0,
+                        help="slowdown factor against the baseline that counts as a regression")
+    parser.add_argument("--repeat", type=int, default=5, help="timed runs per case")
+    parser.add_argument("--only", help="run only cases whose name contains this text")
+    parser.add_argument("--baseline", default=BASELINE_PATH)
+    args = parser.parse_args(argv)
+
+    scratch = tempfile.mkdtemp(prefix="bench-")
+    try:
+        _configure_environment(scratch)
+        cases = build_cases(scratch)
+        if args.only:
+            cases = {name: fn for name, fn in cases.items() if args.only in name}
+
+        results = {name: measure(fn, args.repeat) for name, fn in cases.items()}
+    finally:
+        shutil.rmtree(scratch, ignore_errors=True)
+
+    baseline = {}
+    if os.path.exists(args.baseline):
+        with open(args.baseline, encoding="utf-8") as fh:
+            baseline = json.load(fh)
+    regressions = compare(results, baseline, args.threshold)
+
+    if args.save:
+        baseline.update(results)
+        with open(args.baseline, "w", encoding="utf-8") as fh:
+            json.dump(baseline, fh, indent=2, sort_keys=True)
+        print(f"Baseline written to {args.baseline}")
+        return 0
+
+    if regressions:
+        print(f"{len(regressions)} regression(s): {', '.join(regressions)}")
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
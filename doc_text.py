@@ -0,0 +1,142 @@
+import hashlib
+import os
+import threading
+from typing import Any, BinaryIO, Dict, Optional
+
+import metrics
+from uploads import document_digest, open_document
+
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+DEFAULT_TEXT_CACHE_DIR = os.path.join(BASE_DIR, ".cache", "doc_text")
+
+# A PDF page with less text than this is most likely a scan or an image;
+# if the whole document looks like that, the model gets the raw file instead.
+MIN_CHARS_PER_PAGE = 200
+
+_write_lock = threading.Lock()
+
+
+def preextract_enabled() -> bool:
+    """Local text extraction is on unless ``DOCUMENT_PREEXTRACT=0``."""
+    return os.environ.get("DOCUMENT_PREEXTRACT", "1").strip().lower() not in {"0", "false", "no", "off"}
+
+
+def _cache_dir() -> str:
+    return os.environ.get("DOCUMENT_TEXT_CACHE_DIR") or DEFAULT_TEXT_CACHE_DIR
+
+
+def content_hash(file_bytes: bytes) -> str:
+    return hashlib.sha256(file_bytes).hexdigest()
+
+
+def _pdf_text(stream: BinaryIO) -> Optional[str]:
+    from pypdf import PdfReader
+
+    reader = PdfReader(stream)
+    pages = []
+    for number, page in enumerate(reader.pages, 1):
+        text = (page.extract_text() or "").strip()
+        if text:
+            pages.append(f"[Page {number}]\n{text}")
+
+    total = sum(len(page) for page in pages)
+    if not reader.pages or total < MIN_CHARS_PER_PAGE * len(reader.pages) / 4:
+        return None
+    return "\n\n".join(pages)
+
+
+def _docx_text(stream: BinaryIO) -> Optional[str]:
+    from docx import Document
+    from docx.table import Table
+
+    document = Document(stream)
+    blocks = []
+    for block in document.iter_inner_content():
+        if isinstance(block, Table):
+            rows = []
+            for row in block.rows:
+                cells = [cell.text.strip().replace("\n", " ") for cell in row.cells]
+                if any(cells):
+                    rows.append(" | ".join(cells))
+            if rows:
+                blocks.append("\n".join(rows))
+        else:
+            text = block.text.strip()
+            if text:
+                style = getattr(block.style, "name", "") or ""
+                # Keep headings recognisable for the section indexer.
+                if style.lower().startswith("heading"):
+                    text = f"# {text}"
+                blocks.append(text)
+    return "\n\n".join(blocks) or None
+
+
+_EXTRACTORS = {
+    "pdf": _pdf_text,
+    "docx": _docx_text,
+}
+
+
+def _read_cached(path: str) -> Optional[str]:
+    try:
+        with open(path, encoding="utf-8") as fh:
+            return fh.read()
+    except OSError:
+        return None
+
+
+def _write_cached(path: str, text: str) -> None:
+    directory = os.path.dirname(path)
+    with _write_lock:
+        os.makedirs(directory, exist_ok=True)
+        tmp = f"{path}.{os.getpid()}.tmp"
+        with open(tmp, "w", encoding="utf-8") as fh:
+            fh.write(text)
+        os.replace(tmp, path)
+
+
+_extraction_locks: Dict[str, threading.Lock] = {}
+
+
+def _extraction_lock(digest: str) -> threading.Lock:
+    with _write_lock:
+        return _extraction_locks.setdefault(digest, threading.Lock())
+
+
+def document_text(doc: Dict[str, Any]) -> Optional[str]:
+    """
+    Return the locally extracted text of one uploaded document, or None when
+    the format is unsupported, the file looks scanned, or extraction fails.
+    Results are cached on disk by content hash, including "no text layer";
+    failures are not, since the file may only have been unreadable for now
+    (an expired upload, an I/O error).
+    """
+    extractor = _EXTRACTORS.get(doc.get("format"))
+    if extractor is None:
+        return None
+
+    digest = document_digest(doc)
+    path = os.path.join(_cache_dir(), f"{digest}.{doc['format']}.txt")
+    cached = _read_cached(path)
+    if cached is not None:
+        return cached or None
+
+    # Concurrent prompts for the same proposal wait for one extraction.
+    with _extraction_lock(digest):
+        cached = _read_cached(path)
+        if cached is not None:
+            return cached or None
+        try:
+            with metrics.span(f"document_text.{doc['format']}"), open_document(doc) as stream:
+                text = extractor(stream)
+        except Exception:
+            text = None
+        else:
+            try:
+                _write_cached(path, text or "")
+            except OSError:
+                pass
+    with _write_lock:
+        _extraction_locks.pop(digest, None)
+    return text
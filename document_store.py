@@ -0,0 +1,207 @@
+import os
+import shutil
+import tempfile
+import threading
+import time
+from typing import BinaryIO, Optional
+
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+DEFAULT_STORE_DIR = os.path.join(BASE_DIR, ".cache", "documents")
+
+CHUNK_SIZE = 1024 * 1024
+# A half-written document left by a process killed mid-upload expires
+# after this long.
+PARTIAL_TTL = 3600
+
+
+class _RedisReader:
+    """Read-only stream over a Redis string, fetched one chunk at a time."""
+
+    def __init__(self, redis_conn, key: str):
+        self.redis = redis_conn
+        self.key = key
+        self.offset = 0
+
+    def read(self, size: int = -1) -> bytes:
+        if size is None or size < 0:
+            end = -1
+        else:
+            end = self.offset + size - 1
+        chunk = self.redis.getrange(self.key, self.offset, end)
+        self.offset += len(chunk)
+        return chunk
+
+    def close(self) -> None:
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+class RedisDocumentStore:
+    """
+    Documents as Redis strings under ``document:<sha256>`` that expire
+    ``ttl`` seconds after they were last stored or looked up. Written and
+    read in chunks, so neither side holds a whole protocol in memory.
+
+    The same Redis holds the job queues and sessions, and a full Redis
+    rejects their writes, so the documents are kept under ``max_bytes``
+    in total: storing one evicts the least recently used others.
+    """
+
+    def __init__(self, redis_conn, ttl: int, max_bytes: int = 0, prefix: str = "document:"):
+        self.redis = redis_conn
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self.prefix = prefix
+        # digest -> time of last use, for eviction.
+        self.index = prefix + "index"
+
+    def exists(self, digest: str) -> bool:
+        """Whether ``digest`` is stored; a hit also restarts its TTL."""
+        if not self.redis.expire(self.prefix + digest, self.ttl):
+            return False
+        self.redis.zadd(self.index, {digest: time.time()})
+        return True
+
+    def _evict(self, keep: str) -> None:
+        now = time.time()
+        # Entries unused for longer than the TTL have expired by themselves.
+        self.redis.zremrangebyscore(self.index, 0, now - self.ttl)
+        if not self.max_bytes:
+            return
+        digests = [d.decode() for d in self.redis.zrange(self.index, 0, -1)]
+        pipe = self.redis.pipeline()
+        for digest in digests:
+            pipe.strlen(self.prefix + digest)
+        sizes = pipe.execute()
+        total = sum(sizes)
+        for digest, size in zip(digests, sizes):
+            if total <= self.max_bytes:
+                break
+            if digest == keep:
+                continue
+            pipe.delete(self.prefix + digest)
+            pipe.zrem(self.index, digest)
+            total -= size
+        pipe.execute()
+
+    def put(self, digest: str, stream: BinaryIO) -> None:
+        if self.exists(digest):
+            return
+        partial = f"{self.prefix}{digest}:partial:{os.getpid()}:{threading.get_ident()}"
+        # Created empty with a TTL before the first chunk, so neither an empty
+        # document nor an interrupted upload leaves a key without one.
+        self.redis.set(partial, b"", ex=PARTIAL_TTL)
+        while True:
+            chunk = stream.read(CHUNK_SIZE)
+            if not chunk:
+                break
+            self.redis.append(partial, chunk)
+        pipe = self.redis.pipeline()
+        pipe.rename(partial, self.prefix + digest)
+        pipe.expire(self.prefix + digest, self.ttl)
+        pipe.zadd(self.index, {digest: time.time()})
+        pipe.expire(self.index, self.ttl)
+        pipe.execute()
+        self._evict(keep=digest)
+
+    def open(self, digest: str) -> Optional[BinaryIO]:
+        if not self.exists(digest):
+            return None
+        return _RedisReader(self.redis, self.prefix + digest)
+
+
+class LocalDocumentStore:
+    """
+    Documents as files named by SHA-256 in ``directory``, for single-node
+    installs where the web app and the worker share a disk. Files unused for
+    ``ttl`` seconds are removed on the next write.
+    """
+
+    def __init__(self, directory: str, ttl: int):
+        self.directory = directory
+        self.ttl = ttl
+        os.makedirs(directory, exist_ok=True)
+
+    def _path(self, digest: str) -> str:
+        return os.path.join(self.directory, digest)
+
+    def exists(self, digest: str) -> bool:
+        """Whether ``digest`` is stored; a hit also restarts its TTL."""
+        path = self._path(digest)
+        try:
+            if os.path.getmtime(path) < time.time() - self.ttl:
+                return False
+            os.utime(path)
+            return True
+        except OSError:
+            return False
+
+    def _expire(self) -> None:
+        cutoff = time.time() - self.ttl
+        for name in os.listdir(self.directory):
+            path = os.path.join(self.directory, name)
+            try:
+                if os.path.getmtime(path) < cutoff:
+                    os.remove(path)
+            except OSError:
+                pass
+
+    def put(self, digest: str, stream: BinaryIO) -> None:
+        if self.exists(digest):
+            return
+        self._expire()
+        fd, tmp_path = tempfile.mkstemp(dir=self.directory, suffix=".part")
+        try:
+            with os.fdopen(fd, "wb") as out:
+                shutil.copyfileobj(stream, out, CHUNK_SIZE)
+            os.replace(tmp_path, self._path(digest))
+        except BaseException:
+            try:
+                os.remove(tmp_path)
+            except OSError:
+                pass
+            raise
+
+    def open(self, digest: str) -> Optional[BinaryIO]:
+        if not self.exists(digest):
+            return None
+        try:
+            return open(self._path(digest), "rb")
+        except OSError:
+            return None
+
+
+_store = None
+_store_lock = threading.Lock()
+
+
+def get_store():
+    """
+    Document store selected by ``DOCUMENT_STORE_BACKEND``: ``redis``
+    (default, reachable from every dyno, at most ``DOCUMENT_STORE_MAX_BYTES``
+    in total) or ``local`` (``DOCUMENT_STORE_DIR``). Documents expire
+    ``DOCUMENT_STORE_TTL`` seconds after their last use.
+    """
+    global _store
+    with _store_lock:
+        if _store is None:
+            backend = os.environ.get("DOCUMENT_STORE_BACKEND", "redis").strip().lower()
+            ttl = int(os.environ.get("DOCUMENT_STORE_TTL", str(6 * 60 * 60)))
+            if backend == "local":
+                directory = os.environ.get("DOCUMENT_STORE_DIR") or DEFAULT_STORE_DIR
+                _store = LocalDocumentStore(directory, ttl)
+            else:
+                from redis import Redis
+
+                _store = RedisDocumentStore(
+                    Redis.from_url(os.environ.get("REDIS_URL", "redis://localhost:6379")),
+                    ttl,
+                    int(os.environ.get("DOCUMENT_STORE_MAX_BYTES", str(64 * 1024 * 1024))),
+                )
+        return _store
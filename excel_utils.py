@@ -1,5 +1,91 @@
 from openpyxl import load_workbook
+from openpyxl.utils.indexed_list import IndexedList
 from numbers import Number
+import copyreg
+import io
+import os
+import pickle
+import threading
+
+import metrics
+
+from formula_engine import FormulaError, FormulaModel
+
+
+def _reduce_indexed_list(values):
+    # IndexedList.append drops duplicates, which is what the default pickle
+    # path uses to rebuild it. Style ids index into these lists, so they must
+    # come back unchanged, duplicates included.
+    return IndexedList, (list(values),)
+
+
+def _snapshot_workbook(wb):
+    buffer = io.BytesIO()
+    pickler = pickle.Pickler(buffer, protocol=pickle.HIGHEST_PROTOCOL)
+    pickler.dispatch_table = copyreg.dispatch_table.copy()
+    pickler.dispatch_table[IndexedList] = _reduce_indexed_list
+    pickler.dump(wb)
+    return buffer.getvalue()
+
+
+class CachedTemplate:
+    """
+    A workbook template parsed once, with its defined names resolved to
+    ``(sheet_name, coordinate)`` pairs. ``copy()`` returns an independent
+    workbook rebuilt from an in-memory snapshot, which is far cheaper than
+    parsing the .xlsx again.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self.mtime = os.path.getmtime(path)
+        wb = load_workbook(path)
+        self.sheetnames = list(wb.sheetnames)
+        self.destinations = {
+            name: list(defined_name.destinations)
+            for name, defined_name in wb.defined_names.items()
+        }
+        self._snapshot = _snapshot_workbook(wb)
+        self._formulas = None
+        wb.close()
+
+    def copy(self):
+        return pickle.loads(self._snapshot)
+
+    @property
+    def formulas(self) -> FormulaModel:
+        """The template's compiled formulas, built on first use."""
+        if self._formulas is None:
+            self._formulas = FormulaModel(self.copy())
+        return self._formulas
+
+    def cell_inputs(self, extracted: dict) -> dict:
+        """Map `extracted` onto the ``(sheet, coordinate)`` cells populate_template writes."""
+        inputs = {}
+        for key, value in extracted.items():
+            for sheet_name, coord in self.destinations.get(key, ()):
+                inputs[(sheet_name, coord.replace("$", ""))] = coerce_excel_value(value)
+        return inputs
+
+
+_templates = {}
+_templates_lock = threading.Lock()
+
+
+def get_template(template_path: str) -> CachedTemplate:
+    """
+    Return the cached template for ``template_path``, parsing it on first use
+    and again whenever the file's modification time changes.
+    """
+    path = os.path.abspath(template_path)
+    mtime = os.path.getmtime(path)
+    with _templates_lock:
+        cached = _templates.get(path)
+        if cached is None or cached.mtime != mtime:
+            with metrics.span("template_load"):
+                cached = CachedTemplate(path)
+            _templates[path] = cached
+        return cached
 
 def coerce_excel_value(v):
     """
@@ -31,23 +117,75 @@ def coerce_excel_value(v):
     return v
 
 
-def populate_template(extracted: dict, template_path: str, output_path: str):
+def _calculated_value(value):
+    """Present an evaluated formula result the way Excel would store it."""
+    if isinstance(value, FormulaError):
+        return str(value)
+    if isinstance(value, float) and value.is_integer():
+        return int(value)
+    return value
+
+
+def calculate_template(extracted: dict, template_path: str, keep_sheets=None) -> dict:
+    """
+    Evaluate the formulas of the template at `template_path` as if `extracted`
+    had been written into it. Returns ``{(sheet, coordinate): value}`` for
+    every formula cell; see formula_engine.FormulaModel. With `keep_sheets`,
+    the other sheets count as deleted, as in `build_workbook`.
+    """
+    template = get_template(template_path)
+    with metrics.span("template_calculate"):
+        return template.formulas.evaluate(template.cell_inputs(extracted), keep_sheets)
+
+
+def build_workbook(extracted: dict, template_path: str, keep_sheets=None, calculate=False):
     """
-    Open the Excel file at `template_path`, and for each key in `extracted`,
-    write its value into the single cell defined by the named range of the same name.
+    Return a copy of the cached template at `template_path` with each key in
+    `extracted` written into the cell(s) of the defined name of the same name.
+
+    When `keep_sheets` is given, every other sheet is dropped before anything
+    is written, so values destined for those sheets are never filled in.
+    With `calculate=True`, formula cells are replaced by their evaluated
+    results (see `calculate_template`) instead of the formula text.
     """
-    wb = load_workbook(template_path)
+    template = get_template(template_path)
+    with metrics.span("template_copy"):
+        wb = template.copy()
+
+    if keep_sheets is not None:
+        for sheet_name in template.sheetnames:
+            if sheet_name not in keep_sheets:
+                wb.remove(wb[sheet_name])
 
     for key, value in extracted.items():
         # Skip keys that aren't defined names in the workbook
-        if key not in wb.defined_names:
+        destinations = template.destinations.get(key)
+        if not destinations:
             continue
 
-        dn = wb.defined_names[key]
         coerced = coerce_excel_value(value)
 
-        for sheet_name, coord in dn.destinations:
+        for sheet_name, coord in destinations:
+            if sheet_name not in wb.sheetnames:
+                continue
             ws = wb[sheet_name]
             ws[coord] = coerced  # now a real number if it looked numeric
 
-    wb.save(output_path)
+    if calculate:
+        calculated = calculate_template(extracted, template_path, keep_sheets)
+        for (sheet_name, coord), value in calculated.items():
+            if sheet_name in wb.sheetnames:
+                wb[sheet_name][coord] = _calculated_value(value)
+
+    return wb
+
+
+def populate_template(extracted: dict, template_path: str, output_path, keep_sheets=None):
+    """
+    Fill the Excel template at `template_path` with `extracted` (see
+    `build_workbook`) and save it to `output_path`, which may be a file path
+    or a writable binary buffer.
+    """
+    wb = build_workbook(extracted, template_path, keep_sheets)
+    with metrics.span("workbook_save"):
+        wb.save(output_path)
@@ -2,15 +2,28 @@ from dotenv import load_dotenv, find_dotenv
 
 load_dotenv(find_dotenv())
 
-import boto3
-from botocore.exceptions import ClientError
+import bedrock_client
+import metrics
+from model_backends import get_backend
 import json
+import logging
 from typing import List, Dict, Any, Optional
+import contextvars
 import math
 import os
+import threading
+import time
+from contextlib import contextmanager
+from model_cache import get_cache, request_key
+from doc_text import document_text, preextract_enabled
+from protocol_index import context_budget, route_texts, routing_enabled
+from uploads import document_bytes, document_digest
+from concurrent.futures import ThreadPoolExecutor
 
 import ast, re
 
+logger = logging.getLogger(__name__)
+
 _FENCE_RE = re.compile(
     r"```(?:\s*python)?\s*(.*?)\s*```",
     flags=re.IGNORECASE | re.DOTALL,
@@ -46,6 +59,7 @@ def _first_braced_block(s: str) -> str:
     return s[i:]
 
 
+@metrics.timed()
 def extract_dict(response_text: str):
     """
     Parse a dict from a model reply of the form:
@@ -101,9 +115,79 @@ def extract_dict(response_text: str):
 
     
 
-session = boto3.Session(profile_name = "michael-chen", region_name = "us-east-1")
-brt = session.client("bedrock-runtime")
-model_id = 'anthropic.claude-3-5-sonnet-20240620-v1:0'
+class DictStreamParser:
+    """
+    Incremental counterpart of ``_first_braced_block``: fed the reply text
+    chunk by chunk, it reports completion as soon as the first ``{ ... }``
+    block is balanced, so the rest of the stream (usually an explanation
+    after the dict) need not be read.
+    """
+
+    def __init__(self):
+        self.parts: List[str] = []
+        self.complete = False
+        self._started = False
+        self._depth = 0
+        self._in_str = False
+        self._esc = False
+
+    @property
+    def text(self) -> str:
+        return "".join(self.parts)
+
+    def feed(self, chunk: str) -> bool:
+        self.parts.append(chunk)
+        if self.complete:
+            return True
+        for ch in chunk:
+            if not self._started:
+                if ch == "{":
+                    self._started = True
+                    self._depth = 1
+                continue
+            if self._in_str:
+                if self._esc:
+                    self._esc = False
+                elif ch == "\\":
+                    self._esc = True
+                elif ch == '"':
+                    self._in_str = False
+            elif ch == '"':
+                self._in_str = True
+            elif ch == "{":
+                self._depth += 1
+            elif ch == "}":
+                self._depth -= 1
+                if self._depth == 0:
+                    self.complete = True
+                    return True
+        return False
+
+
+# One complete ``"key": value`` entry of a dict literal, for progress reports
+# while the reply is still streaming in.
+_PAIR_RE = re.compile(
+    r"""["']?([A-Za-z_][\w/]*)["']?\s*:\s*"""
+    r"""(-?\d+(?:\.\d+)?|True|False|None|true|false|null|"[^"\n]*"|'[^'\n]*')\s*(?=[,}\n])"""
+)
+_JSON_LITERALS = {"true": True, "false": False, "null": None}
+
+
+def partial_values(text: str) -> Dict[str, Any]:
+    """The simple ``key: value`` entries already complete in a (partial) reply."""
+    start = text.find("{")
+    if start == -1:
+        return {}
+    values = {}
+    for key, raw in _PAIR_RE.findall(text, start):
+        if raw in _JSON_LITERALS:
+            values[key] = _JSON_LITERALS[raw]
+            continue
+        try:
+            values[key] = ast.literal_eval(raw)
+        except (ValueError, SyntaxError):
+            continue
+    return values
 
 
 def _is_missing(value: Any) -> bool:
@@ -137,32 +221,240 @@ def _maybe_set_total_duration(data: Dict[str, Any]) -> None:
     data["total_dur"] = max(enroll + subj, enroll, subj)
 
 
+# Service builders that start from the common study facts returned by
+# ``get_provided_data``. When several of them are selected together the
+# facts are extracted once and handed to each builder.
+PROVIDED_DATA_STEPS = ("data_management", "biostats", "project_management", "conform")
+
+
+def needs_provided_data(steps) -> bool:
+    """Return True when any selected step is built on ``get_provided_data``."""
+    return any(step in PROVIDED_DATA_STEPS for step in steps)
+
+
+# Upper bound on independent model prompts in flight for a single proposal.
+EXTRACTION_CONCURRENCY = int(os.environ.get("EXTRACTION_CONCURRENCY", "3"))
+
+
+def run_concurrently(calls: Dict[str, Any], max_workers: Optional[int] = None) -> Dict[str, Any]:
+    """
+    Run independent extraction calls on a thread pool.
+
+    ``calls`` maps a name to ``(function, *args)``. Returns a dict with the same
+    names mapped to each function's result. Every call is allowed to finish
+    before the first failure (in ``calls`` order) is re-raised, so no prompt
+    is left running in the background.
+    """
+    if not calls:
+        return {}
+
+    limit = max_workers or EXTRACTION_CONCURRENCY
+    workers = max(1, min(limit, len(calls)))
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        futures = {
+            # Each call runs in a copy of the caller's context so a progress
+            # hook installed by the caller also sees the worker threads.
+            name: pool.submit(contextvars.copy_context().run, fn, *args)
+            for name, (fn, *args) in calls.items()
+        }
+    return {name: future.result() for name, future in futures.items()}
+
+
+def _resolve_provided_data(documents, provided_data: Optional[Dict[str, Any]] = None) -> Dict[str, Any]:
+    """
+    Return a private copy of the shared provided-data dict, extracting it from
+    ``documents`` only when the caller did not supply one. Builders mutate the
+    result, so the shared dict is never handed out directly.
+    """
+    if provided_data is None:
+        return get_provided_data(documents)
+    return dict(provided_data)
+
 
-def _build_conversation(prompt: str, documents: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+def _document_blocks(documents: List[Dict[str, Any]], route: Optional[str] = None) -> List[Dict[str, Any]]:
+    """
+    Content blocks for the documents: locally extracted text when that is
+    enabled and succeeds, otherwise the raw file as a document block. With a
+    ``route`` (see protocol_index.ROUTES) the text documents are narrowed to
+    the sections relevant to that prompt.
+    """
+    texts = [document_text(doc) if preextract_enabled() else None for doc in documents]
+
+    text_positions = [i for i, text in enumerate(texts) if text]
+    if route and routing_enabled() and text_positions:
+        routed = route_texts(route, [texts[i] for i in text_positions])
+        if routed is not None:
+            for i, text in zip(text_positions, routed):
+                texts[i] = text
+
+    blocks = []
+    for doc, text in zip(documents, texts):
+        if text:
+            blocks.append({"text": f'<document name="{doc["name"]}">\n{text}\n</document>'})
+        else:
+            blocks.append({
+                "document": {
+                    "format": doc["format"],
+                    "name":   doc["name"],
+                    "source": {"bytes": document_bytes(doc)}
+                }
+            })
+    return blocks
+
+
+def _build_conversation(prompt: str, documents: List[Dict[str, Any]], route: Optional[str] = None) -> List[Dict[str, Any]]:
     """
     documents: [
-      {"file_bytes": b"...", "format": "pdf", "name": "MyProtocol"},
+      {"upload": Upload, "format": "pdf", "name": "MyProtocol"},
       {"file_bytes": b"...", "format": "docx","name": "Supplement"}
       ...
     ]
     """
-    docs_payload = []
-    for doc in documents:
-        docs_payload.append({
-            "document": {
-                "format": doc["format"],
-                "name":   doc["name"],
-                "source": {"bytes": doc["file_bytes"]}
-            }
-        })
+    docs_payload = _document_blocks(documents, route)
     return [{
         "role": "user",
         "content": [{"text": prompt}, *docs_payload]
     }]
 
 
-def get_provided_data(documents):
-    prompt = """You are an expert in the clinical data management industry, trained to extract study information from provided documents.
+# Stream replies with converse_stream and stop reading once the dict is
+# complete (MODEL_STREAMING=0 waits for the whole reply with converse).
+MODEL_STREAMING = os.environ.get("MODEL_STREAMING", "1").strip().lower() not in {"0", "false", "no", "off"}
+
+_progress_hook = contextvars.ContextVar("model_progress_hook", default=None)
+
+
+@contextmanager
+def progress_hook(hook):
+    """
+    Report model-call progress to ``hook(route, state, chars, values)`` for
+    calls made inside the block (including those fanned out by
+    ``run_concurrently``). ``state`` is "started", "streaming", "restarted"
+    (a stream broke off and is retried), "cached" or "done"; ``chars`` is the
+    length of the reply received so far and ``values`` the entries of its
+    dict parsed so far (see ``partial_values``).
+    """
+    token = _progress_hook.set(hook)
+    try:
+        yield
+    finally:
+        _progress_hook.reset(token)
+
+
+def _report(route: Optional[str], state: str, text: str = "") -> None:
+    hook = _progress_hook.get()
+    if hook is None:
+        return
+    try:
+        hook(route or "model", state, len(text), partial_values(text))
+    except Exception:
+        # Progress is best effort; never fail an extraction over it.
+        pass
+
+
+def _converse_streaming(backend, conversation, config: Dict[str, Any], route: Optional[str], usage) -> str:
+    parser = DictStreamParser()
+    last_report = 0.0
+    chunks = backend.stream(conversation, config, usage)
+    try:
+        for delta in chunks:
+            if parser.feed(delta):
+                break
+            now = time.monotonic()
+            if now - last_report >= 0.5:
+                last_report = now
+                _report(route, "streaming", parser.text)
+    except Exception as e:
+        if parser.text and bedrock_client.is_retryable(e):
+            # bedrock_client.call starts the reply over; drop the partial
+            # reply already shown as progress.
+            _report(route, "restarted")
+        raise
+    finally:
+        chunks.close()
+    return parser.text
+
+
+def _converse(backend, conversation, config: Dict[str, Any], route: Optional[str], usage) -> str:
+    with _model_slots:
+        if MODEL_STREAMING:
+            return _converse_streaming(backend, conversation, config, route, usage)
+        return backend.converse(conversation, config, usage)
+
+
+def _payload_mode(route: Optional[str]) -> str:
+    """How documents are sent for ``route``; part of the response-cache key."""
+    if not preextract_enabled():
+        return "bytes"
+    if route and routing_enabled():
+        return f"text:{route}:{context_budget()}"
+    return "text"
+
+
+INFERENCE_CONFIG = {"maxTokens": 1000, "temperature": 0.3}
+
+# Process-wide cap on model requests in flight. Each proposal fans out up to
+# EXTRACTION_CONCURRENCY prompts; this bounds the total when several
+# proposals run at once (gunicorn threads, the batch runner's worker pool).
+MODEL_MAX_IN_FLIGHT = int(os.environ.get("MODEL_MAX_IN_FLIGHT", "8"))
+_model_slots = threading.BoundedSemaphore(MODEL_MAX_IN_FLIGHT)
+
+
+def _invoke_model(
+    prompt: str,
+    documents: List[Dict[str, Any]],
+    inference_config: Optional[Dict[str, Any]] = None,
+    route: Optional[str] = None,
+) -> str:
+    """
+    Send ``prompt`` together with ``documents`` (narrowed to the sections
+    relevant to ``route``) to the model and return the reply text. The reply
+    is streamed and cut off once its dict is complete, unless
+    MODEL_STREAMING=0. Replies are looked up in the persistent response cache
+    first, keyed by the document bytes, prompt, model id, inference settings
+    and payload mode; a fresh reply is only cached once it parses into a dict.
+    """
+    config = inference_config or INFERENCE_CONFIG
+    backend = get_backend()
+    label = route or "model"
+    cache = get_cache()
+    key = None
+    if cache is not None:
+        key = request_key(documents, prompt, backend.model_id, config, _payload_mode(route))
+        cached = cache.get(key)
+        if cached is not None:
+            metrics.inc("model_calls_total", route=label, outcome="cached")
+            _report(route, "cached", cached)
+            return cached
+
+    with metrics.span("build_conversation"):
+        conversation = _build_conversation(prompt, documents, route)
+    _report(route, "started")
+    usage: Dict[str, int] = {}
+    try:
+        with metrics.span(f"model.{label}"):
+            # Throttled requests are retried with backoff instead of failing the proposal.
+            response_text = bedrock_client.call(_converse, backend, conversation, config, route, usage)
+    except Exception as e:
+        metrics.inc("model_calls_total", route=label, outcome="error")
+        raise RuntimeError(f"Failed to invoke model: {e}")
+    metrics.inc("model_calls_total", route=label, outcome="ok")
+    metrics.inc("model_tokens_total", usage.get("inputTokens", 0), route=label, direction="input")
+    metrics.inc("model_tokens_total", usage.get("outputTokens", 0), route=label, direction="output")
+    metrics.inc("model_output_chars_total", len(response_text), route=label)
+    _report(route, "done", response_text)
+
+    if cache is not None:
+        try:
+            parsed = extract_dict(response_text)
+        except Exception:
+            parsed = None
+        if isinstance(parsed, dict):
+            cache.set(key, response_text)
+    return response_text
+
+
+PROVIDED_PROMPT = """You are an expert in the clinical data management industry, trained to extract study information from provided documents.
 You will receive a study protocol along with other supporting document(s), and a list of variables with brief descriptions that you need to extract from the documents.
 Below are the variables to extract:
 
@@ -181,26 +473,9 @@ to_extract = {
 
 Output the extracted quantities in the format of a Python dictionary with keys written exactly as above. If a quantity cannot be found, write its value as -1. Make sure you enter an integer only for each entry.
 It is imperative that the durations are in months. Make sure to convert them to months."""
-    conversation = _build_conversation(prompt, documents)
-    client = brt
-    mid = model_id
-
-    try:
-        response = client.converse(
-            modelId=mid,
-            messages=conversation,
-            inferenceConfig={"maxTokens": 1000, "temperature": 0.3},
-        )
-        response_text = response["output"]["message"]["content"][0]["text"]
-    except (ClientError, Exception) as e:
-        raise RuntimeError(f"Failed to invoke model: {e}")
-
-    data = extract_dict(response_text)
-    return data
 
 
-def get_assumed_data(documents: List[Dict[str, Any]]) -> dict:
-    prompt = """You are an expert in the clinical data management industry, trained to read provided documents to accurately predict study-related variables.
+ASSUMED_PROMPT = """You are an expert in the clinical data management industry, trained to read provided documents to accurately predict study-related variables.
 You will receive a study protocol along with other supporting document(s), and a list of variables with brief descriptions that you need to predict from the documents.
 Below are the variables to predict:
 
@@ -243,22 +518,162 @@ For Phase 3 study, 120-200 tlfs (35 unique tables 50 repeat tables 40 unique lis
 
 
 """
-    conversation = _build_conversation(prompt, documents)
-    client = brt
-    mid = model_id
 
-    try:
-        response = client.converse(
-            modelId=mid,
-            messages=conversation,
-            inferenceConfig={"maxTokens": 1000, "temperature": 0.3},
+
+DMC_PROMPT = """You are an expert in the clinical data management industry, trained to extract study information related to the DMC (data monitoring committee) from provided documents. Below are the variable(s) to extract:
+
+    to_extract = {
+        num_dmc_meet: specified number of meetings for the DMC (data monitoring committee),
+        dmc_meet_freq: frequency of DMC meetings in terms of months (i.e. every 3 months)
+
+    }
+
+    Output the extracted quantities in the format of a Python dictionary with keys written exactly as above. If a quantity cannot be found, write its value as -1. Make sure you enter an integer only for each entry.
+    It is imperative that the durations are in months. Make sure to convert them to months."""
+
+
+REFRESH_PROMPT = """You are an expert in the clinical data management industry, trained to extract certain study-related information from provided documents. Below are the variable(s) to extract:
+
+    to_extract = {
+        sdtm_fr: specified number of full refreshes for SDTM datasets,
+        adam_fr: specified number of full refreshes for ADaM datasets,
+        tlf_final_fr: specified number of full refreshes for TLFs
+        
+
+    }
+
+    Output the extracted quantities in the format of a Python dictionary with keys written exactly as above. If a quantity cannot be found, write its value as -1. Make sure you enter an integer only for each entry.
+    It is imperative that the durations are in months. Make sure to convert them to months."""
+
+
+WORK_ORDER_PROMPT = """You are an expert in the clinical data management industry, trained to extract study information from provided documents.
+You will receive a study protocol along with other supporting document(s), and a list of variables with brief descriptions that you need to extract from the documents.
+Below are the variables to extract:
+
+to_extract = {
+    study_number: The name/number of the study which the protocol references,
+    sponsor: The name of the company that is sponsoring this study,
+
+}
+
+Output the extracted quantities in the format of a Python dictionary with keys written exactly as above."""
+
+
+# Merged mode: the variables of several prompts are requested in one call
+# and the reply is split back per prompt. Each part's variables are read
+# from the to_extract block of its own prompt above.
+MERGED_PARTS = {
+    "provided": PROVIDED_PROMPT,
+    "assumed": ASSUMED_PROMPT,
+    "work_order": WORK_ORDER_PROMPT,
+    "refresh": REFRESH_PROMPT,
+    "dmc": DMC_PROMPT,
+}
+
+_ASSUMED_GUIDELINES = ASSUMED_PROMPT.split("general guidelines:", 1)[1].strip()
+
+MERGED_PROMPT = """You are an expert in the clinical data management industry, trained to extract study information from provided documents and to predict study-related variables from them.
+You will receive a study protocol along with other supporting document(s), and a list of variables with brief descriptions. Variables described as specified must be extracted from the documents; variables described as predicted or estimated must be predicted from them.
+Below are the variables:
+
+to_extract = {
+%s
+}
+
+Output all the quantities in one Python dictionary with keys written exactly as above. If a specified quantity cannot be found, write its value as -1. Make sure you enter an integer only for each numeric entry.
+It is imperative that the durations are in months. Make sure to convert them to months."""
+
+_SCHEMA_RE = re.compile(r"to_extract = \{\n(.*?)\n\s*\}", re.DOTALL)
+_VARIABLE_RE = re.compile(r"^\s*([\w/]+):\s*(.*?),?\s*$")
+
+
+def merged_extraction_enabled() -> bool:
+    """``EXTRACTION_MODE=merged`` sends one combined prompt instead of one per service."""
+    return os.environ.get("EXTRACTION_MODE", "multi").strip().lower() == "merged"
+
+
+def _prompt_variables(prompt: str) -> List[tuple]:
+    """(key, description) pairs from the to_extract block of ``prompt``."""
+    block = _SCHEMA_RE.search(prompt).group(1)
+    return [m.groups() for m in map(_VARIABLE_RE.match, block.splitlines()) if m]
+
+
+def _merged_description(part: str, description: str) -> str:
+    # Every assumed variable is estimated, including the TLF counts the
+    # assumed prompt words as "specified"; in the merged preamble that word
+    # would ask for -1 when the protocol does not state them.
+    if part == "assumed" and description.startswith("specified "):
+        return "predicted " + description[len("specified "):]
+    return description
+
+
+def build_merged_prompt(parts: List[str]) -> str:
+    lines = [
+        f"    {key}: {_merged_description(part, description)}"
+        for part in parts
+        for key, description in _prompt_variables(MERGED_PARTS[part])
+    ]
+    prompt = MERGED_PROMPT % ",\n".join(lines)
+    if "assumed" in parts:
+        prompt += (
+            "\n\nThe predicted quantities should be estimated using the following "
+            "non-comprehensive general guidelines:\n\n" + _ASSUMED_GUIDELINES
         )
-        response_text = response["output"]["message"]["content"][0]["text"]
-    except (ClientError, Exception) as e:
-        raise RuntimeError(f"Failed to invoke model: {e}")
+    return prompt
+
+
+@metrics.timed()
+def get_merged_data(documents: List[Dict[str, Any]], parts: List[str]) -> Dict[str, Dict[str, Any]]:
+    """
+    Extract the variables of every prompt in ``parts`` (keys of MERGED_PARTS)
+    with a single model call and return one dict per part, shaped like the
+    output of the per-prompt functions (assumed TLF counts remapped to
+    ``tlf_final_*``).
+    """
+    prompt = build_merged_prompt(parts)
+    response_text = _invoke_model(prompt, documents, route="+".join(parts))
+    merged = extract_dict(response_text)
+
+    results = {}
+    for part in parts:
+        keys = [key for key, _ in _prompt_variables(MERGED_PARTS[part])]
+        results[part] = {key: merged[key] for key in keys if key in merged}
+    if "assumed" in results:
+        results["assumed"] = _remap_assumed(results["assumed"])
+    return results
+
+
+def unique_documents(documents: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+    """``documents`` without repeated uploads of the same file."""
+    seen, unique = set(), []
+    for doc in documents:
+        digest = document_digest(doc)
+        if digest not in seen:
+            seen.add(digest)
+            unique.append(doc)
+    return unique
+
+
+@metrics.timed()
+def get_provided_data(documents):
+    prompt = PROVIDED_PROMPT
+    response_text = _invoke_model(prompt, documents, route="provided")
 
-    print(response_text)
     data = extract_dict(response_text)
+    return data
+
+
+@metrics.timed()
+def get_assumed_data(documents: List[Dict[str, Any]]) -> dict:
+    prompt = ASSUMED_PROMPT
+    response_text = _invoke_model(prompt, documents, route="assumed")
+
+    logger.debug("assumed data reply: %s", response_text)
+    return _remap_assumed(extract_dict(response_text))
+
+
+def _remap_assumed(data: Dict[str, Any]) -> Dict[str, Any]:
+    """The prompt asks for ``tlf_*`` counts; the budget uses ``tlf_final_*``."""
     data.update(
         tlf_final_unique_tables = data["tlf_unique_tables"],
         tlf_final_repeat_tables = data["tlf_repeat_tables"],
@@ -279,7 +694,8 @@ For Phase 3 study, 120-200 tlfs (35 unique tables 50 repeat tables 40 unique lis
 
 
 
-def get_data_biostats(documents):
+@metrics.timed()
+def get_data_biostats(documents, provided_data=None, assumed_data=None):
     #Returns dictionary of data needed to calculate price
     data = {
         "dmc/ia": False,
@@ -340,9 +756,8 @@ def get_data_biostats(documents):
         "patient_profile": 25, #assumed
         "num_meetings": 50, #assumed
         }
-    print(6)
-    data1 = get_provided_data(documents)
-    data2 = get_assumed_data(documents)
+    data1 = _resolve_provided_data(documents, provided_data)
+    data2 = get_assumed_data(documents) if assumed_data is None else dict(assumed_data)
     
     data.update(data1)
     data.update(data2)
@@ -362,7 +777,8 @@ def get_data_biostats(documents):
 
 
 
-def calculate_dmc(data, documents, use_files):
+@metrics.timed()
+def calculate_dmc(data, documents, use_files, extracted=None):
     def to_number(key):
         return _coerce_number(data.get(key, -1))
 
@@ -391,31 +807,12 @@ def calculate_dmc(data, documents, use_files):
     data["dsur_years"] = -1 if td is None else math.ceil(td / 12.0)
 
     if use_files:
-        prompt = """You are an expert in the clinical data management industry, trained to extract study information related to the DMC (data monitoring committee) from provided documents. Below are the variable(s) to extract:
-
-    to_extract = {
-        num_dmc_meet: specified number of meetings for the DMC (data monitoring committee),
-        dmc_meet_freq: frequency of DMC meetings in terms of months (i.e. every 3 months)
-
-    }
-
-    Output the extracted quantities in the format of a Python dictionary with keys written exactly as above. If a quantity cannot be found, write its value as -1. Make sure you enter an integer only for each entry.
-    It is imperative that the durations are in months. Make sure to convert them to months."""
-        client = brt
-        mid = model_id
-        conversation = _build_conversation(prompt, documents)
-
-        try:
-            response = client.converse(
-                modelId=mid,
-                messages=conversation,
-                inferenceConfig={"maxTokens": 1000, "temperature": 0.3},
-            )
-            response_text = response["output"]["message"]["content"][0]["text"]
-        except (ClientError, Exception) as e:
-            raise RuntimeError(f"Failed to invoke model: {e}")
-
-        dmc_data = extract_dict(response_text)
+        if extracted is None:
+            prompt = DMC_PROMPT
+            response_text = _invoke_model(prompt, documents, route="dmc")
+            dmc_data = extract_dict(response_text)
+        else:
+            dmc_data = extracted
         
         reported_meetings = _coerce_number(dmc_data.get("num_dmc_meet"))
         meet_freq = _coerce_number(dmc_data.get("dmc_meet_freq"))
@@ -443,36 +840,16 @@ def calculate_dmc(data, documents, use_files):
 
     return data
     
-def calculate_refresh(data, documents, use_files):
+@metrics.timed()
+def calculate_refresh(data, documents, use_files, extracted=None):
     sd = _coerce_number(data.get("subj_dur"))
     if use_files:
-        prompt = """You are an expert in the clinical data management industry, trained to extract certain study-related information from provided documents. Below are the variable(s) to extract:
-
-    to_extract = {
-        sdtm_fr: specified number of full refreshes for SDTM datasets,
-        adam_fr: specified number of full refreshes for ADaM datasets,
-        tlf_final_fr: specified number of full refreshes for TLFs
-        
-
-    }
-
-    Output the extracted quantities in the format of a Python dictionary with keys written exactly as above. If a quantity cannot be found, write its value as -1. Make sure you enter an integer only for each entry.
-    It is imperative that the durations are in months. Make sure to convert them to months."""
-        conversation = _build_conversation(prompt, documents)
-        mid = model_id
-        client = brt
-
-        try:
-            response = client.converse(
-                modelId=mid,
-                messages=conversation,
-                inferenceConfig={"maxTokens": 1000, "temperature": 0.3},
-            )
-            response_text = response["output"]["message"]["content"][0]["text"]
-        except (ClientError, Exception) as e:
-            raise RuntimeError(f"Failed to invoke model: {e}")
-
-        refresh_data = extract_dict(response_text)
+        if extracted is None:
+            prompt = REFRESH_PROMPT
+            response_text = _invoke_model(prompt, documents, route="refresh")
+            refresh_data = extract_dict(response_text)
+        else:
+            refresh_data = extracted
         
         if _is_missing(refresh_data.get("sdtm_fr")):
             sdtm_fr = -1 if sd is None else sd * 1.5
@@ -506,7 +883,8 @@ def calculate_refresh(data, documents, use_files):
 
     return data 
 
-def get_data_dm(documents):
+@metrics.timed()
+def get_data_dm(documents, provided_data=None):
     #Returns dictionary of data needed to calculate price
     data = {
         "num_countries": -1,
@@ -551,7 +929,7 @@ def get_data_dm(documents):
         "num_data_metrics_report": 15, #assumed
         }
 
-    data1 = get_provided_data(documents)
+    data1 = _resolve_provided_data(documents, provided_data)
     sf = _coerce_number(data.get("screen_failure_rate"))
     dr = _coerce_number(data.get("dropout_rate"))
     sd = _coerce_number(data1.get("subj_dur"))
@@ -572,12 +950,10 @@ def get_data_dm(documents):
     _maybe_set_total_duration(data)
 
     num_visits = _coerce_number(data.get("num_visits"))
-    print(num_visits)
     if num_visits is None:
         num_visits = 2 * sd + 2
         data["num_visits"] = num_visits
-        print("num_visits:")
-        print(num_visits)
+        logger.debug("num_visits not found, estimated as %s", num_visits)
 
 
     crf_pages_per_visit = _coerce_number(data.get("crf_pages_per_visit"))
@@ -668,7 +1044,8 @@ def get_data_dm(documents):
 
     return data
 
-def get_data_pm(documents):
+@metrics.timed()
+def get_data_pm(documents, provided_data=None):
     data = {
         "start_dur": -1,
         "enroll_dur": -1,
@@ -678,14 +1055,15 @@ def get_data_pm(documents):
         "total_dur": -1,
     }
 
-    data1 = get_provided_data(documents)
+    data1 = _resolve_provided_data(documents, provided_data)
 
     data.update(data1)
     _maybe_set_total_duration(data)
 
     return data
 
-def get_data_conform(documents):
+@metrics.timed()
+def get_data_conform(documents, provided_data=None):
     data = {
         "start_dur": -1,
         "enroll_dur": -1,
@@ -695,13 +1073,14 @@ def get_data_conform(documents):
         "total_dur": -1,
     }
 
-    data1 = get_provided_data(documents)
+    data1 = _resolve_provided_data(documents, provided_data)
 
     data.update(data1)
     _maybe_set_total_duration(data)
 
     return data
 
+@metrics.timed()
 def get_data_eclinical(documents):
     data = {
         "num_unique_crf_pages": 60,
@@ -713,34 +1092,12 @@ def get_data_eclinical(documents):
 
     return data
 
+@metrics.timed()
 def extract_wo(documents):
-    prompt = """You are an expert in the clinical data management industry, trained to extract study information from provided documents.
-You will receive a study protocol along with other supporting document(s), and a list of variables with brief descriptions that you need to extract from the documents.
-Below are the variables to extract:
-
-to_extract = {
-    study_number: The name/number of the study which the protocol references,
-    sponsor: The name of the company that is sponsoring this study,
-
-}
-
-Output the extracted quantities in the format of a Python dictionary with keys written exactly as above."""
-    conversation = _build_conversation(prompt, documents)
-    client = brt
-    mid = model_id
-    
-    try:
-        response = client.converse(
-            modelId=mid,
-            messages=conversation,
-            inferenceConfig={"maxTokens": 1000, "temperature": 0.3},
-        )
-        response_text = response["output"]["message"]["content"][0]["text"]
-    except (ClientError, Exception) as e:
-        raise RuntimeError(f"Failed to invoke model: {e}")
-    print(response_text)
+    prompt = WORK_ORDER_PROMPT
+    response_text = _invoke_model(prompt, documents, route="work_order")
+    logger.debug("work order reply: %s", response_text)
     data = extract_dict(response_text)
-    print(data)
     return data
     
 
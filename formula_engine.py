@@ -0,0 +1,728 @@
+"""
+A small evaluator for the Excel formulas used by the budget templates.
+
+openpyxl stores formulas but never calculates them, so a workbook that was
+filled in Python has no up-to-date results until Excel opens it. This module
+covers the subset the templates rely on: numbers, strings, arithmetic and
+comparison operators, cell and range references (optionally on another
+sheet), defined names, and the functions in ``FUNCTIONS``.
+
+A ``FormulaModel`` compiles a template once: every formula becomes a Python
+closure, the cell dependency graph is ordered topologically and the whole
+template is evaluated a single time as a baseline. ``evaluate`` then only
+re-computes the formula cells downstream of inputs that differ from that
+baseline.
+"""
+
+import math
+import re
+from decimal import Decimal, ROUND_DOWN, ROUND_HALF_UP, ROUND_UP
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+from openpyxl.utils.cell import column_index_from_string, get_column_letter
+
+
+CellKey = Tuple[str, str]
+
+
+class FormulaError:
+    """An Excel error value such as ``#DIV/0!``; propagates through arithmetic."""
+
+    __slots__ = ("code",)
+
+    def __init__(self, code: str):
+        self.code = code
+
+    def __eq__(self, other):
+        return isinstance(other, FormulaError) and other.code == self.code
+
+    def __hash__(self):
+        return hash(self.code)
+
+    def __repr__(self):
+        return f"FormulaError({self.code!r})"
+
+    def __str__(self):
+        return self.code
+
+
+DIV0 = FormulaError("#DIV/0!")
+VALUE = FormulaError("#VALUE!")
+REF = FormulaError("#REF!")
+NAME = FormulaError("#NAME?")
+NUM = FormulaError("#NUM!")
+CIRCULAR = FormulaError("#CIRC!")
+
+
+class FormulaSyntaxError(ValueError):
+    pass
+
+
+class RangeValue(list):
+    """The values of a rectangular range, row by row."""
+
+
+# ---------------------------------------------------------------------------
+# Tokenizer
+# ---------------------------------------------------------------------------
+
+_CELL = r"\$?[A-Za-z]{1,3}\$?\d+"
+_SHEET = r"(?:'(?:[^']|'')+'|[A-Za-z_][\w\.]*)"
+
+_TOKEN_RE = re.compile(
+    r"""
+    (?P<ws>\s+)
+  | (?P<string>"(?:[^"]|"")*")
+  | (?P<ref>(?:{sheet}!)?{cell}(?::{cell})?)(?![\w(])
+  | (?P<error>\#(?:NULL!|DIV/0!|VALUE!|REF!|NAME\?|NUM!|N/A))
+  | (?P<number>(?:\d+\.?\d*|\.\d+)(?:[eE][+-]?\d+)?)
+  | (?P<func>[A-Za-z_][\w\.]*)(?=\s*\()
+  | (?P<name>[A-Za-z_\\][\w\.]*)
+  | (?P<op><>|<=|>=|[-+*/^&=<>%(),])
+    """.format(sheet=_SHEET, cell=_CELL),
+    re.VERBOSE,
+)
+
+_ERRORS = {e.code: e for e in (DIV0, VALUE, REF, NAME, NUM, FormulaError("#N/A"), FormulaError("#NULL!"))}
+
+
+def _tokenize(text: str) -> List[Tuple[str, str]]:
+    tokens = []
+    pos = 0
+    while pos < len(text):
+        m = _TOKEN_RE.match(text, pos)
+        if m is None:
+            raise FormulaSyntaxError(f"Unexpected character {text[pos]!r} in {text!r}")
+        pos = m.end()
+        kind = m.lastgroup
+        if kind != "ws":
+            tokens.append((kind, m.group(kind)))
+    return tokens
+
+
+# ---------------------------------------------------------------------------
+# Values and coercion
+# ---------------------------------------------------------------------------
+
+def _is_error(value) -> bool:
+    return isinstance(value, FormulaError)
+
+
+def _to_number(value):
+    """Excel's coercion for arithmetic operands; returns a float or an error."""
+    if _is_error(value):
+        return value
+    if value is None:
+        return 0.0
+    if isinstance(value, bool):
+        return 1.0 if value else 0.0
+    if isinstance(value, (int, float)):
+        return float(value)
+    if isinstance(value, str):
+        text = value.strip()
+        if not text:
+            return 0.0
+        try:
+            return float(text.replace(",", ""))
+        except ValueError:
+            return VALUE
+    if isinstance(value, RangeValue):
+        return VALUE
+    return VALUE
+
+
+def _to_bool(value):
+    if _is_error(value):
+        return value
+    if value is None:
+        return False
+    if isinstance(value, bool):
+        return value
+    if isinstance(value, (int, float)):
+        return value != 0
+    if isinstance(value, str):
+        upper = value.strip().upper()
+        if upper == "TRUE":
+            return True
+        if upper == "FALSE":
+            return False
+    return VALUE
+
+
+def _to_text(value):
+    if _is_error(value):
+        return value
+    if value is None:
+        return ""
+    if isinstance(value, bool):
+        return "TRUE" if value else "FALSE"
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return str(value)
+
+
+def _numbers_in(args, include_direct_text=True):
+    """
+    Flatten function arguments the way SUM/MIN/MAX do: numbers in ranges are
+    used and text/blank/boolean range cells are skipped, while direct
+    arguments are coerced. The first error found is returned instead.
+    """
+    numbers = []
+    for arg in args:
+        if isinstance(arg, RangeValue):
+            for value in arg:
+                if _is_error(value):
+                    return value
+                if isinstance(value, (int, float)) and not isinstance(value, bool):
+                    numbers.append(float(value))
+        else:
+            if arg is None:
+                continue
+            if isinstance(arg, str) and not include_direct_text:
+                continue
+            number = _to_number(arg)
+            if _is_error(number):
+                return number
+            numbers.append(number)
+    return numbers
+
+
+# ---------------------------------------------------------------------------
+# Functions
+# ---------------------------------------------------------------------------
+
+def _fn_sum(args):
+    numbers = _numbers_in(args)
+    return numbers if _is_error(numbers) else float(sum(numbers))
+
+
+def _fn_min(args):
+    numbers = _numbers_in(args)
+    if _is_error(numbers):
+        return numbers
+    return min(numbers) if numbers else 0.0
+
+
+def _fn_max(args):
+    numbers = _numbers_in(args)
+    if _is_error(numbers):
+        return numbers
+    return max(numbers) if numbers else 0.0
+
+
+def _fn_average(args):
+    numbers = _numbers_in(args)
+    if _is_error(numbers):
+        return numbers
+    return sum(numbers) / len(numbers) if numbers else DIV0
+
+
+def _round_with(mode):
+    def _fn(args):
+        if len(args) not in (1, 2):
+            return VALUE
+        number = _to_number(args[0])
+        digits = _to_number(args[1]) if len(args) == 2 else 0.0
+        if _is_error(number):
+            return number
+        if _is_error(digits):
+            return digits
+        exponent = Decimal(1).scaleb(-int(digits))
+        rounded = Decimal(repr(abs(number))).quantize(exponent, rounding=mode)
+        return math.copysign(float(rounded), number)
+    return _fn
+
+
+def _fn_abs(args):
+    if len(args) != 1:
+        return VALUE
+    number = _to_number(args[0])
+    return number if _is_error(number) else abs(number)
+
+
+def _fn_and(args):
+    result = True
+    for arg in args:
+        values = arg if isinstance(arg, RangeValue) else [arg]
+        for value in values:
+            flag = _to_bool(value)
+            if _is_error(flag):
+                return flag
+            result = result and flag
+    return result
+
+
+def _fn_or(args):
+    result = False
+    for arg in args:
+        values = arg if isinstance(arg, RangeValue) else [arg]
+        for value in values:
+            flag = _to_bool(value)
+            if _is_error(flag):
+                return flag
+            result = result or flag
+    return result
+
+
+def _fn_not(args):
+    if len(args) != 1:
+        return VALUE
+    flag = _to_bool(args[0])
+    return flag if _is_error(flag) else not flag
+
+
+FUNCTIONS: Dict[str, Callable[[list], Any]] = {
+    "SUM": _fn_sum,
+    "MIN": _fn_min,
+    "MAX": _fn_max,
+    "AVERAGE": _fn_average,
+    "ROUND": _round_with(ROUND_HALF_UP),
+    "ROUNDUP": _round_with(ROUND_UP),
+    "ROUNDDOWN": _round_with(ROUND_DOWN),
+    "ABS": _fn_abs,
+    "AND": _fn_and,
+    "OR": _fn_or,
+    "NOT": _fn_not,
+}
+
+# IF and IFERROR only evaluate the branch they need, so they are compiled
+# specially instead of receiving already-evaluated arguments.
+_LAZY_FUNCTIONS = {"IF", "IFERROR"}
+
+
+# ---------------------------------------------------------------------------
+# Operators
+# ---------------------------------------------------------------------------
+
+def _arith(op):
+    def _apply(left, right):
+        a = _to_number(left)
+        if _is_error(a):
+            return a
+        b = _to_number(right)
+        if _is_error(b):
+            return b
+        if op == "+":
+            return a + b
+        if op == "-":
+            return a - b
+        if op == "*":
+            return a * b
+        if op == "/":
+            return DIV0 if b == 0 else a / b
+        try:
+            return float(a ** b)
+        except (OverflowError, ZeroDivisionError, ValueError):
+            return NUM
+    return _apply
+
+
+def _compare_key(value):
+    # Excel orders numbers < text < booleans; text compares case-insensitively.
+    if value is None:
+        value = 0.0
+    if isinstance(value, bool):
+        return (2, value)
+    if isinstance(value, (int, float)):
+        return (0, float(value))
+    return (1, str(value).lower())
+
+
+def _compare(op):
+    def _apply(left, right):
+        if _is_error(left):
+            return left
+        if _is_error(right):
+            return right
+        if isinstance(left, RangeValue) or isinstance(right, RangeValue):
+            return VALUE
+        if left is None and isinstance(right, str):
+            left = ""
+        if right is None and isinstance(left, str):
+            right = ""
+        a, b = _compare_key(left), _compare_key(right)
+        return {
+            "=": a == b, "<>": a != b,
+            "<": a < b, ">": a > b,
+            "<=": a <= b, ">=": a >= b,
+        }[op]
+    return _apply
+
+
+def _concat(left, right):
+    a = _to_text(left)
+    if _is_error(a):
+        return a
+    b = _to_text(right)
+    if _is_error(b):
+        return b
+    return a + b
+
+
+_BINARY = {
+    "+": _arith("+"), "-": _arith("-"), "*": _arith("*"), "/": _arith("/"), "^": _arith("^"),
+    "&": _concat,
+    "=": _compare("="), "<>": _compare("<>"), "<": _compare("<"),
+    ">": _compare(">"), "<=": _compare("<="), ">=": _compare(">="),
+}
+
+
+# ---------------------------------------------------------------------------
+# Parser / compiler
+# ---------------------------------------------------------------------------
+
+def _split_ref(ref: str, current_sheet: str):
+    if "!" in ref:
+        sheet, cells = ref.rsplit("!", 1)
+        if sheet.startswith("'"):
+            sheet = sheet[1:-1].replace("''", "'")
+    else:
+        sheet, cells = current_sheet, ref
+    cells = cells.replace("$", "").upper()
+    return sheet, cells
+
+
+def _expand_range(sheet: str, start: str, end: str) -> List[CellKey]:
+    m1 = re.match(r"([A-Z]+)(\d+)$", start)
+    m2 = re.match(r"([A-Z]+)(\d+)$", end)
+    c1, c2 = sorted((column_index_from_string(m1.group(1)), column_index_from_string(m2.group(1))))
+    r1, r2 = sorted((int(m1.group(2)), int(m2.group(2))))
+    return [
+        (sheet, f"{get_column_letter(col)}{row}")
+        for row in range(r1, r2 + 1)
+        for col in range(c1, c2 + 1)
+    ]
+
+
+class _Compiler:
+    """Recursive-descent parser that turns one formula into a closure."""
+
+    def __init__(self, text: str, sheet: str, names: Dict[str, "CompiledFormula"]):
+        self.tokens = _tokenize(text)
+        self.pos = 0
+        self.sheet = sheet
+        self.names = names
+        self.deps = set()
+
+    # -- token helpers ------------------------------------------------------
+    def _peek(self):
+        return self.tokens[self.pos] if self.pos < len(self.tokens) else (None, None)
+
+    def _take(self):
+        token = self._peek()
+        self.pos += 1
+        return token
+
+    def _expect(self, value):
+        kind, text = self._take()
+        if text != value:
+            raise FormulaSyntaxError(f"Expected {value!r}, found {text!r}")
+
+    # -- grammar --------------------------------------------------------------
+    def compile(self):
+        fn = self._comparison()
+        if self.pos != len(self.tokens):
+            raise FormulaSyntaxError(f"Unexpected token {self._peek()[1]!r}")
+        return fn
+
+    def _binary_level(self, operators, operand):
+        left = operand()
+        while self._peek()[0] == "op" and self._peek()[1] in operators:
+            op = self._take()[1]
+            right = operand()
+            apply = _BINARY[op]
+            left = (lambda l, r, f: lambda get: f(l(get), r(get)))(left, right, apply)
+        return left
+
+    def _comparison(self):
+        return self._binary_level({"=", "<>", "<", ">", "<=", ">="}, self._concat)
+
+    def _concat(self):
+        return self._binary_level({"&"}, self._additive)
+
+    def _additive(self):
+        return self._binary_level({"+", "-"}, self._multiplicative)
+
+    def _multiplicative(self):
+        return self._binary_level({"*", "/"}, self._power)
+
+    def _power(self):
+        return self._binary_level({"^"}, self._unary)
+
+    def _unary(self):
+        kind, text = self._peek()
+        if kind == "op" and text in ("-", "+"):
+            self._take()
+            operand = self._unary()
+            if text == "+":
+                return operand
+            negate = _arith("-")
+            return lambda get: negate(0.0, operand(get))
+        return self._postfix()
+
+    def _postfix(self):
+        fn = self._primary()
+        while self._peek() == ("op", "%"):
+            self._take()
+            fn = (lambda inner: lambda get: _arith("/")(inner(get), 100.0))(fn)
+        return fn
+
+    def _primary(self):
+        kind, text = self._take()
+        if kind == "number":
+            value = float(text)
+            return lambda get: value
+        if kind == "string":
+            value = text[1:-1].replace('""', '"')
+            return lambda get: value
+        if kind == "error":
+            value = _ERRORS.get(text, FormulaError(text))
+            return lambda get: value
+        if kind == "ref":
+            return self._reference(text)
+        if kind == "func":
+            return self._function(text.upper())
+        if kind == "name":
+            return self._name(text)
+        if (kind, text) == ("op", "("):
+            fn = self._comparison()
+            self._expect(")")
+            return fn
+        raise FormulaSyntaxError(f"Unexpected token {text!r}")
+
+    def _reference(self, text):
+        sheet, cells = _split_ref(text, self.sheet)
+        if ":" in cells:
+            start, end = cells.split(":")
+            keys = _expand_range(sheet, start, end)
+            self.deps.update(keys)
+            return lambda get: RangeValue(get(key) for key in keys)
+        key = (sheet, cells)
+        self.deps.add(key)
+        return lambda get: get(key)
+
+    def _name(self, text):
+        upper = text.upper()
+        if upper in ("TRUE", "FALSE"):
+            value = upper == "TRUE"
+            return lambda get: value
+        target = self.names.get(text) or self.names.get(upper)
+        if target is None:
+            return lambda get: NAME
+        self.deps.update(target.deps)
+        return target.fn
+
+    def _arguments(self):
+        self._expect("(")
+        args = []
+        if self._peek() == ("op", ")"):
+            self._take()
+            return args
+        while True:
+            if self._peek() in (("op", ","), ("op", ")")):
+                args.append(lambda get: None)  # omitted argument
+            else:
+                args.append(self._comparison())
+            kind, text = self._take()
+            if text == ")":
+                return args
+            if text != ",":
+                raise FormulaSyntaxError(f"Expected ',' or ')', found {text!r}")
+
+    def _function(self, name):
+        args = self._arguments()
+        if name == "IF":
+            if len(args) not in (2, 3):
+                return lambda get: VALUE
+            condition, when_true = args[0], args[1]
+            when_false = args[2] if len(args) == 3 else (lambda get: False)
+
+            def _if(get):
+                flag = _to_bool(condition(get))
+                if _is_error(flag):
+                    return flag
+                return when_true(get) if flag else when_false(get)
+            return _if
+        if name == "IFERROR":
+            if len(args) != 2:
+                return lambda get: VALUE
+            value_fn, fallback = args
+
+            def _iferror(get):
+                value = value_fn(get)
+                return fallback(get) if _is_error(value) else value
+            return _iferror
+
+        fn = FUNCTIONS.get(name)
+        if fn is None:
+            return lambda get: NAME
+
+        def _call(get):
+            values = [arg(get) for arg in args]
+            for value in values:
+                if _is_error(value):
+                    return value
+            return fn(values)
+        return _call
+
+
+class CompiledFormula:
+    __slots__ = ("fn", "deps", "text")
+
+    def __init__(self, fn, deps, text):
+        self.fn = fn
+        self.deps = frozenset(deps)
+        self.text = text
+
+
+def compile_formula(text: str, sheet: str, names: Optional[Dict[str, CompiledFormula]] = None) -> CompiledFormula:
+    """Compile ``text`` (with or without the leading ``=``) evaluated on ``sheet``."""
+    body = text[1:] if text.startswith("=") else text
+    compiler = _Compiler(body, sheet, names or {})
+    try:
+        fn = compiler.compile()
+    except FormulaSyntaxError:
+        return CompiledFormula(lambda get: NAME, (), text)
+    return CompiledFormula(fn, compiler.deps, text)
+
+
+def _blank_as_zero(compiled: CompiledFormula) -> CompiledFormula:
+    """
+    A cell formula whose result is an empty cell (``=crf_pages_complete``
+    with the input left blank) shows 0 in Excel, not a blank.
+    """
+    inner = compiled.fn
+
+    def fn(get):
+        value = inner(get)
+        return 0.0 if value is None else value
+
+    return CompiledFormula(fn, compiled.deps, compiled.text)
+
+
+# ---------------------------------------------------------------------------
+# Workbook model
+# ---------------------------------------------------------------------------
+
+class FormulaModel:
+    """
+    Compiled formulas and dependency graph of one workbook.
+
+    ``evaluate(inputs)`` takes ``{(sheet, coordinate): value}`` overrides (the
+    cells populate_template writes) and returns the value of every formula
+    cell. Only cells downstream of an input that differs from the template's
+    own value are recomputed; everything else comes from the baseline.
+    """
+
+    def __init__(self, workbook):
+        self.constants: Dict[CellKey, Any] = {}
+        self.formulas: Dict[CellKey, CompiledFormula] = {}
+
+        names: Dict[str, CompiledFormula] = {}
+        for name, defined_name in workbook.defined_names.items():
+            compiled = compile_formula(defined_name.attr_text or "#REF!", "", {})
+            names[name] = compiled
+            names.setdefault(name.upper(), compiled)
+
+        for ws in workbook.worksheets:
+            for row in ws.iter_rows():
+                for cell in row:
+                    value = cell.value
+                    if value is None:
+                        continue
+                    key = (ws.title, cell.coordinate)
+                    if isinstance(value, str) and value.startswith("=") and len(value) > 1:
+                        self.formulas[key] = _blank_as_zero(compile_formula(value, ws.title, names))
+                    elif isinstance(value, str) or isinstance(value, (int, float, bool)):
+                        self.constants[key] = value
+                    else:
+                        self.constants[key] = str(value)
+
+        self.dependents: Dict[CellKey, set] = {}
+        for key, formula in self.formulas.items():
+            for dep in formula.deps:
+                self.dependents.setdefault(dep, set()).add(key)
+
+        self.order, self.cyclic = self._topological_order()
+        self.position = {key: index for index, key in enumerate(self.order)}
+        self.baseline = self._evaluate_cells(self.order, {}, {})
+
+    def _topological_order(self):
+        pending = {
+            key: sum(1 for dep in formula.deps if dep in self.formulas)
+            for key, formula in self.formulas.items()
+        }
+        ready = sorted(key for key, count in pending.items() if count == 0)
+        order = []
+        while ready:
+            key = ready.pop()
+            order.append(key)
+            for dependent in self.dependents.get(key, ()):
+                pending[dependent] -= 1
+                if pending[dependent] == 0:
+                    ready.append(dependent)
+        cyclic = {key for key, count in pending.items() if count > 0}
+        return order, cyclic
+
+    def _evaluate_cells(self, cells, inputs, base, dropped=frozenset()):
+        values: Dict[CellKey, Any] = {}
+
+        def get(key):
+            if key[0] in dropped:
+                return REF
+            if key in inputs:
+                return inputs[key]
+            if key in values:
+                return values[key]
+            if key in base:
+                return base[key]
+            if key in self.cyclic:
+                return CIRCULAR
+            return self.constants.get(key)
+
+        for key in cells:
+            if key in inputs:
+                continue
+            values[key] = self.formulas[key].fn(get)
+        for key in self.cyclic:
+            values.setdefault(key, CIRCULAR)
+        return values
+
+    def affected_by(self, changed) -> List[CellKey]:
+        """Formula cells downstream of ``changed``, in evaluation order."""
+        seen = set()
+        stack = list(changed)
+        while stack:
+            key = stack.pop()
+            for dependent in self.dependents.get(key, ()):
+                if dependent not in seen:
+                    seen.add(dependent)
+                    stack.append(dependent)
+        return sorted(
+            (key for key in seen if key in self.position),
+            key=self.position.__getitem__,
+        )
+
+    def evaluate(self, inputs: Dict[CellKey, Any], keep_sheets=None) -> Dict[CellKey, Any]:
+        """
+        With ``keep_sheets``, every other sheet is treated as deleted: its
+        cells are left out of the result and references to them evaluate to
+        #REF!, so IFERROR fallbacks apply as they would in Excel.
+        """
+        dropped = frozenset()
+        if keep_sheets is not None:
+            dropped = frozenset(sheet for sheet, _ in self.dependents if sheet not in keep_sheets)
+        changed = [
+            key for key, value in inputs.items()
+            if key in self.formulas or self.constants.get(key) != value
+        ]
+        changed.extend(key for key in self.dependents if key[0] in dropped)
+        results = dict(self.baseline)
+        if changed:
+            cells = [key for key in self.affected_by(changed) if key[0] not in dropped]
+            results.update(self._evaluate_cells(cells, inputs, self.baseline, dropped))
+        for key in inputs:
+            results.pop(key, None)
+        if dropped:
+            results = {key: value for key, value in results.items() if key[0] not in dropped}
+        return results
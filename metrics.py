@@ -0,0 +1,216 @@
+import contextvars
+import functools
+import logging
+import os
+import threading
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+from typing import Dict, List, Optional, Tuple
+
+
+logger = logging.getLogger(__name__)
+
+# Upper bounds (seconds) of the duration histogram buckets.
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0, 300.0)
+
+STAGE_METRIC = "proposal_stage_seconds"
+QUEUE_WAIT_METRIC = "job_queue_wait_seconds"
+
+HELP = {
+    STAGE_METRIC: ("histogram", "Wall time of each pipeline stage."),
+    QUEUE_WAIT_METRIC: ("histogram", "Time jobs spent queued before a worker started them, by queue."),
+    "model_calls_total": ("counter", "Model requests by route and outcome (ok, cached, error)."),
+    "model_tokens_total": ("counter", "Model tokens reported by the API, by route and direction."),
+    "model_output_chars_total": ("counter", "Reply characters read from the model, by route."),
+}
+
+
+def _labels(labels: Dict[str, str]) -> str:
+    return ",".join(f'{key}="{value}"' for key, value in sorted(labels.items()))
+
+
+class LocalMetricsStore:
+    """Counters kept in this process only."""
+
+    def __init__(self):
+        self._values: Dict[str, float] = defaultdict(float)
+        self._lock = threading.Lock()
+
+    def add(self, increments: Dict[str, float]) -> None:
+        with self._lock:
+            for field, value in increments.items():
+                self._values[field] += value
+
+    def snapshot(self) -> Dict[str, float]:
+        with self._lock:
+            return dict(self._values)
+
+
+class RedisMetricsStore(LocalMetricsStore):
+    """
+    Counters in one Redis hash, so /metrics on the web app also shows the
+    spans recorded by RQ workers. Falls back to this process's counters for
+    ``fallback_seconds`` whenever Redis cannot be reached.
+    """
+
+    def __init__(self, redis_conn, key: str = "metrics", fallback_seconds: float = 30.0):
+        super().__init__()
+        self.redis = redis_conn
+        self.key = key
+        self.fallback_seconds = fallback_seconds
+        self._local_until = 0.0
+
+    def add(self, increments: Dict[str, float]) -> None:
+        if time.monotonic() >= self._local_until:
+            try:
+                pipe = self.redis.pipeline(transaction=False)
+                for field, value in increments.items():
+                    pipe.hincrbyfloat(self.key, field, value)
+                pipe.execute()
+                return
+            except Exception as e:
+                logger.warning("Redis metrics unavailable, counting locally: %s", e)
+                self._local_until = time.monotonic() + self.fallback_seconds
+        super().add(increments)
+
+    def snapshot(self) -> Dict[str, float]:
+        values = super().snapshot()
+        try:
+            for field, value in self.redis.hgetall(self.key).items():
+                field = field.decode("utf-8")
+                values[field] = values.get(field, 0.0) + float(value)
+        except Exception as e:
+            logger.warning("Redis metrics unavailable: %s", e)
+        return values
+
+
+_store = None
+_store_lock = threading.Lock()
+
+
+def get_store() -> LocalMetricsStore:
+    """Metrics store chosen by ``METRICS_BACKEND``: ``redis`` (default) or ``local``."""
+    global _store
+    with _store_lock:
+        if _store is None:
+            backend = os.environ.get("METRICS_BACKEND", "redis").strip().lower()
+            if backend == "redis":
+                from redis import Redis
+
+                _store = RedisMetricsStore(Redis.from_url(
+                    os.environ.get("REDIS_URL", "redis://localhost:6379"),
+                    socket_timeout=2,
+                    socket_connect_timeout=2,
+                ))
+            else:
+                _store = LocalMetricsStore()
+        return _store
+
+
+def enabled() -> bool:
+    return os.environ.get("METRICS_ENABLED", "1").strip().lower() not in {"0", "false", "no", "off"}
+
+
+def inc(name: str, value: float = 1, **labels) -> None:
+    if enabled() and value:
+        get_store().add({f"{name}|{_labels(labels)}|": value})
+
+
+def observe(name: str, seconds: float, **labels) -> None:
+    """Add one observation to the histogram ``name``."""
+    if not enabled():
+        return
+    labelled = _labels(labels)
+    increments = {f"{name}|{labelled}|sum": seconds, f"{name}|{labelled}|count": 1}
+    for bound in BUCKETS:
+        if seconds <= bound:
+            increments[f"{name}|{labelled}|le={bound}"] = 1
+    get_store().add(increments)
+
+
+# Stage timings of the current web request, for the Server-Timing header.
+_request_timings: contextvars.ContextVar = contextvars.ContextVar("request_timings", default=None)
+
+
+def start_request() -> None:
+    _request_timings.set([])
+
+
+def request_timings() -> List[Tuple[str, float]]:
+    return list(_request_timings.get() or [])
+
+
+@contextmanager
+def span(stage: str):
+    """Time the block as pipeline stage ``stage``."""
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - started
+        observe(STAGE_METRIC, elapsed, stage=stage)
+        timings = _request_timings.get()
+        if timings is not None:
+            timings.append((stage, elapsed))
+
+
+def timed(stage: Optional[str] = None):
+    """Decorator form of ``span``; the stage defaults to the function name."""
+    def decorator(fn):
+        name = stage or fn.__name__
+
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            with span(name):
+                return fn(*args, **kwargs)
+
+        return wrapper
+
+    return decorator
+
+
+def server_timing_header(total: Optional[float] = None) -> str:
+    """Server-Timing value: the summed duration of each stage in this request."""
+    totals: Dict[str, float] = {}
+    for stage, elapsed in request_timings():
+        totals[stage] = totals.get(stage, 0.0) + elapsed
+    parts = [f"{stage};dur={elapsed * 1000:.1f}" for stage, elapsed in totals.items()]
+    if total is not None:
+        parts.append(f"total;dur={total * 1000:.1f}")
+    return ", ".join(parts)
+
+
+def render_prometheus() -> str:
+    """All metrics in the Prometheus text exposition format."""
+    grouped: Dict[str, Dict[str, Dict[str, float]]] = defaultdict(lambda: defaultdict(dict))
+    for field, value in get_store().snapshot().items():
+        name, labelled, suffix = field.split("|", 2)
+        grouped[name][labelled][suffix] = value
+
+    lines = []
+    for name in sorted(grouped):
+        kind, help_text = HELP.get(name, ("untyped", name))
+        lines.append(f"# HELP {name} {help_text}")
+        lines.append(f"# TYPE {name} {kind}")
+        for labelled, values in sorted(grouped[name].items()):
+            if kind == "histogram":
+                prefix = f"{labelled}," if labelled else ""
+                for bound in BUCKETS:
+                    count = values.get(f"le={bound}", 0)
+                    lines.append(f'{name}_bucket{{{prefix}le="{bound}"}} {count:g}')
+                count = values.get("count", 0)
+                lines.append(f'{name}_bucket{{{prefix}le="+Inf"}} {count:g}')
+                lines.append(f"{name}_sum{{{labelled}}} {values.get('sum', 0):.6f}")
+                lines.append(f"{name}_count{{{labelled}}} {count:g}")
+            else:
+                lines.append(f"{name}{{{labelled}}} {values.get('', 0):g}")
+    return "\n".join(lines) + "\n"
+
+
+def render_gauge(name: str, help_text: str, samples: List[Tuple[Dict[str, str], float]]) -> str:
+    """A gauge read at scrape time (not kept in the store), in the Prometheus text format."""
+    lines = [f"# HELP {name} {help_text}", f"# TYPE {name} gauge"]
+    for labels, value in samples:
+        lines.append(f"{name}{{{_labels(labels)}}} {value:g}")
+    return "\n".join(lines) + "\n"
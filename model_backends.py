@@ -0,0 +1,243 @@
+import hashlib
+import json
+import os
+import random
+import re
+import threading
+import time
+from typing import Any, Dict, Iterator, List, Optional
+
+import bedrock_client
+
+
+DEFAULT_MODEL_ID = "anthropic.claude-3-5-sonnet-20240620-v1:0"
+
+
+class BedrockBackend:
+    """Amazon Bedrock through the shared bedrock-runtime client."""
+
+    name = "bedrock"
+
+    def __init__(self, model_id: str = DEFAULT_MODEL_ID):
+        self.model_id = model_id
+
+    def converse(self, messages: List[Dict[str, Any]], inference_config: Dict[str, Any],
+                 usage: Optional[Dict[str, int]] = None) -> str:
+        """Return the reply text; token counts are copied into ``usage`` if given."""
+        response = bedrock_client.get_client().converse(
+            modelId=self.model_id,
+            messages=messages,
+            inferenceConfig=inference_config,
+        )
+        if usage is not None:
+            usage.update(response.get("usage", {}))
+        return response["output"]["message"]["content"][0]["text"]
+
+    def stream(self, messages: List[Dict[str, Any]], inference_config: Dict[str, Any],
+               usage: Optional[Dict[str, int]] = None) -> Iterator[str]:
+        """
+        Yield the reply text as it arrives; closing the generator stops
+        reading. Token counts only arrive after the last chunk, so ``usage``
+        stays empty for replies that were cut off early.
+        """
+        response = bedrock_client.get_client().converse_stream(
+            modelId=self.model_id,
+            messages=messages,
+            inferenceConfig=inference_config,
+        )
+        stream = response["stream"]
+        try:
+            for event in stream:
+                delta = event.get("contentBlockDelta", {}).get("delta", {}).get("text")
+                if delta:
+                    yield delta
+                elif "metadata" in event and usage is not None:
+                    usage.update(event["metadata"].get("usage", {}))
+        finally:
+            # Closing early drops the unread tail of the reply.
+            stream.close()
+
+
+_SCHEMA_RE = re.compile(r"to_extract = \{\n(.*?)\n\s*\}", re.DOTALL)
+_KEY_RE = re.compile(r"^\s*([\w/]+):", re.MULTILINE)
+
+# Plausible ranges for the variables the prompts ask for; anything else
+# falls back to DEFAULT_RANGE.
+STUB_RANGES = {
+    "num_countries": (1, 10),
+    "num_sites": (5, 80),
+    "num_subj": (20, 400),
+    "enroll_dur": (3, 24),
+    "subj_dur": (6, 36),
+    "total_dur": (12, 60),
+    "num_visits": (4, 20),
+    "avg_unscheduled_visits": (0, 3),
+    "sdtm_sd": (18, 30),
+    "adam_simp": (6, 12),
+    "adam_compl": (4, 8),
+    "stat_support_requests": (20, 200),
+    "prog_support_requests": (20, 200),
+    "tlf_unique_tables": (16, 40),
+    "tlf_repeat_tables": (9, 50),
+    "tlf_unique_figures": (0, 15),
+    "tlf_repeat_figures": (0, 10),
+    "tlf_unique_listings": (16, 40),
+    "tlf_repeat_listings": (5, 15),
+    "num_dmc_meet": (2, 10),
+    "dmc_meet_freq": (3, 12),
+}
+DEFAULT_RANGE = (1, 10)
+
+
+class StubBackend:
+    """
+    Offline stand-in for the model, for load tests and machines without
+    network access. Replies are deterministic per prompt and document set:
+    every variable in the prompt's ``to_extract`` block gets a canned value
+    (from ``responses``, a {variable: value} dict) or one generated within
+    STUB_RANGES. ``latency`` (+/- ``jitter``) seconds are spent per reply and
+    ``error_rate`` of the calls fail with a botocore ``error_code`` error, so
+    the retry and failure paths can be exercised too.
+    """
+
+    name = "stub"
+
+    def __init__(self, latency: float = 0.0, jitter: float = 0.0, error_rate: float = 0.0,
+                 error_code: str = "ThrottlingException", responses: Optional[Dict[str, Any]] = None,
+                 seed: str = ""):
+        # The replies depend on the seed and the canned responses, so both are
+        # part of the id the response cache is keyed on.
+        settings = json.dumps({"seed": seed, "responses": responses or {}}, sort_keys=True, default=str)
+        self.model_id = "stub:" + hashlib.sha256(settings.encode("utf-8")).hexdigest()[:12]
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.error_code = error_code
+        self.responses = responses or {}
+        self.seed = seed
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+
+    def _digest(self, messages: List[Dict[str, Any]]) -> str:
+        digest = hashlib.sha256(self.seed.encode("utf-8"))
+        for block in messages[0]["content"][1:]:
+            if "text" in block:
+                digest.update(block["text"].encode("utf-8"))
+            else:
+                digest.update(block["document"]["source"]["bytes"])
+        return digest.hexdigest()
+
+    def _value(self, key: str, digest: str) -> Any:
+        if key in self.responses:
+            return self.responses[key]
+        number = int(hashlib.sha256(f"{digest}:{key}".encode("utf-8")).hexdigest()[:8], 16)
+        if key == "dmc/ia":
+            return number % 2 == 0
+        if key == "study_number":
+            return f"STUB-{digest[:6].upper()}"
+        if key == "sponsor":
+            return "Stub Pharmaceuticals"
+        low, high = STUB_RANGES.get(key, DEFAULT_RANGE)
+        return low + number % (high - low + 1)
+
+    def reply(self, messages: List[Dict[str, Any]]) -> str:
+        prompt = messages[0]["content"][0]["text"]
+        schema = _SCHEMA_RE.search(prompt)
+        keys = _KEY_RE.findall(schema.group(1)) if schema else []
+        digest = self._digest(messages)
+        values = {key: self._value(key, digest) for key in keys}
+        return (
+            "Here are the values:\n```python\n"
+            + json.dumps(values, indent=4)
+            + "\n```\nThese values are generated by the stub backend and do not "
+            "reflect the documents."
+        )
+
+    def _delay(self) -> float:
+        with self._lock:
+            fail = self._random.random() < self.error_rate
+            delay = max(0.0, self.latency + self._random.uniform(-self.jitter, self.jitter))
+        if fail:
+            from botocore.exceptions import ClientError
+
+            time.sleep(delay / 4)
+            raise ClientError(
+                {"Error": {"Code": self.error_code, "Message": "Injected by the stub backend"}},
+                "Converse",
+            )
+        return delay
+
+    def _usage(self, messages: List[Dict[str, Any]], text: str, usage: Optional[Dict[str, int]]) -> None:
+        # Rough four-characters-per-token counts, so token metrics move under load tests.
+        if usage is not None:
+            sent = sum(len(block.get("text", "")) for block in messages[0]["content"])
+            usage.update(inputTokens=sent // 4, outputTokens=len(text) // 4)
+
+    def converse(self, messages: List[Dict[str, Any]], inference_config: Dict[str, Any],
+                 usage: Optional[Dict[str, int]] = None) -> str:
+        time.sleep(self._delay())
+        text = self.reply(messages)
+        self._usage(messages, text, usage)
+        return text
+
+    def stream(self, messages: List[Dict[str, Any]], inference_config: Dict[str, Any],
+               usage: Optional[Dict[str, int]] = None) -> Iterator[str]:
+        delay = self._delay()
+        text = self.reply(messages)
+        self._usage(messages, text, usage)
+        chunks = [text[i:i + 20] for i in range(0, len(text), 20)]
+        for chunk in chunks:
+            time.sleep(delay / len(chunks))
+            yield chunk
+
+
+def _env_float(name: str, default: float) -> float:
+    try:
+        return float(os.environ.get(name, "").strip() or default)
+    except ValueError:
+        return default
+
+
+def _make_backend():
+    name = os.environ.get("MODEL_BACKEND", "bedrock").strip().lower()
+    if name == "stub":
+        responses = None
+        path = os.environ.get("MODEL_STUB_RESPONSES")
+        if path:
+            with open(path, encoding="utf-8") as fh:
+                responses = json.load(fh)
+        return StubBackend(
+            latency=_env_float("MODEL_STUB_LATENCY", 0.0),
+            jitter=_env_float("MODEL_STUB_JITTER", 0.0),
+            error_rate=_env_float("MODEL_STUB_ERROR_RATE", 0.0),
+            error_code=os.environ.get("MODEL_STUB_ERROR_CODE", "ThrottlingException"),
+            responses=responses,
+            seed=os.environ.get("MODEL_STUB_SEED", ""),
+        )
+    if name == "bedrock":
+        return BedrockBackend(os.environ.get("MODEL_ID") or DEFAULT_MODEL_ID)
+    raise RuntimeError(f"Unknown MODEL_BACKEND: {name}")
+
+
+_backend = None
+_backend_lock = threading.Lock()
+
+
+def get_backend():
+    """
+    Return the process-wide model backend chosen by ``MODEL_BACKEND``:
+    ``bedrock`` (default, model ``MODEL_ID``) or ``stub`` (configured with
+    the MODEL_STUB_* settings).
+    """
+    global _backend
+    with _backend_lock:
+        if _backend is None:
+            _backend = _make_backend()
+        return _backend
+
+
+def set_backend(backend) -> None:
+    """Replace the process-wide backend (load tests, benchmarks)."""
+    global _backend
+    with _backend_lock:
+        _backend = backend
@@ -0,0 +1,199 @@
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+from typing import Any, Dict, List, Optional
+
+import uploads
+
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+DEFAULT_CACHE_PATH = os.path.join(BASE_DIR, ".cache", "model_responses.sqlite3")
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS responses (
+    key      TEXT PRIMARY KEY,
+    value    TEXT NOT NULL,
+    size     INTEGER NOT NULL,
+    created  REAL NOT NULL,
+    accessed REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS responses_accessed ON responses (accessed);
+CREATE TABLE IF NOT EXISTS counters (
+    name  TEXT PRIMARY KEY,
+    value INTEGER NOT NULL
+);
+"""
+
+
+def _env_int(name: str, default: Optional[int]) -> Optional[int]:
+    raw = os.environ.get(name, "").strip()
+    if not raw:
+        return default
+    try:
+        return int(raw)
+    except ValueError:
+        return default
+
+
+def document_digest(documents: List[Dict[str, Any]]) -> str:
+    """SHA-256 over the bytes (and format) of every document, in order."""
+    digest = hashlib.sha256()
+    for doc in documents or []:
+        digest.update(doc["format"].encode("utf-8"))
+        digest.update(b"\0")
+        digest.update(bytes.fromhex(uploads.document_digest(doc)))
+    return digest.hexdigest()
+
+
+def request_key(documents, prompt: str, model_id: str, inference_config: Dict[str, Any], payload: str = "bytes") -> str:
+    """
+    Content-addressed cache key: the document digest combined with a hash of
+    the prompt, the model id, the inference settings and how the documents
+    were sent (``payload``, raw bytes or pre-extracted text).
+    """
+    request = json.dumps(
+        {
+            "prompt": prompt,
+            "model_id": model_id,
+            "inference_config": inference_config,
+            "payload": payload,
+        },
+        sort_keys=True,
+    )
+    request_hash = hashlib.sha256(request.encode("utf-8")).hexdigest()
+    return f"{document_digest(documents)}:{request_hash}"
+
+
+class ResponseCache:
+    """
+    Persistent SQLite cache of model reply texts.
+
+    Entries are evicted least-recently-used first once the stored replies
+    exceed ``max_bytes``. When ``ttl`` (seconds) is set, older entries are
+    treated as misses and removed. Hit and miss counts are kept in the same
+    database, so processes sharing the file (a single host running both the
+    web app and the workers) report one combined figure. On Heroku every
+    dyno has its own ephemeral file, and /cache/stats covers only the web
+    dyno that answers it.
+    """
+
+    def __init__(self, path: str, max_bytes: int = 256 * 1024 * 1024, ttl: Optional[int] = None):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        with self._connect() as conn:
+            conn.executescript(_SCHEMA)
+
+    @contextmanager
+    def _connect(self):
+        conn = sqlite3.connect(self.path, timeout=30)
+        try:
+            with conn:
+                yield conn
+        finally:
+            conn.close()
+
+    def _count(self, conn, name: str) -> None:
+        conn.execute(
+            "INSERT INTO counters (name, value) VALUES (?, 1) "
+            "ON CONFLICT(name) DO UPDATE SET value = value + 1",
+            (name,),
+        )
+
+    def get(self, key: str) -> Optional[str]:
+        now = time.time()
+        with self._lock, self._connect() as conn:
+            row = conn.execute(
+                "SELECT value, created FROM responses WHERE key = ?", (key,)
+            ).fetchone()
+            if row is not None and self.ttl is not None and now - row[1] > self.ttl:
+                conn.execute("DELETE FROM responses WHERE key = ?", (key,))
+                row = None
+            if row is None:
+                self._count(conn, "misses")
+                return None
+            conn.execute("UPDATE responses SET accessed = ? WHERE key = ?", (now, key))
+            self._count(conn, "hits")
+            return row[0]
+
+    def set(self, key: str, value: str) -> None:
+        now = time.time()
+        size = len(value.encode("utf-8"))
+        if size > self.max_bytes:
+            return
+        with self._lock, self._connect() as conn:
+            conn.execute(
+                "INSERT OR REPLACE INTO responses (key, value, size, created, accessed) "
+                "VALUES (?, ?, ?, ?, ?)",
+                (key, value, size, now, now),
+            )
+            self._evict(conn)
+
+    def _evict(self, conn) -> None:
+        if self.ttl is not None:
+            conn.execute("DELETE FROM responses WHERE created < ?", (time.time() - self.ttl,))
+        total = conn.execute("SELECT COALESCE(SUM(size), 0) FROM responses").fetchone()[0]
+        if total <= self.max_bytes:
+            return
+        for key, size in conn.execute(
+            "SELECT key, size FROM responses ORDER BY accessed ASC"
+        ).fetchall():
+            conn.execute("DELETE FROM responses WHERE key = ?", (key,))
+            total -= size
+            if total <= self.max_bytes:
+                break
+
+    def stats(self) -> Dict[str, int]:
+        with self._lock, self._connect() as conn:
+            counters = dict(conn.execute("SELECT name, value FROM counters").fetchall())
+            entries, size = conn.execute(
+                "SELECT COUNT(*), COALESCE(SUM(size), 0) FROM responses"
+            ).fetchone()
+        return {
+            "hits": counters.get("hits", 0),
+            "misses": counters.get("misses", 0),
+            "entries": entries,
+            "bytes": size,
+        }
+
+    def clear(self) -> None:
+        with self._lock, self._connect() as conn:
+            conn.execute("DELETE FROM responses")
+            conn.execute("DELETE FROM counters")
+
+
+_cache: Optional[ResponseCache] = None
+_cache_lock = threading.Lock()
+
+
+def get_cache() -> Optional[ResponseCache]:
+    """
+    Return the process-wide response cache, or None when caching is disabled
+    with ``MODEL_CACHE_ENABLED=0``.
+    """
+    global _cache
+    if os.environ.get("MODEL_CACHE_ENABLED", "1").strip().lower() in {"0", "false", "no", "off"}:
+        return None
+    with _cache_lock:
+        if _cache is None:
+            _cache = ResponseCache(
+                os.environ.get("MODEL_CACHE_PATH") or DEFAULT_CACHE_PATH,
+                max_bytes=_env_int("MODEL_CACHE_MAX_BYTES", 256 * 1024 * 1024),
+                ttl=_env_int("MODEL_CACHE_TTL", None),
+            )
+        return _cache
+
+
+def cache_stats() -> Dict[str, int]:
+    cache = get_cache()
+    if cache is None:
+        return {"hits": 0, "misses": 0, "entries": 0, "bytes": 0}
+    return cache.stats()
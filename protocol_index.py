@@ -0,0 +1,269 @@
+import math
+import os
+import re
+import threading
+from collections import Counter, OrderedDict, namedtuple
+from typing import Dict, List, Optional
+
+from doc_text import content_hash
+
+
+# Longest section kept as one unit; longer ones are split at paragraph breaks
+# so a single oversized chapter cannot use up the whole context budget.
+MAX_SECTION_CHARS = 6000
+# Leading characters of every document (title page: protocol number, sponsor,
+# phase, study title) that are always sent along with the routed sections.
+FRONT_MATTER_CHARS = 1500
+
+Section = namedtuple("Section", "doc title page text")
+
+_PAGE_RE = re.compile(r"^\[Page (\d+)\]$")
+_MARKDOWN_HEADING_RE = re.compile(r"^#\s+(.+)$")
+# "5.2 Schedule of Assessments", "10. STATISTICAL CONSIDERATIONS", "SYNOPSIS"
+_NUMBERED_HEADING_RE = re.compile(r"^(\d{1,2}(?:\.\d{1,2}){0,3})\.?\s+([A-Z][^.:;]{2,80})$")
+_CAPS_HEADING_RE = re.compile(r"^[A-Z][A-Z0-9 ,/&()\-]{3,80}$")
+_TOKEN_RE = re.compile(r"[a-z][a-z0-9]+")
+
+_STOPWORDS = frozenset("""
+a an and are as at be by for from has have in into is it its of on or per
+shall should that the their this to was were will with within which who
+""".split())
+
+# Query terms for each prompt, weighted by repetition. They describe where in
+# a protocol the prompt's variables are usually stated.
+ROUTES = {
+    "provided": """
+        synopsis synopsis schedule schedule assessments assessments
+        countries country sites site centers subjects subjects patients
+        enrolled enrollment enrolment recruitment duration duration months weeks
+        participation treatment period follow visit visits unscheduled
+        study design overview number planned sample size
+        data monitoring committee dmc interim analysis
+    """,
+    "assumed": """
+        objectives objectives endpoints endpoints primary secondary exploratory
+        efficacy safety pharmacokinetics pharmacokinetic pharmacodynamics
+        pharmacodynamic immunogenicity antidrug antibodies laboratory
+        schedule assessments procedures electrocardiogram vital signs
+        phase part parts period periods cohort cohorts arms
+        statistical analysis methods analysis populations tumor response survival
+    """,
+    "dmc": """
+        data monitoring committee committee dmc dmc idmc dsmb
+        interim interim analysis analyses meeting meetings review frequency
+        charter unblinded safety review months
+    """,
+    "refresh": """
+        interim analysis analyses data cut cutoff database lock dry run
+        refresh deliverables statistical analysis plan reporting timelines
+        final analysis tables listings figures
+    """,
+    "work_order": """
+        protocol number study number sponsor sponsored title
+        amendment version date
+    """,
+}
+
+
+def routing_enabled() -> bool:
+    """Prompt-specific section routing is on unless ``CONTEXT_ROUTING=0``."""
+    return os.environ.get("CONTEXT_ROUTING", "1").strip().lower() not in {"0", "false", "no", "off"}
+
+
+def context_budget() -> int:
+    """Characters of routed document text sent with one prompt (``CONTEXT_MAX_CHARS``)."""
+    try:
+        return int(os.environ.get("CONTEXT_MAX_CHARS", "40000"))
+    except ValueError:
+        return 40000
+
+
+def tokenize(text: str) -> List[str]:
+    return [t for t in _TOKEN_RE.findall(text.lower()) if t not in _STOPWORDS]
+
+
+def _heading(line: str) -> Optional[str]:
+    match = _MARKDOWN_HEADING_RE.match(line)
+    if match:
+        return match.group(1).strip()
+    match = _NUMBERED_HEADING_RE.match(line)
+    if match:
+        return f"{match.group(1)} {match.group(2).strip()}"
+    if _CAPS_HEADING_RE.match(line) and len(line.split()) <= 8:
+        return line
+    return None
+
+
+def _split_long(section: Section) -> List[Section]:
+    if len(section.text) <= MAX_SECTION_CHARS:
+        return [section]
+    parts, current, size = [], [], 0
+    for paragraph in section.text.split("\n\n"):
+        if current and size + len(paragraph) > MAX_SECTION_CHARS:
+            parts.append("\n\n".join(current))
+            current, size = [], 0
+        current.append(paragraph)
+        size += len(paragraph) + 2
+    if current:
+        parts.append("\n\n".join(current))
+    return [section._replace(text=part) for part in parts]
+
+
+def split_sections(doc: int, text: str) -> List[Section]:
+    """
+    Split the extracted text of document number ``doc`` into sections at
+    headings (``# ...`` from DOCX, numbered or all-caps heading lines from
+    PDFs), tracking the page each section starts on from the ``[Page N]``
+    markers.
+    """
+    sections = []
+    title, page, start_page, lines = "", None, None, []
+
+    def flush():
+        body = "\n".join(lines).strip()
+        if body:
+            sections.extend(_split_long(Section(doc, title, start_page, body)))
+
+    for raw in text.splitlines():
+        line = raw.strip()
+        page_match = _PAGE_RE.match(line)
+        if page_match:
+            page = int(page_match.group(1))
+            if not lines:
+                start_page = page
+            continue
+        heading = _heading(line) if line else None
+        if heading:
+            flush()
+            title, start_page, lines = heading, page, []
+        lines.append(raw)
+    flush()
+    return sections
+
+
+class ProtocolIndex:
+    """TF-IDF index over the sections of one proposal's documents."""
+
+    def __init__(self, sections: List[Section]):
+        self.sections = sections
+        self._vectors = []
+        doc_freq = Counter()
+        for section in sections:
+            terms = Counter(tokenize(section.text))
+            # Headings say what a section is about; weight them up.
+            for term in tokenize(section.title):
+                terms[term] += 3
+            self._vectors.append(terms)
+            doc_freq.update(terms.keys())
+        count = len(sections)
+        self._idf = {
+            term: math.log((1 + count) / (1 + df)) + 1.0 for term, df in doc_freq.items()
+        }
+
+    def score(self, query: str) -> List[float]:
+        weights = Counter(tokenize(query))
+        scores = []
+        for terms, section in zip(self._vectors, self.sections):
+            total = sum(terms.values()) or 1
+            score = sum(
+                qw * (terms[term] / total) * self._idf.get(term, 0.0) ** 2
+                for term, qw in weights.items()
+                if term in terms
+            )
+            # Normalise away most of the length bias without ignoring it.
+            scores.append(score * math.sqrt(total) / math.sqrt(len(section.text) / 5 + 1))
+        return scores
+
+    def select(self, query: str, max_chars: int) -> List[int]:
+        """Indices of the best-scoring sections that fit ``max_chars``, in document order."""
+        scores = self.score(query)
+        ranked = sorted(
+            (i for i, s in enumerate(scores) if s > 0),
+            key=scores.__getitem__,
+            reverse=True,
+        )
+        chosen, used = [], 0
+        for i in ranked:
+            size = len(self.sections[i].text)
+            if used + size > max_chars:
+                continue
+            chosen.append(i)
+            used += size
+        return sorted(chosen)
+
+
+_indexes: "OrderedDict[str, ProtocolIndex]" = OrderedDict()
+_indexes_lock = threading.Lock()
+_MAX_INDEXES = 32
+
+
+def _index_for(texts: List[str]) -> ProtocolIndex:
+    key = content_hash("\0".join(texts).encode("utf-8"))
+    with _indexes_lock:
+        index = _indexes.get(key)
+        if index is not None:
+            _indexes.move_to_end(key)
+            return index
+    sections = []
+    for doc_number, text in enumerate(texts):
+        sections.extend(split_sections(doc_number, text))
+    index = ProtocolIndex(sections)
+    with _indexes_lock:
+        _indexes[key] = index
+        while len(_indexes) > _MAX_INDEXES:
+            _indexes.popitem(last=False)
+    return index
+
+
+def _render(section: Section) -> str:
+    if section.page is not None and not section.text.lstrip().startswith("[Page"):
+        return f"[Page {section.page}]\n{section.text}"
+    return section.text
+
+
+def route_texts(
+    route: str,
+    texts: List[str],
+    max_chars: Optional[int] = None,
+) -> Optional[List[str]]:
+    """
+    Narrow each document text to the sections relevant to ``route`` (a key of
+    ROUTES, or several joined with "+" for a merged prompt, which also scales
+    the budget), keeping the front matter of every document. Returns None
+    when routing does not apply (unknown route, texts already within the
+    budget, or nothing matched), in which case the caller should send the
+    full texts.
+    """
+    routes = route.split("+")
+    if not texts or any(r not in ROUTES for r in routes):
+        return None
+    query = " ".join(ROUTES[r] for r in routes)
+    if max_chars is None:
+        max_chars = context_budget() * len(routes)
+
+    front = [text[:FRONT_MATTER_CHARS] for text in texts]
+    if sum(len(text) for text in texts) <= max_chars:
+        return None
+
+    index = _index_for(texts)
+    chosen = index.select(query, max(0, max_chars - sum(len(f) for f in front)))
+    if not chosen:
+        return None
+
+    first_section = {}
+    for i, section in enumerate(index.sections):
+        first_section.setdefault(section.doc, i)
+
+    parts: Dict[int, List[str]] = {i: [] for i in range(len(texts))}
+    for i in chosen:
+        section = index.sections[i]
+        parts[section.doc].append(_render(section))
+
+    routed = []
+    for doc_number in range(len(texts)):
+        body = parts[doc_number]
+        # Skip the separate front matter when the opening section was chosen anyway.
+        if not (body and first_section.get(doc_number) in chosen):
+            body = [front[doc_number], *body]
+        routed.append("\n\n[...]\n\n".join(body))
+    return routed
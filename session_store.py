@@ -0,0 +1,168 @@
+import os
+import secrets
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+from typing import Optional
+
+from flask.json.tag import TaggedJSONSerializer
+from flask.sessions import SessionInterface, SessionMixin
+from werkzeug.datastructures import CallbackDict
+
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+DEFAULT_SQLITE_PATH = os.path.join(BASE_DIR, ".cache", "sessions.sqlite3")
+
+
+class ServerSideSession(CallbackDict, SessionMixin):
+    """Session dict whose contents live in a server-side store under ``sid``."""
+
+    def __init__(self, initial=None, sid=None, new=False):
+        def on_update(self):
+            self.modified = True
+
+        super().__init__(initial, on_update)
+        self.sid = sid
+        self.new = new
+        self.modified = False
+
+
+class RedisSessionStore:
+    """Sessions stored as Redis strings that expire ``ttl`` seconds after the last write."""
+
+    def __init__(self, redis_conn, ttl: int, prefix: str = "session:"):
+        self.redis = redis_conn
+        self.ttl = ttl
+        self.prefix = prefix
+
+    def load(self, sid: str) -> Optional[str]:
+        value = self.redis.get(self.prefix + sid)
+        return None if value is None else value.decode("utf-8")
+
+    def save(self, sid: str, value: str) -> None:
+        self.redis.set(self.prefix + sid, value, ex=self.ttl)
+
+    def delete(self, sid: str) -> None:
+        self.redis.delete(self.prefix + sid)
+
+
+class SQLiteSessionStore:
+    """Sessions in a local SQLite file, for single-node installs without Redis."""
+
+    def __init__(self, path: str, ttl: int):
+        self.path = path
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        with self._connect() as conn:
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS sessions ("
+                "sid TEXT PRIMARY KEY, value TEXT NOT NULL, expires REAL NOT NULL)"
+            )
+
+    @contextmanager
+    def _connect(self):
+        conn = sqlite3.connect(self.path, timeout=30)
+        try:
+            with conn:
+                yield conn
+        finally:
+            conn.close()
+
+    def load(self, sid: str) -> Optional[str]:
+        with self._lock, self._connect() as conn:
+            row = conn.execute(
+                "SELECT value FROM sessions WHERE sid = ? AND expires > ?",
+                (sid, time.time()),
+            ).fetchone()
+        return None if row is None else row[0]
+
+    def save(self, sid: str, value: str) -> None:
+        now = time.time()
+        with self._lock, self._connect() as conn:
+            conn.execute(
+                "INSERT OR REPLACE INTO sessions (sid, value, expires) VALUES (?, ?, ?)",
+                (sid, value, now + self.ttl),
+            )
+            conn.execute("DELETE FROM sessions WHERE expires <= ?", (now,))
+
+    def delete(self, sid: str) -> None:
+        with self._lock, self._connect() as conn:
+            conn.execute("DELETE FROM sessions WHERE sid = ?", (sid,))
+
+
+class ServerSideSessionInterface(SessionInterface):
+    """
+    Keep session data in ``store`` and only an opaque random ID in the cookie.
+
+    The cookie stays the same size however many extracted fields the session
+    holds, and the data is only written back when the session was modified.
+    """
+
+    serializer = TaggedJSONSerializer()
+
+    def __init__(self, store):
+        self.store = store
+
+    def _new_sid(self) -> str:
+        return secrets.token_urlsafe(32)
+
+    def open_session(self, app, request):
+        sid = request.cookies.get(self.get_cookie_name(app))
+        if sid:
+            value = self.store.load(sid)
+            if value is not None:
+                try:
+                    return ServerSideSession(self.serializer.loads(value), sid=sid)
+                except ValueError:
+                    pass
+        return ServerSideSession(sid=self._new_sid(), new=True)
+
+    def save_session(self, app, session, response):
+        name = self.get_cookie_name(app)
+        domain = self.get_cookie_domain(app)
+        path = self.get_cookie_path(app)
+
+        if not session:
+            if session.modified and not session.new:
+                self.store.delete(session.sid)
+                response.delete_cookie(name, domain=domain, path=path)
+            return
+
+        if session.modified:
+            self.store.save(session.sid, self.serializer.dumps(dict(session)))
+
+        if session.new or (session.modified and session.permanent):
+            response.set_cookie(
+                name,
+                session.sid,
+                expires=self.get_expiration_time(app, session),
+                httponly=self.get_cookie_httponly(app),
+                domain=domain,
+                path=path,
+                secure=self.get_cookie_secure(app),
+                samesite=self.get_cookie_samesite(app),
+            )
+
+
+def make_session_interface(redis_conn=None) -> ServerSideSessionInterface:
+    """
+    Build the session interface selected by ``SESSION_BACKEND``: ``redis``
+    (default, shares the RQ connection) or ``sqlite`` for single-node installs.
+    Sessions expire ``SESSION_TTL`` seconds after their last change.
+    """
+    backend = os.environ.get("SESSION_BACKEND", "redis").strip().lower()
+    ttl = int(os.environ.get("SESSION_TTL", str(24 * 60 * 60)))
+
+    if backend == "sqlite":
+        path = os.environ.get("SESSION_SQLITE_PATH") or DEFAULT_SQLITE_PATH
+        return ServerSideSessionInterface(SQLiteSessionStore(path, ttl))
+
+    if redis_conn is None:
+        from redis import Redis
+
+        redis_conn = Redis.from_url(os.environ.get("REDIS_URL", "redis://localhost:6379"))
+    return ServerSideSessionInterface(RedisSessionStore(redis_conn, ttl))
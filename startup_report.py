@@ -0,0 +1,68 @@
+# startup_report.py
+"""
+Report how long the web app and the RQ job module take to import.
+
+    python startup_report.py
+    python startup_report.py app tasks --top 15
+
+Each module is imported in a fresh interpreter with ``-X importtime``. The
+report lists the total import time and the packages that cost the most, so
+regressions in cold-start time (dyno restarts, worker boots, local test
+runs) are easy to spot. Nothing here touches Bedrock or Redis.
+"""
+
+import argparse
+import os
+import subprocess
+import sys
+import time
+from collections import defaultdict
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+DEFAULT_MODULES = ["app", "tasks", "extractors"]
+
+
+def measure(module):
+    """Return (wall seconds, {top-level package: self microseconds}) for one import."""
+    env = dict(os.environ)
+    # Keep the measurement local: no Redis round trip for the session store.
+    env.setdefault("SESSION_BACKEND", "sqlite")
+    started = time.perf_counter()
+    proc = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", f"import {module}"],
+        cwd=BASE_DIR,
+        env=env,
+        capture_output=True,
+        text=True,
+    )
+    wall = time.perf_counter() - started
+    if proc.returncode != 0:
+        tail = proc.stderr.strip().splitlines()[-1:] or ["unknown error"]
+        raise RuntimeError(f"import {module} failed: {tail[0]}")
+
+    packages = defaultdict(int)
+    for line in proc.stderr.splitlines():
+        if not line.startswith("import time:") or "self [us]" in line:
+            continue
+        self_us, _cumulative, name = line[len("import time:"):].split("|", 2)
+        packages[name.strip().split(".")[0]] += int(self_us)
+    return wall, packages
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Report cold import time of the app modules.")
+    parser.add_argument("modules", nargs="*", default=DEFAULT_MODULES)
+    parser.add_argument("--top", type=int, default=10, help="packages listed per module")
+    args = parser.parse_args(argv)
+
+    for module in args.modules:
+        wall, packages = measure(module)
+        imported = sum(packages.values()) / 1e6
+        print(f"{module}: {wall:.2f}s wall, {imported:.2f}s importing")
+        for name, self_us in sorted(packages.items(), key=lambda item: -item[1])[:args.top]:
+            print(f"  {self_us / 1000:8.1f} ms  {name}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,63 +1,226 @@
 # tasks.py
 import os, json
+import threading
+from datetime import datetime, timezone
 from dotenv import load_dotenv
 
 load_dotenv()
 
 from redis import Redis
-from rq import get_current_job
-from extractors import (
-    get_data_conform, get_data_pm,
-    get_data_dm, get_data_biostats,
-    calculate_refresh, calculate_dmc
-)
+from rq import Queue, get_current_job
+from rq.job import Job, JobStatus
 from flask import current_app
 import ssl
 import certifi
 
+import metrics
+
+
 def make_redis_conn():
     return Redis.from_url(
-        os.environ["REDIS_URL"],
+        os.environ.get("REDIS_URL", "redis://localhost:6379"),
     )
 
 # Connect to the same Redis:
 redis_conn = make_redis_conn()
-QUEUE_NAME = "default"
+
+# Extraction jobs run several model calls back to back, well past RQ's
+# default 180s job timeout. Finished results stay in Redis long enough for
+# the browser to pick them up from /results.
+JOB_TIMEOUT = int(os.environ.get("EXTRACTION_JOB_TIMEOUT", "1800"))
+RESULT_TTL = int(os.environ.get("EXTRACTION_RESULT_TTL", "3600"))
+
+# Queues in priority order: uploads someone is waiting on, then file-backed
+# sub-steps, then bulk work. "default" is drained for jobs queued before the
+# split.
+QUEUE_NAMES = ["interactive", "substep", "batch", "default"]
+DEFAULT_QUEUE_WEIGHTS = "interactive=6,substep=3,batch=1,default=1"
+
+# Jobs one user may have running at once; workers put any further job of
+# theirs back on its queue (see claim_run_slot). Past this many interactive
+# or sub-step jobs in flight, a user's new jobs also go to the batch queue.
+JOBS_PER_USER = int(os.environ.get("JOBS_PER_USER", "2"))
+OWNER_PREFIX = "jobs:owner:"
+OWNER_LOCK_PREFIX = "jobs:owner-lock:"
+ACTIVE_STATUSES = (JobStatus.QUEUED, JobStatus.STARTED, JobStatus.DEFERRED, JobStatus.SCHEDULED)
+
+queues = {name: Queue(name, connection=redis_conn) for name in QUEUE_NAMES}
+
+
+def queue_weights():
+    """``QUEUE_WEIGHTS`` as {queue: weight}, e.g. ``interactive=6,substep=3,batch=1``."""
+    weights = {}
+    raw = os.environ.get("QUEUE_WEIGHTS") or DEFAULT_QUEUE_WEIGHTS
+    for item in raw.split(","):
+        name, _, weight = item.partition("=")
+        try:
+            weights[name.strip()] = max(0.0, float(weight))
+        except ValueError:
+            continue
+    return {name: weights.get(name, 1.0) for name in QUEUE_NAMES}
+
+
+def _active_jobs(owner, statuses=ACTIVE_STATUSES):
+    """
+    Job ids of ``owner`` that are still queued or running (only those in
+    ``statuses``); finished ones are pruned.
+    """
+    key = OWNER_PREFIX + owner
+    job_ids = [job_id.decode("utf-8") for job_id in redis_conn.smembers(key)]
+    if not job_ids:
+        return []
+    active, done = [], []
+    for job_id, job in zip(job_ids, Job.fetch_many(job_ids, connection=redis_conn)):
+        status = job.get_status(refresh=False) if job is not None else None
+        if status not in ACTIVE_STATUSES:
+            done.append(job_id)
+        elif status in statuses:
+            active.append(job_id)
+    if done:
+        redis_conn.srem(key, *done)
+    return active
+
+
+def claim_run_slot(job):
+    """
+    Called by a worker that has just dequeued ``job``: True if the job may
+    run, False if its owner already has JOBS_PER_USER jobs running. A job
+    that may run is marked started under the owner's lock, so workers
+    dequeuing the same owner's jobs at once cannot both take the last slot.
+    """
+    owner = (job.meta or {}).get("owner")
+    if not owner or JOBS_PER_USER <= 0:
+        return True
+    with redis_conn.lock(OWNER_LOCK_PREFIX + owner, timeout=10, blocking_timeout=10):
+        running = _active_jobs(owner, statuses=(JobStatus.STARTED,))
+        if job.id not in running and len(running) >= JOBS_PER_USER:
+            return False
+        job.set_status(JobStatus.STARTED)
+        return True
+
+
+def enqueue(func, *args, kind="interactive", owner=None):
+    """
+    Queue ``func(*args)`` for the RQ workers on the ``kind`` queue and return
+    the job. Workers run at most JOBS_PER_USER jobs of one ``owner`` (the
+    session) at a time, and an owner's jobs past that many in flight go to
+    the batch queue, so one person's pile of uploads cannot hold up everyone
+    else.
+    """
+    if owner and kind != "batch" and len(_active_jobs(owner)) >= JOBS_PER_USER:
+        kind = "batch"
+    job = queues[kind].enqueue(
+        func,
+        *args,
+        job_timeout=JOB_TIMEOUT,
+        result_ttl=RESULT_TTL,
+        failure_ttl=RESULT_TTL,
+        meta={"owner": owner} if owner else None,
+    )
+    if owner:
+        key = OWNER_PREFIX + owner
+        pipe = redis_conn.pipeline()
+        pipe.sadd(key, job.id)
+        pipe.expire(key, JOB_TIMEOUT + RESULT_TTL)
+        pipe.execute()
+    return job
+
+
+def queue_stats():
+    """
+    Per queue: jobs waiting, jobs running, and how long the oldest waiting
+    job has been queued (seconds).
+    """
+    now = datetime.now(timezone.utc)
+    stats = {}
+    for name, q in queues.items():
+        oldest_wait = 0.0
+        oldest = q.get_job_ids(0, 1)
+        if oldest:
+            job = q.fetch_job(oldest[0])
+            if job is not None and job.enqueued_at is not None:
+                enqueued_at = job.enqueued_at
+                if enqueued_at.tzinfo is None:
+                    enqueued_at = enqueued_at.replace(tzinfo=timezone.utc)
+                oldest_wait = max(0.0, (now - enqueued_at).total_seconds())
+        stats[name] = {
+            "waiting": q.count,
+            "running": q.started_job_registry.count,
+            "oldest_wait": oldest_wait,
+        }
+    return stats
+
+
+def _record_wait(job):
+    """Observe how long ``job`` sat in its queue before a worker picked it up."""
+    if job.enqueued_at is None or job.started_at is None:
+        return
+    wait = (job.started_at - job.enqueued_at).total_seconds()
+    metrics.observe(metrics.QUEUE_WAIT_METRIC, max(0.0, wait), queue=job.origin)
+
+
+PROGRESS_CHANNEL_PREFIX = "job-progress:"
+
+
+def progress_channel(job_id):
+    """Redis pub/sub channel carrying the progress events of one job."""
+    return PROGRESS_CHANNEL_PREFIX + job_id
+
+
+def publish_event(job_id, event):
+    """
+    Publish one progress event (a JSON-serializable dict) for the /events
+    stream. Events with a "status" key mark job state changes; the rest
+    describe a model call. Best effort: nobody may be listening.
+    """
+    try:
+        redis_conn.publish(progress_channel(job_id), json.dumps(event, default=str))
+    except Exception:
+        pass
+
+
+def _record_progress(job):
+    """
+    Progress hook that keeps ``job.meta["progress"]`` up to date with the
+    state of each model call and publishes every change, for the waiting
+    page to show.
+    """
+    lock = threading.Lock()
+
+    def hook(route, state, chars, values):
+        progress = {"state": state, "chars": chars, "values": values}
+        with lock:
+            job.meta.setdefault("progress", {})[route] = progress
+            job.save_meta()
+        publish_event(job.id, {"route": route, **progress})
+
+    return hook
+
+
+def _with_progress(func, *args):
+    from extractors import progress_hook
+
+    job = get_current_job()
+    if job is None:
+        return func(*args)
+    _record_wait(job)
+    publish_event(job.id, {"status": "started"})
+    with progress_hook(_record_progress(job)):
+        return func(*args)
+
 
 def run_extraction(steps, documents, refresh_opts, dmc_opts):
     """
     runs core extraction + optional sub‑steps, returns the final data dict.
     Called in a background RQ worker.
     """
-    data = {}
-    print(2)
-    if "conform" in steps:
-        data.update(get_data_conform(documents))
-    if "project_management" in steps:
-        data.update(get_data_pm(documents))
-    if "data_management" in steps:
-        data.update(get_data_dm(documents))
-    if "biostats" in steps:
-        data.update(get_data_biostats(documents))
+    # Imported here so the web process can import this module without a cycle.
+    from app import run_extraction as _run_extraction
 
-    return data
+    return _with_progress(_run_extraction, steps, documents, refresh_opts, dmc_opts)
 
 def run_substeps(steps, data, refresh_opts, dmc_opts):
-    # if refresh_opts is a tuple (do_refresh, docs[])
-    do_refresh, refresh_docs = refresh_opts
-    r = True
-    if not refresh_docs:
-        r = False        
-        
-    if "biostats" in steps and do_refresh:
-        data.update(calculate_refresh(data, refresh_docs, r))
-
-    # same for DMC:
-    do_dmc, dmc_docs = dmc_opts
-    d = True
-    if not dmc_docs:
-        d = False
-    if "biostats" in steps and do_dmc:
-        data.update(calculate_dmc(data, dmc_docs, d))
-
-    return data
+    """Refresh/DMC sub-steps on previously extracted data, in the RQ worker."""
+    from app import run_substeps as _run_substeps
+
+    return _with_progress(_run_substeps, steps, data, refresh_opts, dmc_opts)
@@ -0,0 +1,93 @@
+import os
+
+import pytest
+from openpyxl import Workbook, load_workbook
+
+from excel_utils import calculate_template, get_template
+from formula_engine import REF, FormulaError, FormulaModel, compile_formula
+
+
+TEMPLATE_PATH = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+                             "templates_xlsx", "template_full.xlsx")
+
+# The sheets app._sheets_for_steps(["biostats"]) keeps.
+BIOSTATS_SHEETS = {"Study Information", "Biostatistics and Programming", "Budget Summary"}
+
+
+def _workbook(cells):
+    wb = Workbook()
+    wb.remove(wb.active)
+    for (sheet, coordinate), value in cells.items():
+        ws = wb[sheet] if sheet in wb.sheetnames else wb.create_sheet(sheet)
+        ws[coordinate] = value
+    return wb
+
+
+def _evaluate(text, values=None):
+    cells = {key: value for key, value in (values or {}).items()}
+    return compile_formula(text, "Sheet").fn(lambda key: cells.get(key))
+
+
+def test_arithmetic_and_functions():
+    values = {("Sheet", "A1"): 2, ("Sheet", "A2"): 3, ("Sheet", "A3"): "4"}
+    assert _evaluate("=A1*A2+A3", values) == 10
+    assert _evaluate("=SUM(A1:A3)", values) == 5
+    assert _evaluate("=ROUNDUP(A2/A1,0)", values) == 2
+    assert _evaluate('=IF(A1>A2,"yes","no")', values) == "no"
+
+
+def test_errors_propagate_and_iferror_catches_them():
+    assert _evaluate("=1/0") == FormulaError("#DIV/0!")
+    assert _evaluate("=1/0+1") == FormulaError("#DIV/0!")
+    assert _evaluate("=IFERROR(1/0,7)") == 7
+
+
+def test_blank_cell_result_is_zero():
+    model = FormulaModel(_workbook({("Sheet", "B1"): "=A1"}))
+    assert model.evaluate({}) == {("Sheet", "B1"): 0}
+    assert model.evaluate({("Sheet", "A1"): 5}) == {("Sheet", "B1"): 5}
+
+
+def test_dropped_sheet_references_are_ref_errors():
+    model = FormulaModel(_workbook({
+        ("Prices", "A1"): 100,
+        ("Summary", "A1"): "=Prices!A1",
+        ("Summary", "A2"): "=IFERROR(Prices!A1,0)",
+        ("Summary", "A3"): "=A2+1",
+    }))
+    assert model.evaluate({})[("Summary", "A2")] == 100
+    results = model.evaluate({}, keep_sheets={"Summary"})
+    assert results == {("Summary", "A1"): REF, ("Summary", "A2"): 0, ("Summary", "A3"): 1}
+
+
+def test_template_matches_cached_values():
+    """With no inputs, every formula of the template gives the value Excel saved."""
+    cached = load_workbook(TEMPLATE_PATH, data_only=True)
+    results = calculate_template({}, TEMPLATE_PATH)
+    assert results
+    for (sheet, coordinate), value in results.items():
+        expected = cached[sheet][coordinate].value
+        if isinstance(value, FormulaError):
+            value = str(value)
+        if isinstance(expected, (int, float)) and not isinstance(expected, bool):
+            assert value == pytest.approx(expected), f"{sheet}!{coordinate}"
+        else:
+            assert value == expected, f"{sheet}!{coordinate}"
+
+
+def test_biostats_only_proposal_prices_other_services_at_zero():
+    formulas = get_template(TEMPLATE_PATH).formulas.formulas
+    full = calculate_template({}, TEMPLATE_PATH)
+    results = calculate_template({}, TEMPLATE_PATH, BIOSTATS_SHEETS)
+
+    assert not any(sheet not in BIOSTATS_SHEETS for sheet, _ in results)
+    lines = [
+        key for key, formula in formulas.items()
+        if key[0] == "Budget Summary" and any(sheet not in BIOSTATS_SHEETS for sheet, _ in formula.deps)
+    ]
+    # Project Management, Clinical Data Management and CONFORM Informatics.
+    assert {("Budget Summary", "B7"), ("Budget Summary", "B14"), ("Budget Summary", "B34")} <= set(lines)
+    assert any(full[key] for key in lines)
+    for key in lines:
+        assert results[key] == 0, f"{key[0]}!{key[1]} {formulas[key].text}"
+    assert results[("Budget Summary", "B54")] < full[("Budget Summary", "B54")]
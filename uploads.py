@@ -0,0 +1,218 @@
+import hashlib
+import io
+import os
+import tempfile
+import threading
+import time
+from typing import Any, BinaryIO, Dict, List, Optional
+
+import document_store
+
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+DEFAULT_SPOOL_DIR = os.path.join(BASE_DIR, ".cache", "uploads")
+
+CHUNK_SIZE = 1024 * 1024
+
+_sweep_lock = threading.Lock()
+_last_sweep = 0.0
+SWEEP_INTERVAL = 600
+
+
+def _spool_dir() -> str:
+    path = os.environ.get("UPLOAD_SPOOL_DIR") or DEFAULT_SPOOL_DIR
+    os.makedirs(path, exist_ok=True)
+    return path
+
+
+def _spool_ttl() -> int:
+    try:
+        return int(os.environ.get("UPLOAD_SPOOL_TTL", "21600"))
+    except ValueError:
+        return 21600
+
+
+class Upload:
+    """
+    An uploaded document kept on disk: ``path``, its SHA-256 (computed while
+    the file was written) and ``size``. The bytes are only read when
+    something needs them.
+
+    Pickling (RQ job arguments) publishes the file to the document store and
+    carries only its digest, since the worker may run on another dyno; the
+    unpickled Upload fetches the file into the local spool directory the
+    first time it is opened.
+    """
+
+    def __init__(self, path: Optional[str], sha256: str, size: int):
+        self.path = path
+        self.sha256 = sha256
+        self.size = size
+        self.published = False
+
+    def _local_path(self) -> str:
+        if self.path and os.path.exists(self.path):
+            return self.path
+        spooled = os.path.join(_spool_dir(), self.sha256)
+        if not os.path.exists(spooled):
+            stream = document_store.get_store().open(self.sha256)
+            if stream is None:
+                raise RuntimeError(f"Document {self.sha256[:12]} has expired; please upload it again")
+            with stream:
+                restored = spool(stream)
+            if restored.sha256 != self.sha256:
+                raise RuntimeError(f"Document {self.sha256[:12]} is corrupted in the document store")
+        self.path = spooled
+        return spooled
+
+    def open(self) -> BinaryIO:
+        return open(self._local_path(), "rb")
+
+    def read(self) -> bytes:
+        with self.open() as fh:
+            return fh.read()
+
+    def publish(self) -> None:
+        """Put the file in the shared document store (once per Upload)."""
+        if not self.published:
+            with self.open() as fh:
+                document_store.get_store().put(self.sha256, fh)
+            self.published = True
+
+    def __getstate__(self) -> Dict[str, Any]:
+        self.publish()
+        return {"sha256": self.sha256, "size": self.size}
+
+    def __setstate__(self, state: Dict[str, Any]) -> None:
+        self.path = None
+        self.sha256 = state["sha256"]
+        self.size = state["size"]
+        self.published = True
+
+    def __repr__(self) -> str:
+        return f"Upload({self.sha256[:12]}, {self.size} bytes)"
+
+
+def _sweep(directory: str) -> None:
+    """Delete spooled files older than ``UPLOAD_SPOOL_TTL`` seconds, every few minutes."""
+    global _last_sweep
+    now = time.time()
+    with _sweep_lock:
+        if now - _last_sweep < SWEEP_INTERVAL:
+            return
+        _last_sweep = now
+    cutoff = now - _spool_ttl()
+    for name in os.listdir(directory):
+        path = os.path.join(directory, name)
+        try:
+            if os.path.getmtime(path) < cutoff:
+                os.remove(path)
+        except OSError:
+            pass
+
+
+def spool(stream: BinaryIO) -> Upload:
+    """
+    Copy ``stream`` to the spool directory in chunks, hashing as it goes.
+    Files are named by content, so repeated uploads share one copy.
+    """
+    directory = _spool_dir()
+    _sweep(directory)
+
+    digest = hashlib.sha256()
+    size = 0
+    fd, tmp_path = tempfile.mkstemp(dir=directory, suffix=".part")
+    try:
+        with os.fdopen(fd, "wb") as out:
+            while True:
+                chunk = stream.read(CHUNK_SIZE)
+                if not chunk:
+                    break
+                digest.update(chunk)
+                out.write(chunk)
+                size += len(chunk)
+        path = os.path.join(directory, digest.hexdigest())
+        os.replace(tmp_path, path)
+    except BaseException:
+        try:
+            os.remove(tmp_path)
+        except OSError:
+            pass
+        raise
+    return Upload(path, digest.hexdigest(), size)
+
+
+def from_path(path: str) -> Upload:
+    """An Upload for a file that is already on disk (batch runs); nothing is copied."""
+    digest = hashlib.sha256()
+    size = 0
+    with open(path, "rb") as fh:
+        while True:
+            chunk = fh.read(CHUNK_SIZE)
+            if not chunk:
+                break
+            digest.update(chunk)
+            size += len(chunk)
+    return Upload(os.path.abspath(path), digest.hexdigest(), size)
+
+
+def make_document(upload: Upload, filename: str) -> Dict[str, Any]:
+    """The document dict the extractors take, for ``upload`` named ``filename``."""
+    return {
+        "upload": upload,
+        "format": filename.rsplit(".", 1)[1].lower(),
+        "name": os.path.splitext(filename)[0],
+    }
+
+
+def document_refs(documents: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+    """
+    JSON-serializable references to spooled ``documents`` (for the session),
+    publishing each to the document store so later requests can reuse it.
+    """
+    refs = []
+    for doc in documents:
+        upload = doc["upload"]
+        upload.publish()
+        refs.append({"sha256": upload.sha256, "size": upload.size, "format": doc["format"], "name": doc["name"]})
+    return refs
+
+
+def stored_documents(refs: List[Dict[str, Any]]) -> Optional[List[Dict[str, Any]]]:
+    """
+    Documents for references made by ``document_refs``, or None when any of
+    them has expired from the document store. The bytes stay in the store
+    until something opens the document.
+    """
+    store = document_store.get_store()
+    if not all(store.exists(ref["sha256"]) for ref in refs):
+        return None
+    documents = []
+    for ref in refs:
+        upload = Upload(None, ref["sha256"], ref["size"])
+        upload.published = True
+        documents.append({"upload": upload, "format": ref["format"], "name": ref["name"]})
+    return documents
+
+
+# Documents are either {"upload": Upload, ...} or, for callers that already
+# hold the file in memory (benchmarks, scripts), {"file_bytes": b"...", ...}.
+
+def document_bytes(doc: Dict[str, Any]) -> bytes:
+    if "upload" in doc:
+        return doc["upload"].read()
+    return doc["file_bytes"]
+
+
+def document_digest(doc: Dict[str, Any]) -> str:
+    """SHA-256 of the document's contents, without reading spooled files again."""
+    if "upload" in doc:
+        return doc["upload"].sha256
+    return hashlib.sha256(doc["file_bytes"]).hexdigest()
+
+
+def open_document(doc: Dict[str, Any]) -> BinaryIO:
+    if "upload" in doc:
+        return doc["upload"].open()
+    return io.BytesIO(doc["file_bytes"])
+
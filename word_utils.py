@@ -1,66 +1,139 @@
+import bisect
+import re
 import zipfile
-from xml.etree import ElementTree as ET
+from xml.sax.saxutils import escape, unescape
 
+import metrics
 
-WORD_NAMESPACE = "http://schemas.openxmlformats.org/wordprocessingml/2006/main"
-XMLNS_NAMESPACE = "http://www.w3.org/2000/xmlns/"
+
+# Parts of the package that can hold placeholders: the body, every header
+# and footer, footnotes and endnotes.
+PLACEHOLDER_PARTS_RE = re.compile(r"^word/(document|header\d*|footer\d*|footnotes|endnotes)\.xml$")
+
+PLACEHOLDER_RE = re.compile(r"\{\{[^{}]+\}\}")
+
+# One pass over the part: paragraph starts and ends (to group runs, including
+# paragraphs nested in text boxes) and the text of every w:t element.
+_TOKEN_RE = re.compile(
+    r"(?P<p_empty><w:p(?:\s[^>]*)?/>)"
+    r"|(?P<p_open><w:p(?:\s[^>]*)?>)"
+    r"|(?P<p_close></w:p>)"
+    r"|(?P<t_open><w:t(?:\s[^>]*)?(?<!/)>)(?P<text>[^<]*)</w:t>"
+)
+
+_ENTITIES = {"&quot;": '"', "&apos;": "'"}
+_NUMERIC_ENTITY_RE = re.compile(r"&#(x[0-9a-fA-F]+|[0-9]+);")
+
+
+def _xml_unescape(text):
+    text = _NUMERIC_ENTITY_RE.sub(
+        lambda m: chr(int(m.group(1)[1:], 16) if m.group(1)[0] == "x" else int(m.group(1))),
+        text,
+    )
+    return unescape(text, _ENTITIES)
+
+
+def _substitute_paragraph(nodes, replacements, edits):
+    """
+    Replace the placeholders in one paragraph. ``nodes`` are the paragraph's
+    w:t elements as (tag, tag_start, text_start, text_end, text). Word often
+    splits a placeholder over several runs, so matching runs on the joined
+    text: a replacement goes into the run where its placeholder starts and
+    the rest of the placeholder is cut from the following runs.
+    """
+    texts = [_xml_unescape(node[4]) for node in nodes]
+    joined = "".join(texts)
+    matches = [
+        m for m in PLACEHOLDER_RE.finditer(joined)
+        if m.group(0) in replacements
+    ]
+    if not matches:
+        return
+
+    starts = []
+    offset = 0
+    for text in texts:
+        starts.append(offset)
+        offset += len(text)
+    pieces = [[] for _ in nodes]
+
+    def emit(start, end):
+        index = bisect.bisect_right(starts, start) - 1
+        while start < end and index < len(nodes):
+            node_end = starts[index] + len(texts[index])
+            stop = min(end, node_end)
+            if stop > start:
+                pieces[index].append(joined[start:stop])
+            start = stop
+            index += 1
+
+    position = 0
+    for match in matches:
+        emit(position, match.start())
+        index = bisect.bisect_right(starts, match.start()) - 1
+        pieces[index].append(replacements[match.group(0)])
+        position = match.end()
+    emit(position, len(joined))
+
+    for node, old_text, new_parts in zip(nodes, texts, pieces):
+        new_text = "".join(new_parts)
+        if new_text == old_text:
+            continue
+        tag, tag_start, text_start, text_end, _ = node
+        if new_text != new_text.strip() and "xml:space" not in tag:
+            # Keep leading/trailing spaces Word would otherwise drop.
+            edits.append((tag_start, text_start, tag[:-1] + ' xml:space="preserve">'))
+        edits.append((text_start, text_end, escape(new_text)))
 
 
 def _replace_placeholders_in_xml(xml_bytes, replacements):
-    """Replace placeholders in the given Word document XML bytes."""
+    """
+    Replace ``{{key}}`` placeholders in one WordprocessingML part.
+
+    The part is scanned once with a tokenizer instead of being parsed into a
+    tree, each placeholder is looked up in ``replacements`` directly (so the
+    cost does not grow with the number of placeholders), and everything
+    outside the changed w:t texts is written back byte for byte.
+    """
+    if not replacements or b"{" not in xml_bytes:
+        return xml_bytes
 
-    if not replacements:
+    xml = xml_bytes.decode("utf-8")
+    edits = []
+    stack = []
+    for token in _TOKEN_RE.finditer(xml):
+        kind = token.lastgroup if token.lastgroup != "text" else "t_open"
+        if kind == "p_open":
+            stack.append([])
+        elif kind == "p_close":
+            if stack:
+                nodes = stack.pop()
+                if any("{" in node[4] or "}" in node[4] for node in nodes):
+                    _substitute_paragraph(nodes, replacements, edits)
+        elif kind == "t_open" and stack:
+            stack[-1].append((
+                token.group("t_open"),
+                token.start("t_open"),
+                token.start("text"),
+                token.end("text"),
+                token.group("text"),
+            ))
+
+    if not edits:
         return xml_bytes
 
-    root = ET.fromstring(xml_bytes)
-
-    # Ensure existing namespace prefixes are preserved when the tree is serialized.
-    for attr_key, uri in root.attrib.items():
-        if attr_key.startswith(f"{{{XMLNS_NAMESPACE}}}"):
-            prefix = attr_key.split("}", 1)[1]
-            ET.register_namespace(prefix, uri)
-
-    ET.register_namespace("w", WORD_NAMESPACE)
-    text_elements = list(root.iter(f"{{{WORD_NAMESPACE}}}t"))
-
-    def apply_replacements(text):
-        if not text:
-            return text
-        updated = text
-        for placeholder, value in replacements.items():
-            updated = updated.replace(placeholder, value)
-        return updated
-
-    i = 0
-    total = len(text_elements)
-    while i < total:
-        elem = text_elements[i]
-        text = elem.text or ""
-
-        if "{{" in text and "}}" not in text:
-            buffer = []
-            combined = ""
-            while i < total:
-                current_elem = text_elements[i]
-                current_text = current_elem.text or ""
-                buffer.append(current_elem)
-                combined += current_text
-                i += 1
-                if "}}" in combined:
-                    break
-
-            replaced_text = apply_replacements(combined)
-            if buffer:
-                buffer[0].text = replaced_text
-                for extra_elem in buffer[1:]:
-                    extra_elem.text = ""
-        else:
-            elem.text = apply_replacements(text)
-            i += 1
-
-    return ET.tostring(root, encoding="utf-8", xml_declaration=True)
+    edits.sort()
+    out = []
+    position = 0
+    for start, end, text in edits:
+        out.append(xml[position:start])
+        out.append(text)
+        position = end
+    out.append(xml[position:])
+    return "".join(out).encode("utf-8")
 
 
+@metrics.timed()
 def populate_work_order(values, template_path, output_path):
     """Populate the Word template with the provided values.
 
@@ -79,6 +152,6 @@ def populate_work_order(values, template_path, output_path):
         with zipfile.ZipFile(output_path, "w") as zout:
             for item in zin.infolist():
                 data = zin.read(item.filename)
-                if item.filename == "word/document.xml":
+                if PLACEHOLDER_PARTS_RE.match(item.filename):
                     data = _replace_placeholders_in_xml(data, replacements)
                 zout.writestr(item, data)
@@ -35,8 +35,26 @@
 
 
 # worker.py
+"""
+RQ worker pool for one dyno.
 
+    python worker.py                       # all queues, WORKER_PROCESSES children
+    python worker.py interactive substep   # only these queues
+
+The parent process imports the app, loads the workbook template and builds
+the model client once (warm_up), then forks WORKER_PROCESSES children that
+each run a WeightedWorker. Jobs still run inside the child that dequeued
+them, as with SimpleWorker, so nothing is re-imported per job. A child
+exits after WORKER_MAX_JOBS jobs or once its memory passes
+WORKER_MAX_MEMORY_MB, and the parent forks a fresh, equally warm one.
+"""
+
+import logging
 import os
+import random
+import signal
+import sys
+import time
 from dotenv import load_dotenv
 
 # 1) Load your .env so REDIS_URL is in os.environ
@@ -46,9 +64,11 @@ from redis import Redis
 from rq.queue import Queue
 from rq.worker import SimpleWorker
 
-# queues to listen on
-listen = ["default"]
-print(9)
+from tasks import QUEUE_NAMES, claim_run_slot, publish_event, queue_weights
+
+logger = logging.getLogger("worker")
+
+
 def make_redis_conn():
     """
     Build a Redis connection (will pick up rediss:// on Heroku,
@@ -56,19 +76,211 @@ def make_redis_conn():
     """
     return Redis.from_url(os.environ["REDIS_URL"])
 
-if __name__ == "__main__":
-    # 2) Create the Redis connection
-    print(3)
-    conn = make_redis_conn()
 
-    # 3) Build Queue objects bound to that connection
-    print(4)
+def _env_int(name, default):
+    try:
+        return int(os.environ.get(name, "").strip() or default)
+    except ValueError:
+        return default
+
+
+def _rss_bytes():
+    """Resident memory of this process (Linux), or its peak where /proc is missing."""
+    try:
+        with open("/proc/self/statm") as fh:
+            return int(fh.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, IndexError):
+        import resource
+
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return peak if sys.platform == "darwin" else peak * 1024
+
+
+def weighted_order(queues, weights):
+    """
+    Random queue order in which each queue comes first with probability
+    proportional to its weight; weight 0 queues always come last.
+    """
+    def key(queue):
+        weight = weights.get(queue.name, 1.0)
+        if weight <= 0:
+            return 1.0 + random.random()
+        # Weighted sampling without replacement: smaller keys first.
+        return 1.0 - random.random() ** (1.0 / weight)
+
+    return sorted(queues, key=key)
+
+
+class WeightedWorker(SimpleWorker):
+    """
+    SimpleWorker that reshuffles its queues by QUEUE_WEIGHTS after every job
+    instead of always draining them in order. Interactive jobs are still
+    picked first most of the time, but a long batch run keeps moving and a
+    batch backlog can never starve the queues ahead of it either.
+
+    With ``memory_limit`` (bytes) the worker stops after the job that took
+    it past the limit, for the pool to replace it.
+
+    A dequeued job whose owner already has JOBS_PER_USER jobs running goes
+    back to the end of its queue, and the worker looks again after
+    ``OWNER_BUSY_DELAY`` seconds.
+    """
+
+    OWNER_BUSY_DELAY = 2.0
+
+    def __init__(self, queues, *args, weights=None, memory_limit=None, **kwargs):
+        super().__init__(queues, *args, **kwargs)
+        self.weights = weights or {}
+        self.memory_limit = memory_limit
+        self._ordered_queues = weighted_order(self.queues, self.weights)
+
+    def reorder_queues(self, reference_queue):
+        self._ordered_queues = weighted_order(self.queues, self.weights)
+
+    def dequeue_job_and_maintain_ttl(self, timeout, max_idle_time=None):
+        while True:
+            result = super().dequeue_job_and_maintain_ttl(timeout, max_idle_time)
+            if result is None or claim_run_slot(result[0]):
+                return result
+            job, queue = result
+            self.log.info("Worker %s: owner of %s is at JOBS_PER_USER, requeueing", self.name, job.id)
+            pipe = self.connection.pipeline()
+            # A single-queue worker dequeues through RQ's intermediate list.
+            pipe.lrem(queue.intermediate_queue_key, 1, job.id)
+            queue.push_job_id(job.id, pipeline=pipe)
+            pipe.execute()
+            time.sleep(self.OWNER_BUSY_DELAY)
+            if self._stop_requested:
+                return None
+
+    def handle_job_success(self, job, queue, started_job_registry):
+        super().handle_job_success(job, queue, started_job_registry)
+        # Only now is the result saved, so /results can pick it up.
+        publish_event(job.id, {"status": "finished"})
+
+    def handle_job_failure(self, job, queue, started_job_registry=None, exc_string=""):
+        super().handle_job_failure(job, queue, started_job_registry=started_job_registry, exc_string=exc_string)
+        publish_event(job.id, {"status": "failed"})
+
+    def execute_job(self, job, queue):
+        result = super().execute_job(job, queue)
+        if self.memory_limit:
+            rss = _rss_bytes()
+            if rss > self.memory_limit:
+                self.log.info("Worker %s: using %d MB, recycling", self.name, rss // (1024 * 1024))
+                self._stop_requested = True
+        return result
+
+
+def warm_up():
+    """
+    Do the expensive start-up work once in the parent, so every forked child
+    shares it: the app and extractor imports, the parsed workbook template
+    with its compiled formulas, and the model backend and Bedrock client
+    (which opens no connection until its first request).
+    """
+    started = time.perf_counter()
+    import app as webapp
+    from excel_utils import get_template
+    from model_backends import get_backend
+
+    get_template(webapp.TEMPLATE_PATH).formulas
+    if get_backend().name == "bedrock":
+        import bedrock_client
+
+        bedrock_client.get_client()
+    logger.info("Warm start took %.2fs", time.perf_counter() - started)
+
+
+def run_worker(listen, max_jobs, memory_limit):
+    """One pool child: a WeightedWorker on ``listen`` until it is recycled or stopped."""
+    conn = make_redis_conn()
     queues = [Queue(name, connection=conn) for name in listen]
+    worker = WeightedWorker(queues, connection=conn, weights=queue_weights(), memory_limit=memory_limit)
+    worker.work(max_jobs=max_jobs or None)
+
+
+class WorkerPool:
+    """Keep ``processes`` forked children running ``run_worker`` until told to stop."""
+
+    # A child that dies faster than this is not respawned immediately, so a
+    # broken Redis URL does not turn into a fork loop.
+    MIN_LIFETIME = 5.0
+
+    def __init__(self, processes, listen, max_jobs, memory_limit):
+        self.processes = processes
+        self.listen = listen
+        self.max_jobs = max_jobs
+        self.memory_limit = memory_limit
+        self.children = {}
+        self.stopping = False
+
+    def _spawn(self):
+        pid = os.fork()
+        if pid == 0:
+            # The child installs RQ's own handlers once it starts working.
+            signal.signal(signal.SIGTERM, signal.SIG_DFL)
+            signal.signal(signal.SIGINT, signal.SIG_DFL)
+            random.seed()
+            code = 0
+            try:
+                run_worker(self.listen, self.max_jobs, self.memory_limit)
+            except BaseException:
+                logger.exception("Worker process %d crashed", os.getpid())
+                code = 1
+            finally:
+                os._exit(code)
+        self.children[pid] = time.monotonic()
+        logger.info("Started worker process %d", pid)
+
+    def _stop(self, signum, frame):
+        # RQ workers finish their current job on the first SIGTERM/SIGINT.
+        self.stopping = True
+        for pid in list(self.children):
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+
+    def run(self):
+        signal.signal(signal.SIGTERM, self._stop)
+        signal.signal(signal.SIGINT, self._stop)
+        while True:
+            while not self.stopping and len(self.children) < self.processes:
+                self._spawn()
+            if not self.children:
+                return
+            try:
+                pid, status = os.wait()
+            except ChildProcessError:
+                self.children.clear()
+                continue
+            except InterruptedError:
+                continue
+            started = self.children.pop(pid, None)
+            if started is None:
+                continue
+            code = os.waitstatus_to_exitcode(status)
+            logger.info("Worker process %d exited with %d", pid, code)
+            if not self.stopping and code != 0 and time.monotonic() - started < self.MIN_LIFETIME:
+                time.sleep(self.MIN_LIFETIME)
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(name)s: %(message)s")
+
+    # queues to listen on: the command line, WORKER_QUEUES, or all of them
+    listen = sys.argv[1:] or [
+        name.strip() for name in os.environ.get("WORKER_QUEUES", ",".join(QUEUE_NAMES)).split(",")
+        if name.strip()
+    ]
+    processes = max(1, _env_int("WORKER_PROCESSES", 2))
+    max_jobs = _env_int("WORKER_MAX_JOBS", 50)
+    memory_limit = _env_int("WORKER_MAX_MEMORY_MB", 400) * 1024 * 1024
 
-    # 4) Instantiate SimpleWorker to watch those queues
-    print(5)
-    worker = SimpleWorker(queues, connection=conn)
+    # 2) Load everything the jobs need once, before forking
+    warm_up()
 
-    print(f"Starting SimpleWorker, listening on queues: {listen}")
-    # 5) Start processing jobs
-    worker.work()
+    print(f"Starting {processes} WeightedWorker process(es), listening on queues: {listen}")
+    # 3) Supervise the children until SIGTERM
+    WorkerPool(processes, listen, max_jobs, memory_limit).run()